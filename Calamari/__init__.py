@@ -1,3 +1,17 @@
 from base import *
+from buffer import *
+from reader import *
 from trigger import *
 from filter import *
+from fit import *
+from noise import *
+from cut import *
+from writer import *
+from store import *
+from index import *
+from parallel import *
+from shard import *
+from checkpoint import *
+from profiler import *
+from synthetic import *
+from live import *
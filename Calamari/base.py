@@ -1,13 +1,374 @@
 import time
+import cPickle
+from multiprocessing.pool import ThreadPool
 import numpy
-import ROOT
-import root_numpy
+try:
+    import ROOT
+    import root_numpy
+except ImportError:
+    # ROOT is only needed to read/write ROOT files. with a MemmapReader the rest
+    # of the framework works without it
+    ROOT=None
+    root_numpy=None
+
+def masked_mean(values,mask):
+    '''
+    Mean of the selected elements in each row of a 2D array. The rows are
+    grouped by how many elements they select, and the selections of each group
+    are summed along the rows, the way numpy.mean() sums one row's selection, so
+    every mean is bit for bit numpy.mean(values[k][mask[k]])
+
+    Input:
+    -values: 2D array
+    -mask: 2D bool array, same shape as values, True for elements to include
+
+    Returns:
+    -array, mean of each row (nan for rows with nothing selected)
+    '''
+    counts=mask.sum(axis=1)
+    means=numpy.empty(len(values))
+    for n in numpy.unique(counts):
+        rows=numpy.flatnonzero(counts==n)
+        if n==0:
+            means[rows]=numpy.nan
+            continue
+        # each row selects n elements, so the selection reshapes row by row
+        selected=values[rows][mask[rows]].reshape(len(rows),n)
+        means[rows]=numpy.add.reduce(selected,axis=1)/n
+    return means
+
+class EventBlock(object):
+    '''
+    A block of events stored by column instead of as a list of dicts. Each
+    scalar field is a 1D array with one value per event, and each waveform field
+    is a 2D array with one row per event. keep is a bool array that modules set
+    to False for events they reject.
+    '''
+    def __init__(self,columns,keep=None):
+        '''
+        Input:
+        -columns: dict of arrays, all with the same length along the first axis
+        -keep: bool array, which events are kept. None to keep all
+        '''
+        self.columns=dict((name,numpy.asarray(columns[name])) for name in columns)
+        if keep is None:
+            n=len(self.columns.values()[0]) if self.columns else 0
+            keep=numpy.ones(n,dtype=bool)
+        self.keep=keep
+
+    @classmethod
+    def from_events(cls,events):
+        '''
+        Build a block from a list of event dicts that all have the same fields
+
+        Input:
+        -events: list of event dicts
+
+        Returns:
+        -EventBlock
+        '''
+        if len(events)==0:
+            return cls({})
+        return cls(dict((name,numpy.array([event[name] for event in events]))
+            for name in events[0]))
+
+    @classmethod
+    def concatenate(cls,blocks):
+        '''
+        Join blocks with the same fields into one, in order
+
+        Input:
+        -blocks: list of EventBlocks
+
+        Returns:
+        -EventBlock
+        '''
+        blocks=[block for block in blocks if len(block)]
+        if len(blocks)==1:
+            return blocks[0]
+        if len(blocks)==0:
+            return cls({})
+        columns=dict((name,numpy.concatenate([block[name] for block in blocks]))
+            for name in blocks[0].columns)
+        return cls(columns,numpy.concatenate([block.keep for block in blocks]))
+
+    def __len__(self):
+        return len(self.keep)
+
+    def __getitem__(self,name):
+        return self.columns[name]
+
+    def __setitem__(self,name,value):
+        self.columns[name]=numpy.asarray(value)
+
+    def __contains__(self,name):
+        return name in self.columns
+
+    def keys(self):
+        return self.columns.keys()
+
+    def drop(self,names):
+        '''
+        Remove fields from the block
+
+        Input:
+        -names: list of field names. names not in the block are ignored
+        '''
+        for name in names:
+            self.columns.pop(name,None)
+
+    def copy(self):
+        '''
+        Returns:
+        -EventBlock sharing the column arrays, with its own dict of columns and
+        its own keep array, so fields can be added and events rejected without
+        touching this block
+        '''
+        return EventBlock(self.columns,self.keep.copy())
+
+    def take(self,rows):
+        '''
+        Select some events
+
+        Input:
+        -rows: slice, index array or bool array selecting the events
+
+        Returns:
+        -EventBlock with the selected events
+        '''
+        return EventBlock(dict((name,self.columns[name][rows])
+            for name in self.columns),self.keep[rows])
+
+    def compress(self):
+        '''
+        Returns:
+        -EventBlock with only the kept events
+        '''
+        if self.keep.all():
+            return self
+        return self.take(self.keep)
+
+    def event(self,k):
+        '''
+        Input:
+        -k: int, position of event in block
+
+        Returns:
+        -dict of event data for one event. waveforms are views of the block
+        '''
+        return dict((name,self.columns[name][k]) for name in self.columns)
+
+    def events(self):
+        '''
+        Returns:
+        -list of event dicts for the kept events
+        '''
+        return [self.event(k) for k in numpy.flatnonzero(self.keep)]
+
+class EventStore(object):
+    '''
+    Growable columnar store for the events that come out of the FileLooper.
+    Each field is one preallocated array: 1D for scalars, 2D (one row per
+    event) for waveforms. The arrays grow by doubling, so appending is cheap on
+    average, and nothing is kept per event but its row. The fields are fixed by
+    the schema the trigger and modules declare, and by the first events stored;
+    every later event must have the same fields.
+
+    Each event also gets an EventID, its position in the run: when events are
+    written out in chunks during the loop and cleared from the store, the
+    numbering carries on.
+
+    For old code, the store can still be indexed and iterated over like the
+    list of event dicts it replaces.
+    '''
+    def __init__(self,capacity=1024):
+        '''
+        Input:
+        -capacity: int, number of events to allocate room for at first
+        '''
+        self.capacity=capacity
+        self.n_events=0
+        # EventID of the first event in the store
+        self.first_id=0
+        # declared dtype of each field, see declare()
+        self.dtypes={}
+        self.columns={}
+
+    def declare(self,schema):
+        '''
+        Declare the dtypes of fields. The shape of each field (scalar, or waveform
+        length) is taken from the first events stored. Fields already in the
+        store keep their dtype
+
+        Input:
+        -schema: dict of numpy dtypes (or python types), keyed by field name
+        '''
+        self.dtypes.update(schema)
+
+    def allocate(self,block):
+        '''
+        Allocate the columns for the fields of the first block of events
+        '''
+        self.columns['EventID']=numpy.empty(self.capacity,dtype=numpy.int64)
+        for name in block.keys():
+            value=block[name]
+            dtype=self.dtypes.get(name,value.dtype)
+            self.columns[name]=numpy.empty((self.capacity,)+value.shape[1:],
+                dtype=dtype)
+
+    def reserve(self,n_new):
+        '''
+        Make room for n_new more events, at least doubling the capacity if the
+        columns have to grow
+        '''
+        if self.n_events+n_new<=self.capacity:
+            return
+        self.capacity=max(2*self.capacity,self.n_events+n_new)
+        for name in self.columns:
+            column=self.columns[name]
+            grown=numpy.empty((self.capacity,)+column.shape[1:],dtype=column.dtype)
+            grown[:self.n_events]=column[:self.n_events]
+            self.columns[name]=grown
+
+    def append(self,block):
+        '''
+        Store the kept events of a block
+
+        Input:
+        -block: EventBlock
+        '''
+        block=block.compress()
+        n_new=len(block)
+        if n_new==0:
+            return
+        if not self.columns:
+            self.allocate(block)
+        names=set(block.keys())
+        if names!=set(self.columns)-set(['EventID']):
+            raise ValueError("events don't match the fields of the event store: "
+                "missing %s, unexpected %s" %
+                (sorted(set(self.columns)-names-set(['EventID'])),
+                sorted(names-set(self.columns))))
+        self.reserve(n_new)
+        rows=slice(self.n_events,self.n_events+n_new)
+        for name in names:
+            self.columns[name][rows]=block[name]
+        self.columns['EventID'][rows]=numpy.arange(self.n_events,
+            self.n_events+n_new)+self.first_id
+        self.n_events+=n_new
+
+    def append_event(self,event):
+        '''
+        Store one event
+
+        Input:
+        -event: dict of event data
+        '''
+        if len(event)!=len(self.columns)-1 or\
+            any(name not in self.columns for name in event):
+            # first event, or one that doesn't fit (append() says why)
+            self.append(EventBlock.from_events([event]))
+            return
+        self.reserve(1)
+        for name in event:
+            self.columns[name][self.n_events]=event[name]
+        self.columns['EventID'][self.n_events]=self.first_id+self.n_events
+        self.n_events+=1
+
+    def clear(self):
+        '''
+        Drop all events from the store, keeping the allocated columns for the
+        next ones
+        '''
+        self.first_id+=self.n_events
+        self.n_events=0
+
+    def __len__(self):
+        return self.n_events
+
+    def keys(self):
+        return self.columns.keys()
+
+    def __contains__(self,name):
+        return name in self.columns
+
+    def __getitem__(self,key):
+        '''
+        Input:
+        -key: string field name, or int position of an event in the store
+
+        Returns:
+        -array, view of the column holding the field for all events, or dict of
+        event data for one event
+        '''
+        if isinstance(key,basestring):
+            return self.columns[key][:self.n_events]
+        if key<0:
+            key+=self.n_events
+        if key<0 or key>=self.n_events:
+            raise IndexError("event %i not in store of %i events" %
+                (key,self.n_events))
+        return dict((name,self.columns[name][key]) for name in self.columns)
+
+    def __iter__(self):
+        for k in xrange(self.n_events):
+            yield self[k]
+
+    def to_array(self):
+        '''
+        Returns:
+        -numpy structured array with one record per event, with the fields in
+        alphabetical order (EventID first). waveforms are sub-arrays
+        '''
+        if not self.columns:
+            return numpy.zeros(0,dtype=[('EventID',numpy.int64)])
+        names=['EventID']+sorted(set(self.columns)-set(['EventID']))
+        dt=numpy.dtype([(name,self.columns[name].dtype,
+            self.columns[name].shape[1:]) for name in names])
+        out=numpy.empty(self.n_events,dtype=dt)
+        for name in names:
+            out[name]=self.columns[name][:self.n_events]
+        return out
+
+    def to_dataframe(self,waveforms=True):
+        '''
+        Input:
+        -waveforms: bool, if False leave out the waveform fields
+
+        Returns:
+        -pandas DataFrame with one row per event, indexed by EventID. each
+        waveform field is a column of views of the waveforms
+        '''
+        import pandas
+        columns={}
+        for name in self.columns:
+            column=self[name]
+            if column.ndim==1:
+                columns[name]=column
+            elif waveforms:
+                columns[name]=list(column)
+        return pandas.DataFrame(columns,index=self['EventID'])
+
+def execute_batch_copy(task):
+    '''
+    Runs one module on its own copy of a block, for FileLooper.run_stage()
+
+    Input:
+    -task: tuple of the module and the EventBlock
+
+    Returns:
+    -EventBlock, the module's result
+    '''
+    module,block=task
+    return module.execute_batch(block)
 
 class FileLooper(object):
     '''
     Class to control program flow for analyzing SQUID data
     '''
-    def __init__(self,file_names,tree_name,logging=True):
+    def __init__(self,file_names,tree_name,logging=True,reader=None,
+        chunk_size=1000,prefetch=0,prefetch_memory=None,block_size=1,
+        batch_size=1,keep_fields=None,n_threads=1):
         '''
 
         Input:
@@ -15,12 +376,58 @@ class FileLooper(object):
             file to load
         -tree_name: string with name of tree in ROOT file
         -logging: bool, set to True for periodic useful output
+        -reader: Reader class (e.g. TreeReader or MemmapReader) to read the
+            files with. if None, entries are read one at a time from a PyROOT TChain
+        -chunk_size: int, number of entries the reader loads at once
+        -prefetch: int, number of chunks for the reader to read ahead in a
+            background thread while the current chunk is processed. 0 to read
+            serially. needs a reader
+        -prefetch_memory: int, cap in bytes on the waveform data read ahead
+        -block_size: int, number of TChain entries handed to the trigger at once.
+            triggers that vectorize across entries (HeaterTrigger) are much
+            faster with large blocks
+        -batch_size: int, number of events handed to the modules at once, as an
+            EventBlock. modules with an execute_batch() method process the whole
+            block with array operations, the others get one event at a time
+        -keep_fields: list of strings, names of the event fields to keep in the
+            output. other fields are dropped as soon as no module needs them
+            anymore. None to keep everything
+        -n_threads: int, number of threads to run modules that don't depend on
+            each other in at once (see plan_schedule()), with a batch_size above
+            1. numpy and scipy let go of the GIL in most array operations, so
+            modules doing heavy array work on a batch run side by side
         '''
         self.file_names=file_names
         self.tree_name=tree_name
+        self.reader=reader
+        self.chunk_size=chunk_size
+        self.prefetch=prefetch
+        self.prefetch_memory=prefetch_memory
+        self.block_size=block_size
+        self.batch_size=batch_size
+        self.keep_fields=keep_fields
+        self.n_threads=n_threads
+        # stages of modules to run, see plan_schedule()
+        self.stages=None
+        # fields to drop after the trigger and after each stage, see plan_drops()
+        self.drops=None
+        self.pool=None
+        # events from the trigger waiting for a full batch
+        self.pending=[]
+        self.n_pending=0
         self.modules={}
+        # names of the modules in the order they were added
+        self.module_names=[]
         self.trigger=None
-        self.events=[]
+        self.writer=None
+        self.waveform_store=None
+        # directory of trigger indexes, and the index being recorded
+        self.index_directory=None
+        self.index=None
+        # trigger state the last loop started from, see Trigger.state()
+        self.start_state=None
+        self.profiler=None
+        self.events=EventStore()
         self.logging=logging
         if self.logging:
             print "Created FileLooper"
@@ -43,87 +450,558 @@ class FileLooper(object):
         Input:
         -module: module class instance
         '''
+        if module.name not in self.modules:
+            self.module_names+=[module.name]
         self.modules[module.name]=module
         if self.logging:
             print "Added module %s" % (module.name)
 
+    def add_writer(self,writer):
+        '''
+        Function to add a writer, which writes events out in chunks during the
+        loop. Written events are dropped from self.events
+
+        Input:
+        -writer: Writer instance (e.g. RootWriter, HDF5Writer or NPZWriter)
+        '''
+        self.writer=writer
+        if self.logging:
+            print "Added writer %s" % (writer.file_name)
+
+    def add_waveform_store(self,waveform_store):
+        '''
+        Function to add a waveform store. The waveforms of its fields are moved
+        there from each event, and linked to the event by EventID
+
+        Input:
+        -waveform_store: WaveformStore instance
+        '''
+        self.waveform_store=waveform_store
+        if self.logging:
+            print "Added waveform store %s" % (waveform_store.directory)
+
+    def add_profiler(self,profiler):
+        '''
+        Function to add a profiler, which times each stage of the loop and
+        reports at finish()
+
+        Input:
+        -profiler: Profiler instance
+        '''
+        self.profiler=profiler
+        if self.logging:
+            print "Added profiler"
+
+    def add_trigger_index(self,directory):
+        '''
+        Function to keep a TriggerIndex of the trigger's events in a directory.
+        If there is an index for these files and this trigger's settings, the
+        loop reads the indexed events straight from their readout windows (see
+        IndexedTrigger) instead of running the trigger; otherwise a loop over
+        all entries records one
+
+        Input:
+        -directory: string, directory to keep the index files in
+        '''
+        self.index_directory=directory
+        if self.logging:
+            print "Added trigger index %s" % (directory)
+
+    def open_trigger_index(self):
+        '''
+        Swap the trigger for an IndexedTrigger if there is an index for it, or
+        start recording one
+        '''
+        from index import TriggerIndex,IndexedTrigger
+        if isinstance(self.trigger,IndexedTrigger):
+            self.trigger=self.trigger.source
+        index=TriggerIndex(self.index_directory,self.file_names,self.tree_name,
+            self.trigger)
+        if index.exists():
+            self.trigger=IndexedTrigger(index.load(),self.trigger)
+            if self.logging:
+                print "Reading %i events from trigger index %s" %\
+                    (len(index),index.file_name)
+        else:
+            self.index=index
+            self.trigger.locate=True
+            if self.logging:
+                print "Recording trigger index %s" % (index.file_name)
+
+    def attach_modules(self):
+        '''
+        Attach the modules that will run (see plan_schedule()) to the trigger,
+        so the ones that need something from it (e.g. stream filters) ask for it.
+        Skipped modules aren't attached, so the trigger doesn't do work for them.
+        An IndexedTrigger skips entries, so it can't run stream filters; the
+        trigger then scans all entries instead, recording the index again
+        '''
+        from index import TriggerIndex,IndexedTrigger
+        names=[name for stage in self.stages for name in stage]
+        try:
+            for name in names:
+                self.modules[name].attach(self.trigger)
+        except ValueError:
+            if not isinstance(self.trigger,IndexedTrigger):
+                raise
+            if self.logging:
+                print "Not reading from the trigger index, stream filters need "\
+                    "every entry"
+            self.trigger=self.trigger.source
+            self.index=TriggerIndex(self.index_directory,self.file_names,
+                self.tree_name,self.trigger)
+            self.trigger.locate=True
+            for name in names:
+                self.modules[name].attach(self.trigger)
+
+    def plan_schedule(self):
+        '''
+        Work out the order to run the modules in from the fields they read and
+        add (see Module.reads() and Module.schema()). A module runs after the
+        earlier added modules it depends on: those adding fields it reads or
+        adds too, those reading fields it adds, and all of them if it may read
+        any field. Modules that may reject events (see Module.rejects_events())
+        run after all earlier added modules and before all later ones, so each
+        module sees the same events as in the order they were added. The
+        exception are modules that ask to run early (see Module.runs_early(),
+        e.g. a Cut): they are first moved up past the modules they don't depend
+        on, so those only see the events that pass, unless the modules do
+        something else with the events than add fields (or reject them).
+
+        Modules that don't depend on each other make up one stage, and with
+        n_threads above 1 the modules of a stage run at the same time. With
+        keep_fields, modules are skipped if none of the fields they add are kept
+        or read by a module that runs, unless they may reject events or do
+        something else with the events (see Module.side_effects()).
+
+        Returns:
+        -list of stages, each a list of module names, in the order to run them
+        '''
+        names=list(self.module_names)
+        for name in self.module_names:
+            if not self.modules[name].runs_early():
+                continue
+            k=names.index(name)
+            while k>0:
+                earlier=self.modules[names[k-1]]
+                if self.depends(name,names[k-1]) or earlier.side_effects() or\
+                    not earlier.schema():
+                    break
+                k-=1
+            names.remove(name)
+            names.insert(k,name)
+        level={}
+        for k,name in enumerate(names):
+            level[name]=0
+            for other in names[:k]:
+                if self.depends(name,other) or\
+                    self.modules[name].rejects_events() or\
+                    self.modules[other].rejects_events():
+                    level[name]=max(level[name],level[other]+1)
+        order=sorted(names,key=lambda name: (level[name],names.index(name)))
+        needed=set(names)
+        if self.keep_fields is not None:
+            # go backwards, collecting the fields modules that run still need
+            wanted=set(self.keep_fields)
+            if self.waveform_store is not None:
+                wanted|=set(self.waveform_store.fields)
+            read_all=False
+            needed=set()
+            for name in reversed(order):
+                module=self.modules[name]
+                writes=set(module.schema())
+                if read_all or not writes or writes&wanted or\
+                    module.rejects_events() or module.side_effects():
+                    needed.add(name)
+                    reads=module.reads()
+                    if reads is None:
+                        read_all=True
+                    else:
+                        wanted|=set(reads)
+        stages=[]
+        for name in order:
+            if name not in needed:
+                if self.logging:
+                    print "Skipping module %s, nothing uses its output" % name
+                continue
+            if stages and level[stages[-1][0]]==level[name]:
+                stages[-1]+=[name]
+            else:
+                stages+=[[name]]
+        return stages
+
+    def depends(self,name,other):
+        '''
+        Input:
+        -name: string, name of a module
+        -other: string, name of a module added before it
+
+        Returns:
+        -bool, True if the module reads or adds a field the other module adds,
+        or adds a field the other module reads, so it has to run after it
+        '''
+        module=self.modules[name]
+        earlier=self.modules[other]
+        reads=module.reads()
+        earlier_reads=earlier.reads()
+        writes=set(module.schema())
+        earlier_writes=set(earlier.schema())
+        if reads is None or earlier_reads is None:
+            return True
+        return bool(writes&earlier_writes or set(reads)&earlier_writes or
+            set(earlier_reads)&writes)
+
+    def plan_drops(self):
+        '''
+        Work out when each field not in keep_fields can be dropped: right after
+        the trigger if no module reads it, otherwise after the stage (see
+        plan_schedule()) of the last module that reads it (see Module.reads()).
+        Fields going to the waveform store are kept to the end. Fields a module
+        doesn't declare (in schema()) are dropped at the end.
+
+        Returns:
+        -list of lists of field names to drop: after the trigger, then after
+        each stage in turn
+        '''
+        drops=[[] for k in range(len(self.stages)+1)]
+        if self.keep_fields is None:
+            return drops
+        keep=set(self.keep_fields)
+        if self.waveform_store is not None:
+            keep|=set(self.waveform_store.fields)
+        # stage after which each field is last needed, 0 for the trigger
+        last={}
+        for name in self.trigger.schema():
+            last[name]=0
+        for k,stage in enumerate(self.stages):
+            for name in stage:
+                for field in self.modules[name].schema():
+                    last[field]=k+1
+        for k,stage in enumerate(self.stages):
+            for name in stage:
+                reads=self.modules[name].reads()
+                for field in last:
+                    # a module that doesn't say what it reads may read anything
+                    if reads is None or field in reads:
+                        last[field]=max(last[field],k+1)
+        for field in last:
+            if field not in keep:
+                drops[last[field]]+=[field]
+        return drops
+
+    def drop_fields(self,events,names):
+        '''
+        Remove fields from an event dict or EventBlock
+        '''
+        if isinstance(events,EventBlock):
+            events.drop(names)
+        else:
+            for name in names:
+                events.pop(name,None)
+
+    def store(self,events):
+        '''
+        Moves waveforms to the waveform store, drops the fields that aren't kept,
+        and saves the events in self.events
+
+        Input:
+        -events: event dict or EventBlock that made it through all modules
+        '''
+        block=isinstance(events,EventBlock)
+        if self.waveform_store is not None:
+            first_id=self.events.first_id+len(self.events)
+            n=len(events) if block else 1
+            self.waveform_store.append(numpy.arange(first_id,first_id+n),
+                dict((name,events[name]) for name in self.waveform_store.fields))
+            self.drop_fields(events,self.waveform_store.fields)
+        if self.keep_fields is not None:
+            # TriggerEventID links events to the trigger index, like EventID
+            self.drop_fields(events,[name for name in events.keys()
+                if name not in self.keep_fields and name!='TriggerEventID'])
+        if block:
+            self.events.append(events)
+        else:
+            self.events.append_event(events)
+
+    def flush(self,final=False):
+        '''
+        Hand the stored events to the writer once there is a full chunk of them
+
+        Input:
+        -final: bool, if True write whatever is left, and close the writer
+        '''
+        if self.writer is None:
+            return
+        if final or len(self.events)>=self.writer.chunk_size:
+            self.writer.write(self.events.to_array())
+            self.events.clear()
+        if final:
+            self.writer.close()
+
+    def schema(self):
+        '''
+        Returns:
+        -dict of dtypes of the event fields declared by the trigger and the
+        modules that run, and TriggerEventID while a trigger index is recorded
+        or read
+        '''
+        from index import IndexedTrigger
+        schema=self.trigger.schema()
+        if self.index is not None or isinstance(self.trigger,IndexedTrigger):
+            schema['TriggerEventID']=int
+        names=self.module_names if self.stages is None else\
+            [name for stage in self.stages for name in stage]
+        for name in names:
+            schema.update(self.modules[name].schema())
+        return schema
+
     def open_file(self):
         '''
-        Creates ROOT TChain, adds files to chain
+        Creates ROOT TChain, adds files to chain. If a reader was given, the reader
+        is used in place of the TChain; it has the same interface as far as
+        triggers are concerned
         '''
-        self.chain=ROOT.TChain(self.tree_name)
-        for f in self.file_names:
-            self.chain.Add(f)
+        if self.reader is not None:
+            self.chain=self.reader(self.file_names,self.tree_name,self.chunk_size)
+            if self.prefetch>0:
+                self.chain.start_prefetch(self.prefetch,self.prefetch_memory)
+        elif self.prefetch>0:
+            raise ValueError("prefetching needs a reader, not a TChain")
+        else:
+            self.chain=ROOT.TChain(self.tree_name)
+            for f in self.file_names:
+                self.chain.Add(f)
         if self.logging:
             print "Opened files"
 
-    def loop(self,n_events=0):
+    def loop(self,n_events=0,start=0,state=None):
         '''
         This is where all the actual calculations/work happens. This function
         loops through each entry of the TChain. For each entry, it:
             -applies the trigger module on the ROOT TChain entry, which returns
-            a dict of data for that event
-            -applies each additional module to this outputed dict. each
+            a list of dicts of data, one for each event found in the entry
+            -applies each additional module to each outputed dict. each
             module should return a new dict, containing previous and
             additional event data
-            -saves final event dict in a list of dicts
+            -saves final event dicts in a list of dicts
 
         Input:
         -n_events: int, number of events to process. if 0, it processes all
         events in files
+        -start: int, TChain entry to start from. the trigger is warmed up on the
+        entries before it (see Trigger.warm_up)
+        -state: trigger state to start from (see Trigger.state), e.g. the state
+        a loop over the entries before start ended in. The trigger is then not
+        warmed up, unless it has stream filters, which still need the entries
+        before start. None to rely on the warm-up
         '''
         start_time=time.time()
         self.open_file()
+        n_visited=0
+        # the prefetch thread, thread pool and profiler are stopped even if
+        # the loop fails
+        try:
+            if self.index_directory is not None:
+                self.open_trigger_index()
+            if self.logging:
+                print "Starting loop"
+            self.stages=self.plan_schedule()
+            # modules that need something from the trigger ask for it before looping
+            self.attach_modules()
+            self.events.declare(self.schema())
+            self.drops=self.plan_drops()
+            if self.n_threads>1 and self.batch_size>1 and\
+                any(len(stage)>1 for stage in self.stages):
+                self.pool=ThreadPool(self.n_threads)
+            if n_events==0:
+                n_events=self.chain.GetEntries()-start
+            # entry to stop before
+            stop=min(start+n_events,self.chain.GetEntries())
+            if self.profiler is not None:
+                self.profiler.instrument(self)
+            # an exact state leaves nothing for the warm-up to do but the stream
+            # filters
+            if start>0 and (state is None or self.trigger.stream_filters):
+                self.trigger.warm_up(self.chain,start)
+            if state is not None:
+                self.trigger.set_state(state)
+            self.start_state=self.trigger.state()
+            # the trigger may know up front that only some entries are worth looking at
+            if hasattr(self.trigger,'select_entries'):
+                entries=self.trigger.select_entries(self.chain,stop,start)
+            else:
+                entries=xrange(start,stop)
+            block=[]
+            for self.i in entries:
+                if self.block_size>1:
+                    # collect entries until there is a full block for the trigger
+                    block+=[self.i]
+                    if len(block)<self.block_size:
+                        continue
+                    events=self.trigger.execute_block(self.chain,block)
+                    n_new=len(block)
+                    block=[]
+                else:
+                    # apply trigger to each entry in root tree
+                    # this builds triggered waveforms, puts them in dict structure
+                    # other modules work with event data in dict form
+                    events=self.trigger.execute(self.chain,self.i)
+                    n_new=1
+                self.process(events)
+                n_visited+=n_new
+                if self.logging and n_visited/100>(n_visited-n_new)/100:
+                    print "Event %i / %i" % (self.i+1, stop)
+            if block:
+                self.process(self.trigger.execute_block(self.chain,block))
+                n_visited+=len(block)
+            # whatever is left over makes the last, smaller batch
+            if self.n_pending:
+                self.process_batch(EventBlock.concatenate(self.pending))
+                self.pending=[]
+                self.n_pending=0
+            self.flush(final=True)
+            if self.index is not None:
+                # an index has to hold every event of the run
+                if start==0 and stop==self.chain.GetEntries():
+                    self.index.save()
+                elif self.logging:
+                    print "Not saving trigger index, the loop didn't cover all entries"
+        finally:
+            if self.waveform_store is not None:
+                self.waveform_store.close()
+            if self.reader is not None:
+                self.chain.stop_prefetch()
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool=None
+            if self.index is not None:
+                self.trigger.locate=False
+                self.index=None
+            if self.profiler is not None and self.profiler.wrapped:
+                self.profiler.release(self,n_visited)
+        end_time=time.time()
         if self.logging:
-            print "Starting loop"
-        self.i=0
-        if n_events==0:
-            n_events=self.chain.GetEntries()
-        while self.i < n_events:
-            # apply trigger to each entry in root tree
-            # this builds triggered waveforms, puts them in dict structure
-            # other modules work with event data in dict form
-            event=self.trigger.execute(self.chain,self.i)
-            for name in self.modules:
-                # if an event doesn't trigger, trigger should return False
-                # similarly, if a module rejects an event, module shoul return False
+            print "Finished loop in %3.2f seconds" % (end_time-start_time)
+
+    def process(self,events):
+        '''
+        Applies each module to events from the trigger, and saves the ones that
+        come out the other end. With a batch_size above 1, events are collected
+        into EventBlocks of that size first
+
+        Input:
+        -events: list of event dicts, or an EventBlock, from the trigger. a single
+        event dict, or False for no events, is accepted as well
+        '''
+        if self.index is not None:
+            self.index.add(events)
+        if self.batch_size>1:
+            if not isinstance(events,EventBlock):
+                if isinstance(events,dict):
+                    events=[events]
+                events=EventBlock.from_events(events or [])
+            if len(events)==0:
+                return
+            self.pending+=[events]
+            self.n_pending+=len(events)
+            if self.n_pending>=self.batch_size:
+                events=EventBlock.concatenate(self.pending)
+                n_full=self.batch_size*(len(events)/self.batch_size)
+                for start in xrange(0,n_full,self.batch_size):
+                    self.process_batch(events.take(slice(start,start+self.batch_size)))
+                self.pending=[events.take(slice(n_full,None))]
+                self.n_pending=len(events)-n_full
+            return
+        if isinstance(events,EventBlock):
+            events=events.events()
+        elif not events:
+            events=[]
+        elif isinstance(events,dict):
+            events=[events]
+        for event in events:
+            self.drop_fields(event,self.drops[0])
+            for k,stage in enumerate(self.stages):
+                for name in stage:
+                    # if a module rejects an event, module should return False
+                    if event:
+                        event=self.modules[name].execute(event)
                 if event:
-                    event=self.modules[name].execute(event)
+                    self.drop_fields(event,self.drops[k+1])
             if event:
-                self.events+=[event]
-            self.i+=1
-            if self.logging and self.i%100==0:
-                print "Event %i / %i" % (self.i, n_events)
-            if self.i==n_events:
-                break
-        end_time=time.time()
+                self.store(event)
+        self.flush()
+
+    def process_batch(self,block):
+        '''
+        Applies each module to a block of events, dropping rejected events after
+        each module, and saves the ones that come out the other end
+
+        Input:
+        -block: EventBlock of events from the trigger
+        '''
+        self.drop_fields(block,self.drops[0])
+        for k,stage in enumerate(self.stages):
+            block=self.run_stage(stage,block).compress()
+            if len(block)==0:
+                return
+            self.drop_fields(block,self.drops[k+1])
+        self.store(block)
+        self.flush()
+
+    def run_stage(self,stage,block):
+        '''
+        Applies the modules of one stage to a block of events. With a thread
+        pool, the modules with their own execute_batch() each get a shallow
+        copy of the block to work on at the same time, and the fields they add
+        and the events they reject are gathered back into the block. Modules
+        with the default, event by event execute_batch() hold on to the GIL, so
+        they run one after another
+
+        Input:
+        -stage: list of module names
+        -block: EventBlock
+
+        Returns:
+        -EventBlock, with the results of all the modules added
+        '''
+        modules=[self.modules[name] for name in stage]
+        threaded=[module for module in modules
+            if type(module).execute_batch!=Module.execute_batch]
+        if self.pool is None or len(threaded)<2:
+            for module in modules:
+                block=module.execute_batch(block)
+            return block
+        results=self.pool.map(execute_batch_copy,
+            [(module,block.copy()) for module in threaded])
+        for result in results:
+            for name in result.keys():
+                if name not in block or result[name] is not block[name]:
+                    block[name]=result[name]
+            block.keep&=result.keep
+        for module in modules:
+            if module not in threaded:
+                block=module.execute_batch(block)
+        return block
 
     def write_output(self,outfile_name,ROOT=True,pickle=False):
         '''
         Converts outputed event data into re-usable data format,
-        either ROOT or a pickled numpy record array
+        either ROOT or a pickled numpy record array. With a writer, only the
+        events not written out yet are left to write here
 
         Input:
         -outfile_name: string, name of outfile to write to (without extension)
         -ROOT: bool, True to write a ROOT file
         -pickle: bool, True to write a pickle file
         '''
-        # build record array of outputed event dicts
-        # assume all dict's are the same structure
-        dt=[]
-        for item in self.events[0]:
-            if type(self.events[0][item])==numpy.ndarray:
-                dt+=[(item,type(self.events[0][item][0]),len(self.events[0][item]))]
-            else:
-                dt+=[(item,type(self.events[0][item]))]
-
-        dt=numpy.dtype(dt)
-        values=[tuple(each.values()) for each in self.events]
-        out=numpy.zeros((len(self.events),),dtype=dt)
-        out[:]=values
+        # build record array straight from the columns of the event store
+        out=self.events.to_array()
 
         # convert record array to root tree, write to file
         if ROOT:
+            if root_numpy is None:
+                raise ImportError("writing ROOT files needs root_numpy")
             if self.logging:
                 print "Creating file %s.root" % (outfile_name)
             root_numpy.array2root(out,'%s.root' % (outfile_name))
@@ -131,8 +1009,8 @@ class FileLooper(object):
         if pickle:
             if self.logging:
                 print "Creating file %s.pickle" % (outfile_name)
-            f=open('%s.pickle' % (outfile_name),'w')
-            pickle.dump(out,f)
+            f=open('%s.pickle' % (outfile_name),'wb')
+            cPickle.dump(out,f,cPickle.HIGHEST_PROTOCOL)
             f.close()
 
     def finish(self):
@@ -140,8 +1018,10 @@ class FileLooper(object):
         Calls finish methods of trigger and each modules
         '''
         self.trigger.finish()
-        for name in self.modules:
+        for name in self.module_names:
             self.modules[name].finish()
+        if self.profiler is not None:
+            self.profiler.report()
         if self.logging:
             print "Finished"
 
@@ -152,10 +1032,13 @@ class Module(object):
     All Modules can have names (strings), event counters, and timers
 
     For a Trigger Module, the execute() method should take in a TChain and an
-    integer corresponding to the current position in the TChain to consider
+    integer corresponding to the current position in the TChain to consider, and
+    return a list of dicts, one for each event found there
 
     For a standard Module, the execute() method should take in a dict that contains
-    all data for that given (already triggered) event
+    all data for that given (already triggered) event. A standard Module can also
+    have an execute_batch() method that takes in a whole EventBlock of events, to
+    use array operations across events
     '''
     def __init__(self,name):
         '''
@@ -183,6 +1066,22 @@ class Module(object):
             return out
         return wrapper
 
+    @staticmethod
+    def _execute_block(exec_fn):
+        '''
+        Like _execute, for execute methods that handle a whole block of entries
+        or events in one call. The block is the last positional argument, and the
+        counter goes up by its length.
+        '''
+        def wrapper(self,*args,**kwargs):
+            start_time=time.time()
+            out=exec_fn(self,*args,**kwargs)
+            self.counter+=len(args[-1])
+            end_time=time.time()
+            self.run_time+=end_time-start_time
+            return out
+        return wrapper
+
     @staticmethod
     def _finish(finish_fn):
         '''
@@ -202,8 +1101,355 @@ class Module(object):
         '''
         pass
 
+    def execute_batch(self,block):
+        '''
+        This function is called on each block of events, when FileLooper has a
+        batch_size above 1. By default it calls execute() on each kept event and
+        builds a new block from the results. Modules that can work on whole
+        columns at once override this, modify the block in place (setting
+        block.keep to False for rejected events) and return it.
+
+        Input:
+        -block: EventBlock
+
+        Returns:
+        -EventBlock, with the module's results added
+        '''
+        events=[]
+        for k in numpy.flatnonzero(block.keep):
+            event=self.execute(block.event(k))
+            if event:
+                events+=[event]
+        return EventBlock.from_events(events)
+
+    def attach(self,trigger):
+        '''
+        Called by FileLooper once before looping, with the trigger the module's
+        events come from. Modules that need the trigger to do something for them
+        (e.g. filter the stream it reads out from) ask for it here.
+
+        Input:
+        -trigger: Trigger instance
+        '''
+        pass
+
+    def merge(self,other):
+        '''
+        Add the results of another instance of the module, which processed other
+        events (e.g. in a worker of a ParallelLooper), to this one. By default
+        this adds up the event counters and timers. Modules that accumulate
+        other results add those too
+
+        Input:
+        -other: instance of the same module
+        '''
+        self.counter+=other.counter
+        self.run_time+=other.run_time
+
+    def reads(self):
+        '''
+        Declares the event fields the module reads, so the FileLooper can drop
+        fields no module needs anymore
+
+        Returns:
+        -list of field names, or None if the module may read any field
+        '''
+        return None
+
+    def rejects_events(self):
+        '''
+        Declares whether the module may reject events (return False from
+        execute(), or set block.keep to False), which keeps the FileLooper from
+        moving other modules past it. Modules that never do say so, so they can
+        be reordered, run side by side, or skipped (see
+        FileLooper.plan_schedule())
+
+        Returns:
+        -bool
+        '''
+        return True
+
+    def runs_early(self):
+        '''
+        Declares whether the module should be moved up to run as soon as the
+        fields it reads are there, ahead of modules added before it (see
+        FileLooper.plan_schedule()). For modules that reject events, so fewer
+        events reach the expensive ones
+
+        Returns:
+        -bool
+        '''
+        return False
+
+    def side_effects(self):
+        '''
+        Declares whether the module does something with the events besides
+        adding its fields to them (e.g. accumulate results), so it has to run
+        even if none of its fields are used
+
+        Returns:
+        -bool
+        '''
+        return False
+
+    def schema(self):
+        '''
+        Declares the fields the module adds to events, and their types
+
+        Returns:
+        -dict of numpy dtypes (or python types), keyed by field name. waveform
+        fields give the type of one sample
+        '''
+        return {}
+
+    def config(self):
+        '''
+        The settings that decide what the module does to events, for checking
+        saved results (e.g. checkpoints) still apply. Modules override this
+
+        Returns:
+        -dict of JSON serializable settings, or None if the module doesn't say
+        '''
+        return None
+
     def finish(self):
         '''
         After processing all events, this function is called once.
         '''
         pass
+
+class Trigger(Module):
+    '''
+    Base class for Trigger Modules to plug into FileLooper
+
+    The execute() method takes in a TChain and an integer corresponding to the
+    current position in the TChain, and returns a list of event dicts, one for
+    each event found there (an empty list if nothing triggered)
+
+    A trigger that carries state from one entry to the next sets warmup_entries
+    to the number of entries it usually needs to look at before it gives the
+    same events as when starting from the first entry. If that can't be
+    guaranteed, it also overrides state() and set_state(), so a loop starting
+    part way through can be checked against, or handed, the exact state.
+    '''
+    warmup_entries=0
+
+    def __init__(self,name):
+        '''
+        Input:
+        -name: string name of trigger
+        '''
+        # Filter modules run on the stream of entries, see add_stream_filter()
+        self.stream_filters=[]
+        # modules fed the data that didn't trigger, see add_noise_accumulator()
+        self.noise_accumulators=[]
+        # samples at the start of the next entry covered by a readout window
+        self.noise_spill=0
+        # set while warming up, so the noise isn't fed twice
+        self.noise_paused=False
+        # set while a TriggerIndex is recorded, see locate_event()
+        self.locate=False
+        super(Trigger,self).__init__(name)
+
+    def config(self):
+        '''
+        The settings that decide which events the trigger finds, for keying a
+        TriggerIndex. Triggers that can be indexed override this
+
+        Returns:
+        -dict of JSON serializable settings, or None if the trigger can't be
+        indexed
+        '''
+        return None
+
+    def window_entries(self):
+        '''
+        Where each waveform field of an event is read out from, relative to the
+        entry the event was found in, for a TriggerIndex
+
+        Returns:
+        -dict of (offset in TChain entries, step between entries of the stream)
+        tuples, keyed by waveform field name
+        '''
+        return dict((name,(0,buffer.step))
+            for name,buffer in self.stream_buffers().items())
+
+    def locate_event(self,event,entry,start,length):
+        '''
+        While a TriggerIndex is recorded, add where the readout window came from
+        to an event (the FileLooper moves these fields to the index before any
+        module sees the event)
+
+        Input:
+        -event: event dict, or dict of arrays for a block of events
+        -entry: int, TChain position of the entry the event was found in
+        -start: int, first sample of the readout window, relative to the start
+        of that entry
+        -length: int, number of samples in the readout window
+        '''
+        if not self.locate:
+            return
+        event['Entry']=entry
+        event['WindowStart']=start
+        event['WindowLength']=length
+
+    def stream_buffers(self):
+        '''
+        Buffers the trigger reads out waveforms from
+
+        Returns:
+        -dict of StitchedBuffer, keyed by the name of the waveform read out from
+        it in the event dicts
+        '''
+        return {}
+
+    def skips_entries(self):
+        '''
+        Whether the trigger may leave entries of a stream out (see
+        select_entries()). A stream filter would then start over at every gap,
+        so such triggers refuse stream filters
+
+        Returns:
+        -bool, False by default
+        '''
+        return False
+
+    def add_stream_filter(self,filter):
+        '''
+        Filter one of the trigger's streams of entries, and read out the filtered
+        waveform along with the raw one. Triggers that skip entries (see
+        skips_entries()) raise a ValueError
+
+        Input:
+        -filter: Filter module in stream mode. its input_name says which waveform
+        to filter, and its output_name what to call the filtered one
+        '''
+        if filter in self.stream_filters:
+            return
+        if self.skips_entries():
+            raise ValueError("%s skips entries, so it can't filter the stream; "
+                "use %s without stream=True" % (self.name,filter.name))
+        buffers=self.stream_buffers()
+        if filter.input_name not in buffers:
+            raise ValueError("%s can't filter %s, it only reads out %s" %
+                (self.name,filter.input_name,', '.join(sorted(buffers))))
+        buffers[filter.input_name].add_filter(filter)
+        self.stream_filters+=[filter]
+
+    def add_noise_accumulator(self,accumulator):
+        '''
+        Feed the stretches of data that don't end up in any readout window to an
+        accumulator, e.g. a NoisePSD module
+
+        Input:
+        -accumulator: object with an add(waveforms,dt_sample) method
+        '''
+        if accumulator not in self.noise_accumulators:
+            self.noise_accumulators+=[accumulator]
+
+    def accumulate_noise(self,waveform,windows,dt_sample):
+        '''
+        Feed the parts of an entry outside all readout windows to the noise
+        accumulators. Readout windows that reach into the next entry are
+        remembered, and the start of the next entry is left out too.
+
+        Input:
+        -waveform: array, waveform of the current entry
+        -windows: list of (start,end) sample ranges of the readout windows,
+        relative to the start of the entry. can reach beyond it on either side
+        -dt_sample: float, time interval of one sample
+        '''
+        if not self.noise_accumulators:
+            return
+        n=len(waveform)
+        start=self.noise_spill
+        self.noise_spill=0
+        for window_start,window_end in sorted(windows)+[(n,n)]:
+            if window_start>start and not self.noise_paused:
+                for accumulator in self.noise_accumulators:
+                    accumulator.add(waveform[start:min(window_start,n)],dt_sample)
+            start=max(start,window_end)
+            self.noise_spill=max(self.noise_spill,window_end-n)
+
+    def select_entries(self,chain,n_entries,start=0):
+        '''
+        Called once before looping, to choose which TChain entries execute() is
+        called on. By default, all of them.
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -n_entries: int, entry to stop before
+        -start: int, first entry to consider
+
+        Returns:
+        -iterable of ints, the TChain positions to visit, in increasing order
+        '''
+        return xrange(start,n_entries)
+
+    def warm_up(self,chain,start):
+        '''
+        Called before looping from an entry other than the first (e.g. by a
+        worker of a ParallelLooper), so the trigger is in the same state as if it
+        had looped over all the entries before. By default this runs execute() on
+        the warmup_entries entries before start and throws away their events.
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -start: int, first entry the loop will visit
+        '''
+        counter=self.counter
+        self.noise_paused=True
+        for i in xrange(max(0,start-self.warmup_entries),start):
+            self.execute(chain,i)
+        self.noise_paused=False
+        self.counter=counter
+
+    def state(self):
+        '''
+        The state the trigger carries from one entry to the next, between two
+        entries. A loop started part way through compares its state after
+        warm_up() with the state the loop over the entries before ended in.
+        By default triggers are taken to be fully warmed up by warm_up()
+
+        Returns:
+        -picklable object that compares equal (with ==) for the same state,
+        or None if warm_up() always gives the exact state
+        '''
+        return None
+
+    def set_state(self,state):
+        '''
+        Put the trigger in a state returned by state(). A loop started from a
+        state calls this instead of warm_up() (or after it, if the trigger has
+        stream filters), so it has to set everything warm_up() would
+
+        Input:
+        -state: object returned by state() of a trigger with the same settings
+        '''
+        pass
+
+    def execute_block(self,chain,entries):
+        '''
+        Called by FileLooper on a block of TChain entries at once, when its
+        block_size is above 1. By default this just calls execute() on each entry,
+        copying the readout windows of its events: they are views of the trigger's
+        buffers, which the next entry overwrites. Triggers that can vectorize
+        across entries override it.
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -entries: list of ints, TChain positions to process, in increasing order
+
+        Returns:
+        -list of event dicts from all the entries, in order, or an EventBlock
+        holding them
+        '''
+        events=[]
+        for i in entries:
+            out=self.execute(chain,i)
+            if isinstance(out,dict):
+                out=[out]
+            for event in out or []:
+                events+=[dict((name,value.copy() if isinstance(value,numpy.ndarray)
+                    else value) for name,value in event.items())]
+        return events
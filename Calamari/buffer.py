@@ -0,0 +1,320 @@
+import timeit
+import collections
+import numpy
+
+class StitchedBuffer(object):
+    '''
+    Contiguous buffer holding the waveforms of the previous, current and next
+    entries of one data stream in a TChain. A readout window that spills into a
+    neighbouring entry is then still a plain slice of one array, so triggers can
+    hand out readout windows as views instead of copying them together.
+
+    The three entries sit in a longer array that is allocated once. Moving
+    forward one entry only writes the new next entry after the others, and
+    slides the three entries along; when they reach the end of the array, the
+    previous and current entries are copied back to its start, once every
+    n_slots-3 entries. Entries already in the buffer are reused, so moving
+    forward one entry at a time reads each entry from the chain only once.
+
+    Windows (and current()) are views of the buffer: they are only valid until
+    the next call to load(). Whoever keeps a window longer than that, e.g. an
+    event waiting for a full batch, has to copy it.
+
+    Filters added with add_filter() are run over the stream as entries come into
+    the buffer, carrying the filter state across entry boundaries, and the
+    filtered stream is kept in a second buffer alongside the raw one.
+    '''
+    # length of the array holding the three entries, in entries
+    n_slots=8
+
+    def __init__(self,step=1,cache=None):
+        '''
+        Input:
+        -step: int, spacing in the TChain between consecutive entries of this
+        stream. 1 for background data, 2 when heater and bolometer entries
+        alternate
+        -cache: EntryCache to read entries through, if it is shared with other
+        parts of a trigger. None to read from the chain directly
+        '''
+        self.step=step
+        self.cache=cache
+        self.n_samples=0
+        # chain index of the current entry and the buffer around it: a view of
+        # 3*n_samples of storage, starting at offset
+        self.i=None
+        self.data=None
+        self.storage=None
+        self.offset=0
+        # stream filters, and the filtered buffer and its storage for each, by
+        # output name
+        self.filters=[]
+        self.filtered={}
+        self.filtered_storage={}
+        # (last entry filtered, filter state after it), by output name
+        self.filter_state={}
+        # time spent stitching entries together in load(), for profiling
+        self.load_time=0.
+
+    def add_filter(self,filter):
+        '''
+        Run a filter over the stream from now on
+
+        Input:
+        -filter: Filter module, with apply_filter() and initial_state()
+        '''
+        self.filters+=[filter]
+        self.filter_state[filter.output_name]=(None,None)
+        # entries already in the buffer were never filtered, so start over
+        self.i=None
+        self.data=None
+        self.storage=None
+        self.filtered={}
+        self.filtered_storage={}
+
+    def filter_entry(self,filter,entry,waveform):
+        '''
+        Filter one entry of the stream. The filter state carries over from the
+        previous entry of the stream if that was the last one filtered, otherwise
+        it is started as if the stream had been flat before this entry.
+
+        Input:
+        -filter: Filter module
+        -entry: int, position in TChain of the entry
+        -waveform: array, raw waveform of the entry
+
+        Returns:
+        -array, filtered waveform
+        '''
+        last,zi=self.filter_state[filter.output_name]
+        if last is None or entry!=last+self.step:
+            zi=filter.initial_state(waveform[0])
+        filtered,zi=filter.apply_filter(waveform,zi)
+        self.filter_state[filter.output_name]=(entry,zi)
+        return filtered
+
+    def fetch(self,chain,i):
+        '''
+        Read the waveform of one entry from the chain
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -i: int, position in TChain
+
+        Returns:
+        -array, waveform of entry i. entries outside the chain, or that the
+        chain has no data for (GetEntry() returns 0), are zeros
+        '''
+        if i<0 or i>=chain.GetEntries():
+            return numpy.zeros(self.n_samples)
+        if self.cache is not None:
+            entry=self.cache.get(chain,i)
+            return numpy.zeros(self.n_samples) if entry is None else entry.Waveform
+        if not chain.GetEntry(i):
+            return numpy.zeros(self.n_samples)
+        return numpy.asarray(chain.Waveform,dtype=float)
+
+    def fill(self,chain,k,entry):
+        '''
+        Read one entry into slot k of the buffer (0 for the previous entry, 1
+        for the current one, 2 for the next), and filter it
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -k: int, slot
+        -entry: int, position in TChain of the entry
+        '''
+        n=self.n_samples
+        self.data[k*n:(k+1)*n]=self.fetch(chain,entry)
+        for f in self.filters:
+            filtered=self.filtered[f.output_name]
+            if 0<=entry<chain.GetEntries():
+                filtered[k*n:(k+1)*n]=self.filter_entry(f,entry,
+                    self.data[k*n:(k+1)*n])
+            else:
+                filtered[k*n:(k+1)*n]=0
+
+    def slide(self,offset):
+        '''
+        Point the buffer at the three entries starting at offset in the storage
+        '''
+        n=self.n_samples
+        self.offset=offset
+        self.data=self.storage[offset:offset+3*n]
+        for name in self.filtered_storage:
+            self.filtered[name]=self.filtered_storage[name][offset:offset+3*n]
+
+    def load(self,chain,i):
+        '''
+        Make entry i the current entry of the buffer. This leaves the chain
+        positioned on whichever entry was read last, so call chain.GetEntry()
+        again before reading branches from it. Windows from before are no longer
+        valid after this
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -i: int, position in TChain of the new current entry
+
+        Returns:
+        -array of length 3*n_samples, the previous, current and next entries
+        '''
+        if i==self.i:
+            return self.data
+        start_time=timeit.default_timer()
+        if self.storage is None:
+            # the first entry fixes the waveform length
+            current=self.fetch(chain,i)
+            self.n_samples=n=len(current)
+            self.storage=numpy.empty(self.n_slots*n)
+            self.filtered_storage=dict((f.output_name,numpy.empty(self.n_slots*n))
+                for f in self.filters)
+            self.slide(0)
+            self.fill(chain,0,i-self.step)
+            self.data[n:2*n]=current
+            for f in self.filters:
+                self.filtered[f.output_name][n:2*n]=\
+                    self.filter_entry(f,i,self.data[n:2*n])
+            self.fill(chain,2,i+self.step)
+        elif i==self.i+self.step:
+            n=self.n_samples
+            if self.offset+4*n>len(self.storage):
+                # back to the start: the previous and current entries become
+                # the new previous and current entries there
+                for storage in [self.storage]+self.filtered_storage.values():
+                    storage[:2*n]=storage[self.offset+n:self.offset+3*n]
+                self.slide(0)
+            else:
+                self.slide(self.offset+n)
+            self.fill(chain,2,i+self.step)
+        else:
+            # anywhere else: keep the entries that are already in the buffer,
+            # and read the others
+            n=self.n_samples
+            kept={}
+            for k in range(3):
+                old_k=k+(i-self.i)/self.step
+                if (i-self.i)%self.step==0 and 0<=old_k<=2:
+                    kept[k]=[self.data[old_k*n:(old_k+1)*n].copy()]+\
+                        [self.filtered[f.output_name][old_k*n:(old_k+1)*n].copy()
+                        for f in self.filters]
+            self.slide(0)
+            for k in range(3):
+                if k in kept:
+                    self.data[k*n:(k+1)*n]=kept[k][0]
+                    for f,waveform in zip(self.filters,kept[k][1:]):
+                        self.filtered[f.output_name][k*n:(k+1)*n]=waveform
+                else:
+                    self.fill(chain,k,i+(k-1)*self.step)
+        self.i=i
+        self.load_time+=timeit.default_timer()-start_time
+        return self.data
+
+    def current(self):
+        '''
+        Returns:
+        -array, view of the waveform of the current entry
+        '''
+        return self.data[self.n_samples:2*self.n_samples]
+
+    def window(self,start,end):
+        '''
+        Readout window from the buffer
+
+        Input:
+        -start: int, first sample of the window, relative to the start of the
+        current entry. can be negative, down to -n_samples
+        -end: int, sample after the last one in the window, relative to the start
+        of the current entry. can be up to 2*n_samples
+
+        Returns:
+        -array, view of the buffer covering the window
+        '''
+        if start<-self.n_samples or end>2*self.n_samples:
+            raise IndexError("readout window [%i,%i) reaches beyond the "
+                "neighbouring entries" % (start,end))
+        return self.data[self.n_samples+start:self.n_samples+end]
+
+    def filtered_windows(self,start,end):
+        '''
+        Readout window from each filtered buffer
+
+        Input:
+        -start: int, first sample of the window, as for window()
+        -end: int, sample after the last one in the window, as for window()
+
+        Returns:
+        -dict of arrays, views of the filtered buffers covering the window, keyed
+        by the output name of each filter
+        '''
+        self.window(start,end)
+        n=self.n_samples
+        return dict((name,self.filtered[name][n+start:n+end])
+            for name in self.filtered)
+
+class DecodedEntry(object):
+    '''
+    One TChain entry converted to python: the waveform as a numpy array, and the
+    scalar branches as attributes, named like the branches
+    '''
+    def __init__(self,Waveform,**scalars):
+        '''
+        Input:
+        -Waveform: array, waveform of the entry
+        -scalars: values of the scalar branches (Ch, t_s, t_mus, dt_s)
+        '''
+        self.Waveform=Waveform
+        self.__dict__.update(scalars)
+
+class EntryCache(object):
+    '''
+    Small bounded cache of decoded TChain entries, keyed by chain index. Parts of
+    a trigger that look at the same entries (e.g. the current entry and its
+    neighbours) share one cache, so each entry is read from the chain and
+    converted to numpy only once. When full, the least recently used entry is
+    dropped.
+    '''
+    scalar_names=['Ch','t_s','t_mus','dt_s']
+
+    def __init__(self,size=8):
+        '''
+        Input:
+        -size: int, maximum number of entries to keep
+        '''
+        self.size=size
+        self.entries=collections.OrderedDict()
+        self.hits=0
+        self.misses=0
+
+    def get(self,chain,i):
+        '''
+        Decoded entry i, read from the chain if it isn't cached
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -i: int, position in TChain
+
+        Returns:
+        -DecodedEntry for entry i, or None if there is no entry i, or the
+        chain has no data for it (GetEntry() returns 0)
+        '''
+        if i in self.entries:
+            self.hits+=1
+            entry=self.entries.pop(i)
+            self.entries[i]=entry
+            return entry
+        if i<0 or i>=chain.GetEntries():
+            return None
+        self.misses+=1
+        if not chain.GetEntry(i):
+            return None
+        scalars=dict((name,getattr(chain,name,None)) for name in self.scalar_names)
+        entry=DecodedEntry(numpy.asarray(chain.Waveform,dtype=float),**scalars)
+        self.entries[i]=entry
+        if len(self.entries)>self.size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        '''
+        Drop all cached entries
+        '''
+        self.entries.clear()
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import hashlib
+import cPickle
+import numpy
+from base import *
+from index import file_signature
+from parallel import run_range
+from shard import object_path
+
+class CheckpointLooper(FileLooper):
+    '''
+    FileLooper that processes the run one file at a time and commits each
+    file's results to a checkpoint directory as soon as it is done: its events,
+    and its trigger and modules before finish() (see Module.merge). When the
+    loop is run again, files with a valid checkpoint are read back instead of
+    processed, so a crashed or preempted run resumes after the last finished
+    file, and a run directory that has grown since the last loop only costs the
+    new or changed files.
+
+    Each file is processed like a range of a ParallelLooper, with its own
+    trigger and modules built by the setup function, reading readout windows
+    across its boundaries as usual. Files are processed in order, so each
+    starts from the exact trigger state the file before ended in (see
+    Trigger.state), which the checkpoint records too. Its events therefore
+    depend on its neighbours and on the files before it, so a checkpoint is
+    only valid while the file, the files before and after it, the state it
+    started from, the reader and FileLooper arguments, and the trigger and
+    module types and settings (Trigger.config(), Module.config()) are
+    unchanged. Modules that don't report their settings need a new checkpoint
+    directory when those change.
+
+    The merged events, EventIDs and module results are the same as from a
+    single FileLooper over all the files.
+    '''
+    def __init__(self,file_names,tree_name,setup,directory,hash_files=False,
+        logging=True,**kwargs):
+        '''
+        Input:
+        -file_names: list of strings corresponding to path of each ROOT
+            file to load
+        -tree_name: string with name of tree in ROOT file
+        -setup: function taking a FileLooper and adding the trigger and modules
+            to it
+        -directory: string, directory to keep the checkpoints in
+        -hash_files: bool, if True a file's checkpoint also checks a hash of
+            its contents, not just its size and modification time
+        -logging: bool, set to True for periodic useful output
+        -kwargs: other FileLooper arguments (reader, chunk_size, block_size,
+            etc.), used for processing each file
+        '''
+        super(CheckpointLooper,self).__init__(file_names,tree_name,
+            logging=logging,**kwargs)
+        self.kwargs=kwargs
+        self.setup=setup
+        self.directory=directory
+        self.hash_files=hash_files
+        # counts of files read from checkpoints and processed, in the last loop
+        self.n_restored=0
+        self.n_processed=0
+        setup(self)
+
+    def file_entries(self):
+        '''
+        Returns:
+        -list of ints, number of TChain entries in each file
+        '''
+        counts=[]
+        for name in self.file_names:
+            if self.reader is not None:
+                counts+=[self.reader([name],self.tree_name,self.chunk_size).GetEntries()]
+            else:
+                chain=ROOT.TChain(self.tree_name)
+                chain.Add(name)
+                counts+=[chain.GetEntries()]
+        return counts
+
+    def signature(self,k,start,n_entries):
+        '''
+        Input:
+        -k: int, position of the file in file_names
+        -start: int, first TChain entry of the file
+        -n_entries: int, number of entries in the file
+
+        Returns:
+        -string, hash of everything the file's results depend on
+        '''
+        neighbours=[self.file_names[j] for j in [k-1,k,k+1]
+            if 0<=j<len(self.file_names)]
+        # arguments that only change how fast the files are read
+        looper_args=dict((name,value) for name,value in self.kwargs.items()
+            if name not in ['reader','chunk_size','prefetch','prefetch_memory',
+            'n_threads'])
+        description={'files':[file_signature(name,self.hash_files)
+            for name in neighbours],'position':k,'start':start,
+            'n_entries':n_entries,'tree_name':self.tree_name,
+            'reader':None if self.reader is None else object_path(self.reader),
+            'looper_args':looper_args,
+            'trigger':[type(self.trigger).__name__,self.trigger.config()],
+            'modules':[[name,type(self.modules[name]).__name__,
+            self.modules[name].config()] for name in self.module_names]}
+        return hashlib.sha1(json.dumps(description,sort_keys=True)).hexdigest()
+
+    def checkpoint_directory(self,name):
+        '''
+        Input:
+        -name: string, path of an input file
+
+        Returns:
+        -string, directory of the file's checkpoint
+        '''
+        key=hashlib.sha1(os.path.abspath(name)).hexdigest()[:16]
+        return os.path.join(self.directory,'%s_%s' % (os.path.basename(
+            os.path.normpath(name)),key))
+
+    def restore(self,checkpoint,signature,state):
+        '''
+        Read a file's results back from its checkpoint
+
+        Input:
+        -checkpoint: string, directory of the checkpoint
+        -signature: string, from signature()
+        -state: the trigger state the file has to start from, see
+        Trigger.state(). None for the first file
+
+        Returns:
+        -dict of arrays, columns of the file's events, without EventID, the
+        file's trigger and dict of its modules. None if there is no valid
+        checkpoint
+        '''
+        done_file=os.path.join(checkpoint,'done.json')
+        if not os.path.exists(done_file):
+            return None
+        with open(done_file) as f:
+            if json.load(f)['signature']!=signature:
+                return None
+        with numpy.load(os.path.join(checkpoint,'events.npz')) as f:
+            columns=dict((name,f[name]) for name in f.files)
+        with open(os.path.join(checkpoint,'state.pickle'),'rb') as f:
+            trigger,modules,start_state=cPickle.load(f)
+        if state is not None and start_state!=state:
+            return None
+        return columns,trigger,modules
+
+    def commit(self,checkpoint,signature,columns,trigger,modules,start_state):
+        '''
+        Write a file's results to its checkpoint. The done marker, with the
+        signature, is written last, so a checkpoint interrupted halfway is
+        never used
+
+        Input:
+        -checkpoint: string, directory of the checkpoint
+        -signature: string, from signature()
+        -columns: dict of arrays, columns of the file's events
+        -trigger: the file's trigger
+        -modules: dict of the file's modules
+        -start_state: the trigger state the file started from
+        '''
+        if not os.path.isdir(checkpoint):
+            os.makedirs(checkpoint)
+        done_file=os.path.join(checkpoint,'done.json')
+        if os.path.exists(done_file):
+            os.remove(done_file)
+        numpy.savez_compressed(os.path.join(checkpoint,'events.npz'),**columns)
+        with open(os.path.join(checkpoint,'state.pickle'),'wb') as f:
+            cPickle.dump((trigger,modules,start_state),f,cPickle.HIGHEST_PROTOCOL)
+        with open(done_file+'.tmp','w') as f:
+            json.dump({'signature':signature,'time':time.time()},f)
+        os.rename(done_file+'.tmp',done_file)
+
+    def loop(self):
+        '''
+        Loop over all files, reading each from its checkpoint if it has a valid
+        one, and processing and checkpointing it otherwise, and merge their
+        results in order
+        '''
+        start_time=time.time()
+        self.stages=self.plan_schedule()
+        self.events.declare(self.schema())
+        self.drops=self.plan_drops()
+        # files are processed with the fields the waveform store needs too
+        kwargs=dict(self.kwargs)
+        if self.keep_fields is not None and self.waveform_store is not None:
+            kwargs['keep_fields']=list(self.keep_fields)+self.waveform_store.fields
+        self.n_restored=0
+        self.n_processed=0
+        start=0
+        # state the file before ended in
+        state=None
+        for k,(name,n_entries) in enumerate(zip(self.file_names,
+            self.file_entries())):
+            checkpoint=self.checkpoint_directory(name)
+            signature=self.signature(k,start,n_entries)
+            result=self.restore(checkpoint,signature,state)
+            restored=result is not None
+            if restored:
+                self.n_restored+=1
+            else:
+                result=run_range((self.file_names,self.tree_name,kwargs,
+                    self.setup,start,n_entries,state))
+                self.commit(checkpoint,signature,*result)
+                result=result[:3]
+                self.n_processed+=1
+            columns,trigger,modules=result
+            state=trigger.state()
+            self.trigger.merge(trigger)
+            for module_name in self.modules:
+                self.modules[module_name].merge(modules[module_name])
+            if columns:
+                self.store(EventBlock(columns))
+                self.flush()
+            if self.logging:
+                print "File %i / %i %s" % (k+1,len(self.file_names),
+                    'from checkpoint' if restored else 'processed')
+            start+=n_entries
+        self.flush(final=True)
+        if self.waveform_store is not None:
+            self.waveform_store.close()
+        if self.logging:
+            print "Finished loop in %3.2f seconds: %i files processed, %i from "\
+                "checkpoints" % (time.time()-start_time,self.n_processed,
+                self.n_restored)
@@ -0,0 +1,286 @@
+import ast
+import time
+import operator
+import numpy
+from base import *
+
+# what cut expressions may use besides event fields
+FUNCTIONS={'abs':numpy.abs,'sqrt':numpy.sqrt,'exp':numpy.exp,'log':numpy.log,
+    'log10':numpy.log10,'isfinite':numpy.isfinite}
+CONSTANTS={'pi':numpy.pi,'True':True,'False':False}
+BINARY={ast.Add:operator.add,ast.Sub:operator.sub,ast.Mult:operator.mul,
+    ast.Div:operator.truediv,ast.Pow:operator.pow,ast.Mod:operator.mod}
+COMPARE={ast.Lt:operator.lt,ast.LtE:operator.le,ast.Gt:operator.gt,
+    ast.GtE:operator.ge,ast.Eq:operator.eq,ast.NotEq:operator.ne}
+
+class CutExpression(object):
+    '''
+    A cut on event fields, written as a python expression, e.g.
+    "1e-3 < HeaterWidth < 5e-3 and abs(PulseParams_Baseline) < 0.1". The
+    expression is parsed once, and only comparisons, and/or/not, arithmetic,
+    numbers, field names and a few numpy functions (see FUNCTIONS) are allowed,
+    so nothing else gets run. It evaluates the same on the values of one event
+    or on the columns of a block of events, where and/or/not and chained
+    comparisons work element by element.
+    '''
+    def __init__(self,name,expression):
+        '''
+        Input:
+        -name: string, name of the cut for pretty printing
+        -expression: string, the cut, True for events that pass
+        '''
+        self.name=name
+        self.expression=expression
+        self.tree=ast.parse(expression,mode='eval').body
+        self.fields=[]
+        self.check(self.tree)
+
+    def check(self,node):
+        '''
+        Make sure an expression only uses what evaluate() allows, and collect
+        the fields it reads
+        '''
+        if isinstance(node,ast.Name):
+            if node.id not in CONSTANTS and node.id not in self.fields:
+                self.fields+=[node.id]
+            return
+        if isinstance(node,ast.Num):
+            return
+        if isinstance(node,ast.Call):
+            if not isinstance(node.func,ast.Name) or node.func.id not in FUNCTIONS\
+                or node.keywords or node.starargs or node.kwargs:
+                raise ValueError("cut %s: only calls to %s are allowed" %
+                    (self.name,', '.join(sorted(FUNCTIONS))))
+            children=node.args
+        elif isinstance(node,ast.BoolOp):
+            children=node.values
+        elif isinstance(node,ast.UnaryOp) and\
+            isinstance(node.op,(ast.Not,ast.USub,ast.UAdd)):
+            children=[node.operand]
+        elif isinstance(node,ast.BinOp) and type(node.op) in BINARY:
+            children=[node.left,node.right]
+        elif isinstance(node,ast.Compare) and\
+            all(type(op) in COMPARE for op in node.ops):
+            children=[node.left]+node.comparators
+        else:
+            raise ValueError("cut %s: %s isn't allowed in cuts" %
+                (self.name,type(node).__name__))
+        for child in children:
+            self.check(child)
+
+    def evaluate(self,values,node=None):
+        '''
+        Input:
+        -values: event dict, or dict of columns of a block of events
+        -node: ast node to evaluate, None for the whole expression
+
+        Returns:
+        -bool, or bool array with one value per event
+        '''
+        if node is None:
+            node=self.tree
+        if isinstance(node,ast.Name):
+            if node.id in CONSTANTS:
+                return CONSTANTS[node.id]
+            return values[node.id]
+        if isinstance(node,ast.Num):
+            return node.n
+        if isinstance(node,ast.Call):
+            return FUNCTIONS[node.func.id](*[self.evaluate(values,arg)
+                for arg in node.args])
+        if isinstance(node,ast.BoolOp):
+            combine=numpy.logical_and if isinstance(node.op,ast.And) else\
+                numpy.logical_or
+            return reduce(combine,[self.evaluate(values,value)
+                for value in node.values])
+        if isinstance(node,ast.UnaryOp):
+            operand=self.evaluate(values,node.operand)
+            if isinstance(node.op,ast.Not):
+                return numpy.logical_not(operand)
+            return -operand if isinstance(node.op,ast.USub) else operand
+        if isinstance(node,ast.BinOp):
+            return BINARY[type(node.op)](self.evaluate(values,node.left),
+                self.evaluate(values,node.right))
+        # a chained comparison a < b < c is (a < b) and (b < c)
+        left=self.evaluate(values,node.left)
+        result=True
+        for op,comparator in zip(node.ops,node.comparators):
+            right=self.evaluate(values,comparator)
+            result=numpy.logical_and(result,COMPARE[type(op)](left,right))
+            left=right
+        return result
+
+    def __getstate__(self):
+        # parse trees don't pickle; the expression is parsed again on unpickling
+        state=self.__dict__.copy()
+        del state['tree']
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.tree=ast.parse(self.expression,mode='eval').body
+
+class Cut(Module):
+    '''
+    Module rejecting events that fail any of a list of cuts on their fields
+    (see CutExpression). It asks to run as early as the fields it reads allow
+    (see FileLooper.plan_schedule()), so events that fail don't go through
+    the modules it doesn't depend on.
+
+    Each cut is only evaluated on the events that passed the cuts before it.
+    The time spent and the fraction of events passing are measured for each
+    cut, and every reorder_every events the cuts are put in order of time per
+    rejected event, cost/(1-pass rate), so the cheap cuts that reject the most
+    run first and the others see fewer events.
+    '''
+    def __init__(self,name,cuts,reorder_every=1000):
+        '''
+        Input:
+        -name: string name of module for pretty printing
+        -cuts: list of strings, cut expressions that events have to pass, or
+        list of (name, expression) tuples to give the cuts names
+        -reorder_every: int, number of events between reorderings of the cuts.
+        0 to keep them in the order given
+        '''
+        self.cuts=[]
+        for cut in cuts:
+            if isinstance(cut,basestring):
+                cut=(cut,cut)
+            self.cuts+=[CutExpression(*cut)]
+        self.reorder_every=reorder_every
+        self.n_since_reorder=0
+        # statistics of each cut, keyed by name
+        self.n_tested=dict((cut.name,0) for cut in self.cuts)
+        self.n_passed=dict((cut.name,0) for cut in self.cuts)
+        self.cut_time=dict((cut.name,0.) for cut in self.cuts)
+        self.n_reorders=0
+        super(Cut,self).__init__(name)
+
+    def rank(self,cut):
+        '''
+        Input:
+        -cut: CutExpression
+
+        Returns:
+        -float, the time the cut takes per event it rejects. cuts not tested
+        yet come first, so they get measured
+        '''
+        n=self.n_tested[cut.name]
+        if n==0:
+            return 0.
+        rejected=1-self.n_passed[cut.name]/float(n)
+        if rejected==0:
+            return numpy.inf
+        return self.cut_time[cut.name]/n/rejected
+
+    def reorder(self,n_events):
+        '''
+        Count events towards the next reordering, and reorder the cuts when it
+        is due
+
+        Input:
+        -n_events: int, number of events just processed
+        '''
+        if self.reorder_every<=0:
+            return
+        self.n_since_reorder+=n_events
+        if self.n_since_reorder<self.reorder_every:
+            return
+        self.n_since_reorder=0
+        order=sorted(self.cuts,key=self.rank)
+        if order!=self.cuts:
+            self.cuts=order
+            self.n_reorders+=1
+
+    @Module._execute
+    def execute(self,event):
+        '''
+        Apply the cuts to one event
+
+        Inputs:
+        -event: dict containing event data
+
+        Returns:
+        -the event if it passes all cuts, False otherwise
+        '''
+        passed=True
+        for cut in self.cuts:
+            start_time=time.time()
+            passed=bool(cut.evaluate(event))
+            self.cut_time[cut.name]+=time.time()-start_time
+            self.n_tested[cut.name]+=1
+            if not passed:
+                break
+            self.n_passed[cut.name]+=1
+        self.reorder(1)
+        return event if passed else False
+
+    def execute_batch(self,block):
+        '''
+        Apply the cuts to a whole block of events, each cut only to the events
+        that are still left
+
+        Inputs:
+        -block: EventBlock
+
+        Returns:
+        -EventBlock, with events that fail set to not kept
+        '''
+        return self.cut_block(block)
+
+    @Module._execute_block
+    def cut_block(self,block):
+        '''
+        Set keep to False for the events of the block that fail a cut
+        '''
+        rows=numpy.flatnonzero(block.keep)
+        n_events=len(rows)
+        for cut in self.cuts:
+            if len(rows)==0:
+                break
+            start_time=time.time()
+            if len(rows)==len(block):
+                values=block.columns
+            else:
+                values=dict((field,block[field][rows]) for field in cut.fields)
+            passed=numpy.asarray(cut.evaluate(values),dtype=bool)
+            if passed.ndim==0:
+                passed=numpy.repeat(passed,len(rows))
+            self.cut_time[cut.name]+=time.time()-start_time
+            self.n_tested[cut.name]+=len(rows)
+            self.n_passed[cut.name]+=int(passed.sum())
+            block.keep[rows[~passed]]=False
+            rows=rows[passed]
+        self.reorder(n_events)
+        return block
+
+    def merge(self,other):
+        super(Cut,self).merge(other)
+        for cut in self.cuts:
+            self.n_tested[cut.name]+=other.n_tested[cut.name]
+            self.n_passed[cut.name]+=other.n_passed[cut.name]
+            self.cut_time[cut.name]+=other.cut_time[cut.name]
+        self.n_reorders+=other.n_reorders
+
+    def reads(self):
+        fields=[]
+        for cut in self.cuts:
+            fields+=[field for field in cut.fields if field not in fields]
+        return fields
+
+    def runs_early(self):
+        return True
+
+    def config(self):
+        # the order of the cuts doesn't change which events pass
+        return {'cuts':sorted([cut.name,cut.expression] for cut in self.cuts)}
+
+    @Module._finish
+    def finish(self):
+        print "%s: cuts in their final order, reordered %i times" %\
+            (self.name,self.n_reorders)
+        for cut in self.cuts:
+            n=self.n_tested[cut.name]
+            rate=self.n_passed[cut.name]/float(n) if n else 0.
+            print "  %s: %i / %i events passed (%.1f%%), %3.2f seconds" %\
+                (cut.name,self.n_passed[cut.name],n,100*rate,self.cut_time[cut.name])
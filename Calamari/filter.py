@@ -1,61 +1,103 @@
 import numpy
 import pylab
-from scipy.signal import butter, lfilter, freqz
+from scipy.signal import butter, sosfilt, sosfilt_zi, sosfiltfilt
 from base import *
 
 class Filter(Module):
     '''
-    Apply basic Butterworth filter to waveform
+    Apply Butterworth filter to waveform. The filter is designed once, in
+    second-order sections, and can be low-pass, high-pass or band-pass, and
+    zero-phase (run forwards and backwards).
+
+    In stream mode, the filter is instead run over the continuous stream of
+    TChain entries by the trigger, carrying the filter state from one entry to
+    the next, and readout windows are cut from the filtered stream. This keeps
+    the start-up transient of the filter out of the readout windows. It needs a
+    trigger that visits every entry of the stream, so not a HeaterTrigger with
+    prescan, or one read back from a trigger index.
     '''
     def __init__(self,name,cutoff,order,dt_sample,input_name, output_name,
-        plot=False):
+        plot=False,btype='low',zero_phase=False,stream=False):
         '''
         Inputs:
         -name: string name of module
-        -cutoff: float, frequency cutoff of filter in Hz
+        -cutoff: float, frequency cutoff of filter in Hz. for a band-pass filter,
+        a (low, high) pair of cutoffs
         -order: int, order of butterworth filter
         -dt_sample: float, time interval for one sample
         -input_name: string, name of waveform in event dict
         -output_name: string, name for outputed filtered waveform in event dict
         -plot:, bool, if True show a plot of the unfiltered and filtered waveforms
+        -btype: string, 'low', 'high' or 'band'
+        -zero_phase: bool, if True filter forwards and backwards, so the filtered
+        pulse isn't delayed. can't be used in stream mode
+        -stream: bool, if True the trigger filters the whole stream of entries
+        that input_name is read out from
         '''
+        if zero_phase and stream:
+            raise ValueError("a zero-phase filter can't run on a stream")
         self.cutoff=cutoff
         self.order=order
         self.dt_sample=dt_sample
         self.input_name=input_name
         self.output_name=output_name
         self.plot=plot
+        self.btype=btype
+        self.zero_phase=zero_phase
+        self.stream=stream
+        self.sos=self.design_filter()
         super(Filter,self).__init__(name)
 
-    def butter_lowpass(self,fs):
+    def design_filter(self):
         '''
         Create butterworth filter
 
+        Returns:
+        -array of second-order sections for filter
+        '''
+        nyq = 0.5 / self.dt_sample
+        cutoff = numpy.asarray(self.cutoff,dtype=float) / nyq
+        return butter(self.order, cutoff, btype=self.btype, output='sos')
+
+    def apply_filter(self,data,zi=None):
+        '''
+        Apply butterworth filter to data
+
         Inputs:
-        -fs, float, sampling rate (Hz)
+        -data: array of unfiltered waveforms. for a 2D array, each row is
+        filtered separately
+        -zi: array, initial filter state, from initial_state() or from the end of
+        the previous piece of the stream. None to start from rest
 
         Returns:
-        -b, a coefficients for filter
+        -array of filtered waveforms
+        -array, final filter state (only if zi was given)
         '''
-        nyq = 0.5 * fs
-        high = self.cutoff / nyq
-        b, a = butter(self.order, high, btype='low')
-        return b, a
+        if self.zero_phase:
+            return sosfiltfilt(self.sos, data, axis=-1)
+        if zi is None:
+            return sosfilt(self.sos, data, axis=-1)
+        return sosfilt(self.sos, data, zi=zi)
 
-    def butter_lowpass_filter(self,data,fs):
+    def initial_state(self,x0):
         '''
-        Apply butterworth filter to data
+        Filter state for the start of a stream, as if the stream had been sitting
+        at its first value forever, so there is no step at the start
 
         Inputs:
-        -data: array, unfiltered waveform
-        -fs: float, sampling rate (Hz)
+        -x0: float, first sample of the stream
 
         Returns:
-        -array of filtered waveform
+        -array, filter state to pass to apply_filter()
+        '''
+        return sosfilt_zi(self.sos)*x0
+
+    def attach(self,trigger):
+        '''
+        In stream mode, have the trigger filter the stream for this module
         '''
-        b, a = self.butter_lowpass(fs,)
-        y = lfilter(b, a, data)
-        return y
+        if self.stream:
+            trigger.add_stream_filter(self)
 
     def plot_filtered(self,wf,filtered):
         '''
@@ -84,14 +126,55 @@ class Filter(Module):
         Returns:
         -dict containing existing event data, plus filtered waveform
         '''
+        # in stream mode the trigger already read out the filtered waveform
+        if self.stream:
+            return event
         wf=event[self.input_name]
-        t=1000*numpy.linspace(0,len(wf)*self.dt_sample-self.dt_sample,len(wf))
-        filtered=self.butter_lowpass_filter(wf,1/self.dt_sample)
+        filtered=self.apply_filter(wf)
         if self.plot:
             self.plot_filtered(wf,filtered)
         event[self.output_name]=filtered
         return event
 
+    def execute_batch(self,block):
+        '''
+        Apply the filter to the waveforms of a whole block of events at once
+
+        Inputs:
+        -block: EventBlock
+
+        Returns:
+        -EventBlock, with filtered waveforms added
+        '''
+        if self.plot:
+            return super(Filter,self).execute_batch(block)
+        return self.filter_block(block)
+
+    @Module._execute_block
+    def filter_block(self,block):
+        '''
+        Filter the waveform column of a block, unless the trigger already did
+        '''
+        if not self.stream:
+            block[self.output_name]=self.apply_filter(block[self.input_name])
+        return block
+
+    def reads(self):
+        # in stream mode the trigger did the filtering
+        return [] if self.stream else [self.input_name]
+
+    def rejects_events(self):
+        return False
+
+    def schema(self):
+        return {self.output_name:float}
+
+    def config(self):
+        return {'cutoff':numpy.asarray(self.cutoff,dtype=float).tolist(),
+            'order':self.order,'dt_sample':self.dt_sample,
+            'input_name':self.input_name,'output_name':self.output_name,
+            'btype':self.btype,'zero_phase':self.zero_phase,'stream':self.stream}
+
     @Module._finish
     def finish(self):
         pass
@@ -154,11 +237,99 @@ class PulseParams(Module):
         # write output
         event[self.name+'_LeadingEdgeTime']=leading_edge
         event[self.name+'_Baseline']=baseline
+        event[self.name+'_BaselineRMS']=std
         event[self.name+'_PulseHeight']=height
         event[self.name+'_DecayTime']=decay_time
         return event
 
+    def execute_batch(self,block):
+        '''
+        Calculate the pulse parameters of a whole block of events at once
+
+        Inputs:
+        -block: EventBlock
+
+        Returns:
+        -EventBlock, with the parameters added and flat pulses rejected
+        '''
+        return self.measure_block(block)
+
+    @Module._execute_block
+    def measure_block(self,block):
+        '''
+        Add the pulse parameters of every event in the block, and reject the
+        flat pulses
+        '''
+        params,good=self.calculate_pulse_params(block[self.waveform_name],
+            block['dt_sample'],block['Time'])
+        for name in params:
+            block[self.name+'_'+name]=params[name]
+        block.keep&=good
+        return block
+
+    def calculate_pulse_params(self,waveforms,dt_sample,event_time):
+        '''
+        Calculate pulse height, baseline, decay time and leading edge time for a
+        2D block of bolometer waveforms, with array operations. Each waveform's
+        baseline comes from its own pre-pulse samples, selected with a mask, and
+        is summed in the same order as in execute() (see masked_mean()), so the
+        results are bit for bit the same as one event at a time.
+
+        Input:
+        -waveforms: 2D array, bolometer waveforms, one per row
+        -dt_sample: array, time interval of one sample for each waveform
+        -event_time: array, time of the start of each waveform
+
+        Returns:
+        -dict of arrays, LeadingEdgeTime, Baseline, BaselineRMS, PulseHeight and
+        DecayTime of each waveform
+        -bool array, False for waveforms with no pulse to measure (flat lines, or
+        a maximum in the first sample)
+        '''
+        rows=numpy.arange(len(waveforms))
+        samples=numpy.arange(waveforms.shape[1])
+
+        # calculate height
+        ind=waveforms.argmax(axis=1)
+        # use 3/4 of data before pulse maximum to estimate baseline and baselineRMS
+        pre_pulse=samples<(0.75*ind).astype(int)[:,numpy.newaxis]
+        baseline=masked_mean(waveforms,pre_pulse)
+        std=numpy.sqrt(masked_mean((waveforms-baseline[:,numpy.newaxis])**2,
+            pre_pulse))
+        height=waveforms[rows,ind]-baseline
+
+        # calculate decay time, from the last sample above baseline+height/e.
+        # flat pulses (and pulses without a baseline) have no such sample
+        with numpy.errstate(invalid='ignore'):
+            above=waveforms>(baseline+height*(1/numpy.e))[:,numpy.newaxis]
+        good=above.any(axis=1)
+        last=len(samples)-1-above[:,::-1].argmax(axis=1)
+        decay_time=(last-ind)*dt_sample
+
+        # leading edge defined as time when pulse goes 5 sigma above baseline
+        with numpy.errstate(invalid='ignore'):
+            above=waveforms>(baseline+5*std)[:,numpy.newaxis]
+        # if no samples 5 sigma above baseline, set equal to -1
+        # ...probably need to treat this better
+        leading_edge=numpy.where(above.any(axis=1),
+            above.argmax(axis=1)*dt_sample+event_time,-1)
+
+        return {'LeadingEdgeTime':leading_edge,
+            'Baseline':baseline,
+            'BaselineRMS':std,
+            'PulseHeight':height,
+            'DecayTime':decay_time}, good
+
+    def reads(self):
+        return [self.waveform_name,'dt_sample','Time']
+
+    def schema(self):
+        return dict((self.name+'_'+name,float) for name in
+            ['LeadingEdgeTime','Baseline','BaselineRMS','PulseHeight','DecayTime'])
+
+    def config(self):
+        return {'waveform_name':self.waveform_name}
+
     @Module._finish
     def finish(self):
         pass
-
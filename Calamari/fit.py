@@ -0,0 +1,277 @@
+import cPickle
+import numpy
+from base import *
+
+class TemplateFit(Module):
+    '''
+    Module to fit each bolometer pulse with an average pulse template. The
+    amplitude of the fit is a much less noisy estimate of the pulse height than
+    the maximum minus the baseline, which is biased upward by the noise.
+
+    The fit is linear: each waveform is modeled as
+        amplitude*template + baseline - amplitude*shift*template'
+    where template' is the derivative of the template, so the last term is the
+    first order correction for a pulse shifted by a (small) number of samples.
+    The pseudo-inverse of the model matrix is computed once, so fitting a whole
+    block of waveforms is a single matrix multiply.
+
+    Without a template, the module instead builds one: it averages the waveforms
+    of the selected events (aligned as the trigger read them out), and at
+    finish() normalizes the average to a pulse of height 1. Save it with
+    save_template(), and give the file to the module on the next run.
+    '''
+    def __init__(self,name,waveform_name,template=None,fit_shift=True,
+        selection=None,n_template_events=0):
+        '''
+        Input:
+        -name: string name of module for pretty printing
+        -waveform_name: string name in event dict corresponding to bolometer waveform
+        -template: array, pulse template with the same length as the waveforms,
+        or string name of a file written by save_template(). if None, build a
+        template instead of fitting
+        -fit_shift: bool, if True also fit a time shift of the pulse
+        -selection: function taking an event dict and returning True for events
+        to build the template from. if None, use all events
+        -n_template_events: int, maximum number of events to build the template
+        from. if 0, use all selected events. the first ones are used, also when
+        the results of several loops are merged (see merge())
+        '''
+        self.waveform_name=waveform_name
+        self.fit_shift=fit_shift
+        self.selection=selection
+        self.n_template_events=n_template_events
+        # sum of the waveforms the template is built from, and with
+        # n_template_events, the waveforms themselves, so merge() can keep the
+        # first ones
+        self.template_sum=None
+        self.n_summed=0
+        self.template_waveforms=[]
+        self.template=None
+        self.pinv=None
+        if template is not None:
+            if isinstance(template,basestring):
+                template=self.load_template(template)
+            self.set_template(template)
+        super(TemplateFit,self).__init__(name)
+
+    def set_template(self,template):
+        '''
+        Use a new template, and precompute the pseudo-inverse of the model
+        matrix for fitting with it
+
+        Input:
+        -template: array, pulse template
+        '''
+        self.template=numpy.asarray(template,dtype=float)
+        columns=[self.template,numpy.ones(len(self.template))]
+        if self.fit_shift:
+            columns+=[numpy.gradient(self.template)]
+        # model matrix, one column per fit parameter
+        self.model=numpy.column_stack(columns)
+        self.pinv=numpy.linalg.pinv(self.model)
+
+    def save_template(self,file_name):
+        '''
+        Save the template to a numpy .npz file
+
+        Input:
+        -file_name: string, name of output file
+        '''
+        if self.template is None:
+            raise ValueError("%s has no template to save" % self.name)
+        numpy.savez(file_name,template=self.template)
+
+    @staticmethod
+    def load_template(file_name):
+        '''
+        Load a template written by save_template()
+
+        Input:
+        -file_name: string, name of file
+
+        Returns:
+        -array, pulse template
+        '''
+        with numpy.load(file_name) as f:
+            return f['template']
+
+    def make_template(self):
+        '''
+        Normalize the average of the summed waveforms into a template: the
+        baseline (from 3/4 of the samples before the maximum, as in PulseParams)
+        is subtracted, and the pulse scaled to a height of 1
+
+        Returns:
+        -array, pulse template
+        '''
+        if self.n_summed==0:
+            raise ValueError("%s selected no events to build a template from" %
+                self.name)
+        average=self.template_sum/self.n_summed
+        ind=numpy.argmax(average)
+        if int(0.75*ind)==0:
+            raise ValueError("%s: average pulse has no baseline before its "
+                "maximum" % self.name)
+        average=average-numpy.mean(average[0:int(0.75*ind)])
+        return average/average[ind]
+
+    def add_to_template(self,waveforms):
+        '''
+        Add waveforms to the sum the template is built from
+
+        Input:
+        -waveforms: 2D array, waveforms of selected events, one per row
+        '''
+        if self.n_template_events:
+            waveforms=waveforms[:self.n_template_events-self.n_summed]
+        if len(waveforms)==0:
+            return
+        if self.template_sum is None:
+            self.template_sum=numpy.zeros(waveforms.shape[1])
+        self.template_sum+=waveforms.sum(axis=0)
+        self.n_summed+=len(waveforms)
+        if self.n_template_events:
+            self.template_waveforms+=[numpy.array(waveforms)]
+
+    def fit(self,waveforms,dt_sample):
+        '''
+        Fit a 2D block of waveforms with the template
+
+        Input:
+        -waveforms: 2D array, bolometer waveforms, one per row
+        -dt_sample: array, time interval of one sample for each waveform
+
+        Returns:
+        -dict of arrays, Amplitude, Baseline, Shift (in seconds, positive for a
+        pulse later than the template, 0 if not fit) and Chi2 (sum of squared
+        residuals divided by the degrees of freedom) of each waveform
+        '''
+        if waveforms.shape[1]!=len(self.template):
+            raise ValueError("%s: waveforms have %i samples, template has %i" %
+                (self.name,waveforms.shape[1],len(self.template)))
+        params=numpy.dot(waveforms,self.pinv.T)
+        residuals=waveforms-numpy.dot(params,self.model.T)
+        n_dof=len(self.template)-self.model.shape[1]
+        amplitude=params[:,0]
+        if self.fit_shift:
+            with numpy.errstate(divide='ignore',invalid='ignore'):
+                shift=-params[:,2]/amplitude*dt_sample
+        else:
+            shift=numpy.zeros(len(waveforms))
+        return {'Amplitude':amplitude,
+            'Baseline':params[:,1],
+            'Shift':shift,
+            'Chi2':(residuals*residuals).sum(axis=1)/n_dof}
+
+    @Module._execute
+    def execute(self,event):
+        '''
+        Do this on each event. Fits the bolometer pulse with the template, or adds
+        it to the template being built
+
+        Inputs:
+        -event: dict of event data
+
+        Returns:
+        -dict containing existing event data, plus the fit parameters
+        '''
+        waveform=event[self.waveform_name][numpy.newaxis]
+        if self.template is None:
+            if self.selection is None or self.selection(event):
+                self.add_to_template(waveform)
+            return event
+        # the same calculation as for a block (up to the rounding of the matrix
+        # multiply, which can depend on the number of rows)
+        params=self.fit(waveform,numpy.array([event['dt_sample']]))
+        for name in params:
+            event[self.name+'_'+name]=params[name][0]
+        return event
+
+    def execute_batch(self,block):
+        '''
+        Fit a whole block of events at once
+
+        Inputs:
+        -block: EventBlock
+
+        Returns:
+        -EventBlock, with the fit parameters added
+        '''
+        return self.fit_block(block)
+
+    @Module._execute_block
+    def fit_block(self,block):
+        '''
+        Add the fit parameters of every event in the block, or add the selected
+        events to the template being built
+        '''
+        if self.template is None:
+            rows=numpy.flatnonzero(block.keep)
+            if self.selection is not None:
+                rows=[k for k in rows if self.selection(block.event(k))]
+            self.add_to_template(block[self.waveform_name][rows])
+            return block
+        params=self.fit(block[self.waveform_name],block['dt_sample'])
+        for name in params:
+            block[self.name+'_'+name]=params[name]
+        return block
+
+    def merge(self,other):
+        super(TemplateFit,self).merge(other)
+        if other.template_sum is None:
+            return
+        if self.n_template_events:
+            # other's events come after this one's, so only its first ones are
+            # added, up to n_template_events in all, as in a single loop
+            for waveforms in other.template_waveforms:
+                self.add_to_template(waveforms)
+            return
+        if self.template_sum is None:
+            self.template_sum=numpy.zeros_like(other.template_sum)
+        self.template_sum+=other.template_sum
+        self.n_summed+=other.n_summed
+
+    def __getstate__(self):
+        # workers and checkpoints pickle the module. a selection function that
+        # doesn't pickle (e.g. a lambda) would otherwise only fail deep inside
+        # them, or be lost
+        if self.selection is not None:
+            try:
+                cPickle.dumps(self.selection,cPickle.HIGHEST_PROTOCOL)
+            except (cPickle.PicklingError,TypeError,AttributeError):
+                raise cPickle.PicklingError("%s: the selection function %r "
+                    "can't be pickled; define it at the top level of a module"
+                    % (self.name,self.selection))
+        return self.__dict__
+
+    def reads(self):
+        if self.template is None and self.selection is not None:
+            # the selection may look at any field
+            return None
+        return [self.waveform_name,'dt_sample']
+
+    def rejects_events(self):
+        return False
+
+    def schema(self):
+        if self.template is None:
+            return {}
+        return dict((self.name+'_'+name,float) for name in
+            ['Amplitude','Baseline','Shift','Chi2'])
+
+    def config(self):
+        # only the name of a selection function; a changed function body
+        # doesn't show
+        selection=self.selection
+        if selection is not None:
+            selection='%s.%s' % (getattr(selection,'__module__',None),
+                getattr(selection,'__name__',type(selection).__name__))
+        return {'waveform_name':self.waveform_name,'fit_shift':self.fit_shift,
+            'template':None if self.template is None else self.template.tolist(),
+            'selection':selection,'n_template_events':self.n_template_events}
+
+    @Module._finish
+    def finish(self):
+        if self.template is None and self.n_summed:
+            self.set_template(self.make_template())
+            print "%s: built template from %i events" % (self.name,self.n_summed)
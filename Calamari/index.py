@@ -0,0 +1,268 @@
+import os
+import json
+import hashlib
+import numpy
+from base import *
+from buffer import *
+
+def file_signature(path,content=False):
+    '''
+    Input:
+    -path: string, name of a file, or of a directory (e.g. a memmap store)
+    -content: bool, if True add a hash of the file contents, which catches
+    changes that keep the size and modification time, at the cost of reading
+    the whole file
+
+    Returns:
+    -list of the absolute path, size and modification time (and content hash)
+    of the file, or of every file in the directory
+    '''
+    if os.path.isdir(path):
+        return [file_signature(os.path.join(path,name),content)
+            for name in sorted(os.listdir(path))]
+    stat=os.stat(path)
+    signature=[os.path.abspath(path),stat.st_size,stat.st_mtime]
+    if content:
+        digest=hashlib.sha1()
+        with open(path,'rb') as f:
+            for block in iter(lambda: f.read(1<<20),''):
+                digest.update(block)
+        signature+=[digest.hexdigest()]
+    return signature
+
+class TriggerIndex(object):
+    '''
+    On-disk record of where the trigger found every event of a run: the TChain
+    entry, and the first sample and length of the readout window, plus the
+    trigger's scalar fields (e.g. the heater pulse parameters). The index file is
+    named after a hash of the input files (names, sizes and modification times)
+    and of the trigger's type and settings (Trigger.config()), so an index is
+    only ever used with the same data and the same trigger.
+
+    FileLooper.add_trigger_index() records an index during a loop over the whole
+    run, and later loops read the events straight from the indexed windows with
+    an IndexedTrigger instead of scanning every entry. Events in the index are
+    numbered in the order the trigger found them, and each event keeps its
+    number in the TriggerEventID field, for reading it back with event() or
+    waveform() after modules have rejected events.
+    '''
+    location_fields=['Entry','WindowStart','WindowLength']
+
+    def __init__(self,directory,file_names,tree_name,trigger):
+        '''
+        Input:
+        -directory: string, directory the index files are kept in
+        -file_names: list of strings, the input files, in chain order
+        -tree_name: string with name of tree in ROOT file
+        -trigger: Trigger instance the index is for
+        '''
+        config=trigger.config()
+        if config is None:
+            raise ValueError("%s can't be indexed" % type(trigger).__name__)
+        description=json.dumps({'files':[file_signature(name) for name in file_names],
+            'tree_name':tree_name,'trigger':type(trigger).__name__,
+            'config':config,'fields':sorted(trigger.schema())},sort_keys=True)
+        self.key=hashlib.sha1(description).hexdigest()
+        self.file_name=os.path.join(directory,'trigger_%s.npz' % self.key)
+        self.trigger_name=type(trigger).__name__
+        self.windows=trigger.window_entries()
+        # scalar fields of the trigger's events
+        self.scalar_names=sorted(name for name in trigger.schema()
+            if name not in self.windows)
+        self.pending=dict((name,[]) for name in
+            self.location_fields+self.scalar_names)
+        self.n_events=0
+        self.columns=None
+
+    def exists(self):
+        return os.path.exists(self.file_name)
+
+    def add(self,events):
+        '''
+        Move the location fields of events from the trigger to the index, copy
+        their scalar fields, and number them with TriggerEventID
+
+        Input:
+        -events: list of event dicts, or an EventBlock, as handed to
+        FileLooper.process(). a single event dict, or False, is accepted as well
+        '''
+        if isinstance(events,dict):
+            events=[events]
+        if isinstance(events,EventBlock):
+            for name in self.pending:
+                self.pending[name]+=[numpy.asarray(events[name])]
+            events.drop(self.location_fields)
+            events['TriggerEventID']=numpy.arange(self.n_events,
+                self.n_events+len(events))
+            self.n_events+=len(events)
+            return
+        for event in events or []:
+            for name in self.pending:
+                self.pending[name]+=[numpy.atleast_1d(event[name])]
+            for name in self.location_fields:
+                del event[name]
+            event['TriggerEventID']=self.n_events
+            self.n_events+=1
+
+    def save(self):
+        '''
+        Write the index file. It is written under a temporary name first, so a
+        half written index is never picked up
+        '''
+        directory=os.path.dirname(self.file_name)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        columns=dict((name,numpy.concatenate(self.pending[name])
+            if self.pending[name] else numpy.zeros(0)) for name in self.pending)
+        columns['Entry']=columns['Entry'].astype(numpy.int64)
+        columns['WindowStart']=columns['WindowStart'].astype(numpy.int64)
+        columns['WindowLength']=columns['WindowLength'].astype(numpy.int64)
+        temp_name=self.file_name[:-len('.npz')]+'.tmp.npz'
+        numpy.savez(temp_name,windows=json.dumps(self.windows),
+            trigger=self.trigger_name,**columns)
+        os.rename(temp_name,self.file_name)
+        self.columns=columns
+
+    def load(self):
+        '''
+        Read the index file
+
+        Returns:
+        -self
+        '''
+        with numpy.load(self.file_name) as f:
+            self.windows=dict((str(name),tuple(window)) for name,window in
+                json.loads(str(f['windows'])).items())
+            self.columns=dict((name,f[name]) for name in f.files
+                if name not in ['windows','trigger'])
+        self.scalar_names=sorted(name for name in self.columns
+            if name not in self.location_fields)
+        return self
+
+    def __len__(self):
+        return len(self.columns['Entry'])
+
+    def event(self,chain,event_id,buffers=None):
+        '''
+        Read one indexed event back from the raw data
+
+        Input:
+        -chain: ROOT TChain (or reader) over the same files the index was made
+        from, e.g. the chain of a FileLooper after open_file()
+        -event_id: int, position of the event in the index
+        -buffers: dict of StitchedBuffers to read the waveforms with, keyed by
+        field name. None to make new ones
+
+        Returns:
+        -dict, the event as the trigger gave it: its scalar fields, and a view
+        of each waveform field (valid until the buffers load another entry),
+        plus its TriggerEventID
+        '''
+        if buffers is None:
+            buffers=dict((name,StitchedBuffer(step)) for name,(offset,step)
+                in self.windows.items())
+        entry=int(self.columns['Entry'][event_id])
+        start=int(self.columns['WindowStart'][event_id])
+        end=start+int(self.columns['WindowLength'][event_id])
+        event=dict((name,self.columns[name][event_id])
+            for name in self.scalar_names)
+        event['TriggerEventID']=event_id
+        for name,(offset,step) in self.windows.items():
+            buffer=buffers[name]
+            buffer.load(chain,entry+offset)
+            event[name]=buffer.window(start,end)
+            event.update(buffer.filtered_windows(start,end))
+        return event
+
+    def waveform(self,chain,event_id,name='Waveform'):
+        '''
+        Random access to the raw waveform of any indexed event
+
+        Input:
+        -chain: ROOT TChain (or reader) over the same files the index was made
+        from
+        -event_id: int, position of the event in the index
+        -name: string, name of the waveform field
+
+        Returns:
+        -array, copy of the readout window
+        '''
+        return self.event(chain,event_id)[name].copy()
+
+class IndexedTrigger(Trigger):
+    '''
+    Trigger for re-analysing a run with a TriggerIndex: instead of scanning
+    every entry, it visits only the entries the indexed events were found in,
+    and reads their readout windows and scalar fields back, so the events are
+    the same as from the original trigger. Stream filters can't be attached to
+    it, since they would start over at every gap between the visited entries,
+    and nothing is fed to noise accumulators
+    '''
+    def __init__(self,index,trigger):
+        '''
+        Input:
+        -index: loaded TriggerIndex
+        -trigger: the Trigger instance the index was made with
+        '''
+        self.index=index
+        self.source=trigger
+        self.cache=EntryCache(8)
+        self.buffers=dict((name,StitchedBuffer(step,self.cache))
+            for name,(offset,step) in index.windows.items())
+        # events in order of the entry they were found in
+        self.entries=index.columns['Entry']
+        self.order=numpy.argsort(self.entries,kind='mergesort')
+        self.sorted_entries=self.entries[self.order]
+        super(IndexedTrigger,self).__init__(trigger.name)
+
+    def select_entries(self,chain,n_entries,start=0):
+        '''
+        Visit only the entries with indexed events
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -n_entries: int, entry to stop before
+        -start: int, first entry to consider
+
+        Returns:
+        -list of ints, the TChain positions to visit
+        '''
+        entries=numpy.unique(self.sorted_entries)
+        return entries[(entries>=start)&(entries<n_entries)].tolist()
+
+    def skips_entries(self):
+        return True
+
+    @Module._execute
+    def execute(self,chain,i):
+        '''
+        Read back the indexed events of one entry
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -i: int, current position in TChain
+
+        Returns:
+        -list of event dicts, one for each indexed event of this entry
+        '''
+        first=numpy.searchsorted(self.sorted_entries,i)
+        last=numpy.searchsorted(self.sorted_entries,i,side='right')
+        return [self.index.event(chain,event_id,self.buffers)
+            for event_id in self.order[first:last]]
+
+    def stream_buffers(self):
+        return self.buffers
+
+    def window_entries(self):
+        return self.index.windows
+
+    def config(self):
+        return self.source.config()
+
+    def schema(self):
+        return self.source.schema()
+
+    @Module._finish
+    def finish(self):
+        print "%s: read %i indexed events from %s" %\
+            (self.name,len(self.index),self.index.file_name)
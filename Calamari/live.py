@@ -0,0 +1,651 @@
+import os
+import sys
+import json
+import stat
+import time
+import Queue
+import socket
+import struct
+import threading
+import collections
+import numpy
+from base import *
+from profiler import Stage,wall_clock
+
+# header of one waveform record on the wire: Ch, t_s, t_mus, dt_s and the
+# number of samples, followed by the samples as little-endian float64
+RECORD_HEADER=struct.Struct('<iqqdI')
+
+def pack_record(Ch,t_s,t_mus,dt_s,Waveform):
+    '''
+    Input:
+    -Ch, t_s, t_mus, dt_s: the scalar branches of one entry
+    -Waveform: array, the waveform of the entry
+
+    Returns:
+    -string, the entry as a record for a LiveLooper
+    '''
+    waveform=numpy.ascontiguousarray(Waveform,dtype='<f8')
+    return RECORD_HEADER.pack(int(Ch),int(t_s),int(t_mus),float(dt_s),
+        len(waveform))+waveform.tostring()
+
+def read_record(stream):
+    '''
+    Input:
+    -stream: file-like object records are read from
+
+    Returns:
+    -dict with the Ch, t_s, t_mus, dt_s and Waveform of the next record, or
+    None at the end of the stream
+    '''
+    header=stream.read(RECORD_HEADER.size)
+    if len(header)<RECORD_HEADER.size:
+        return None
+    Ch,t_s,t_mus,dt_s,n_samples=RECORD_HEADER.unpack(header)
+    data=stream.read(8*n_samples)
+    if len(data)<8*n_samples:
+        return None
+    return {'Ch':Ch,'t_s':t_s,'t_mus':t_mus,'dt_s':dt_s,
+        'Waveform':numpy.frombuffer(data,dtype='<f8')}
+
+def parse_address(address):
+    '''
+    Input:
+    -address: string, '-' for stdin/stdout, 'host:port' for TCP, or the path
+    of a UNIX socket, named pipe or file
+
+    Returns:
+    -(family, address) for a socket, or None for a path or '-'
+    '''
+    if address=='-' or os.sep in address:
+        return None
+    if ':' in address:
+        host,port=address.rsplit(':',1)
+        if port.isdigit():
+            return socket.AF_INET,(host or 'localhost',int(port))
+    return None
+
+def connect_stream(address,mode='rb'):
+    '''
+    Open the consuming end of a stream of records or published events
+
+    Input:
+    -address: string, see parse_address(). a UNIX socket or TCP address is
+    connected to, anything else is opened as a file (e.g. a named pipe)
+    -mode: string, 'rb' to read, 'wb' to write
+
+    Returns:
+    -file-like object
+    '''
+    if address=='-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    parsed=parse_address(address)
+    if parsed is None and os.path.exists(address) and\
+        stat.S_ISSOCK(os.stat(address).st_mode):
+        parsed=socket.AF_UNIX,address
+    if parsed is None:
+        return open(address,mode)
+    sock=socket.socket(parsed[0],socket.SOCK_STREAM)
+    sock.connect(parsed[1])
+    return sock.makefile(mode)
+
+def serve_stream(address,mode='wb'):
+    '''
+    Open the producing end of a stream: listen on a UNIX socket or TCP
+    address and wait for one client to connect
+
+    Input:
+    -address: string, see parse_address(). a path that doesn't exist yet is
+    made a UNIX socket; an existing path (e.g. a named pipe) is opened as a file
+    -mode: string, 'wb' to write, 'rb' to read
+
+    Returns:
+    -file-like object
+    '''
+    if address=='-':
+        return sys.stdout if 'w' in mode else sys.stdin
+    parsed=parse_address(address)
+    if parsed is None:
+        if os.path.exists(address) and not stat.S_ISSOCK(os.stat(address).st_mode):
+            return open(address,mode)
+        if os.path.exists(address):
+            os.remove(address)
+        parsed=socket.AF_UNIX,address
+    server=socket.socket(parsed[0],socket.SOCK_STREAM)
+    if parsed[0]==socket.AF_INET:
+        server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    server.bind(parsed[1])
+    server.listen(1)
+    connection,client=server.accept()
+    server.close()
+    return connection.makefile(mode)
+
+def replay(file_names,tree_name,address,reader=None,speed=1.,chunk_size=1000,
+    logging=True):
+    '''
+    Stream entries from files as records to a LiveLooper, the way the DAQ
+    would: each entry is sent once the time it ends (from t_s, t_mus and its
+    length) has passed since the first entry, divided by speed
+
+    Input:
+    -file_names: list of strings corresponding to path of each ROOT
+        file to load
+    -tree_name: string with name of tree in ROOT file
+    -address: string, where to serve the records (see serve_stream())
+    -reader: Reader class to read the files with, None for a PyROOT TChain
+    -speed: float, how many times faster than real time to replay. 0 to send
+    as fast as the consumer takes them
+    -chunk_size: int, number of entries the reader loads at once
+    -logging: bool, set to True for periodic useful output
+
+    Returns:
+    -int, number of entries sent
+    '''
+    if reader is not None:
+        chain=reader(file_names,tree_name,chunk_size)
+    else:
+        chain=ROOT.TChain(tree_name)
+        for f in file_names:
+            chain.Add(f)
+    n_entries=chain.GetEntries()
+    if logging:
+        print "Replaying %i entries to %s" % (n_entries,address)
+    stream=serve_stream(address,'wb')
+    start_time=time.time()
+    first=None
+    n_sent=0
+    try:
+        for i in xrange(n_entries):
+            chain.GetEntry(i)
+            waveform=numpy.asarray(chain.Waveform,dtype=float)
+            end=chain.t_s+chain.t_mus*1e-6+len(waveform)*chain.dt_s
+            if first is None:
+                first=end
+            if speed>0:
+                wait=start_time+(end-first)/speed-time.time()
+                if wait>0:
+                    time.sleep(wait)
+            stream.write(pack_record(chain.Ch,chain.t_s,chain.t_mus,chain.dt_s,
+                waveform))
+            n_sent+=1
+            if logging and n_sent%1000==0:
+                print "Sent %i / %i entries" % (n_sent,n_entries)
+        stream.flush()
+    finally:
+        stream.close()
+    if logging:
+        print "Replayed %i entries in %3.2f seconds" % (n_sent,time.time()-start_time)
+    return n_sent
+
+class LiveChain(object):
+    '''
+    Stand-in for a TChain over a stream that is still being taken: entries are
+    appended as they arrive, and only the last few are kept. It has the
+    GetEntries()/GetEntry() interface the triggers use. A dropped record is
+    appended as a gap marker, an entry without data (GetEntry() returns 0), so
+    the entries after it keep their positions in the stream
+    '''
+    def __init__(self,history=64):
+        '''
+        Input:
+        -history: int, number of most recent entries to keep
+        '''
+        self.history=history
+        self.entries=collections.OrderedDict()
+        # time each kept entry was received, for the latency
+        self.arrival={}
+        self.n_entries=0
+
+    def append(self,record,arrival):
+        '''
+        Input:
+        -record: dict from read_record(), or None for a gap marker
+        -arrival: float, wall_clock() time the record was received
+        '''
+        self.entries[self.n_entries]=record
+        self.arrival[self.n_entries]=arrival
+        self.n_entries+=1
+        if len(self.entries)>self.history:
+            i,record=self.entries.popitem(last=False)
+            del self.arrival[i]
+
+    def GetEntries(self):
+        return self.n_entries
+
+    def GetEntry(self,i):
+        if i<0 or i>=self.n_entries:
+            return 0
+        if i not in self.entries:
+            raise IndexError("entry %i is older than the last %i entries kept" %
+                (i,self.history))
+        record=self.entries[i]
+        if record is None:
+            return 0
+        for name in record:
+            setattr(self,name,record[name])
+        return 1
+
+    def is_gap(self,i):
+        '''
+        Input:
+        -i: int, position of a kept entry
+
+        Returns:
+        -bool, True if the entry is a gap marker
+        '''
+        return self.entries[i] is None
+
+class JSONLinePublisher(object):
+    '''
+    Publishes the events of a LiveLooper, and its rolling statistics, as one
+    JSON object per line: {"event": {...}} with the scalar fields of each event,
+    and {"stats": {...}}
+    '''
+    def __init__(self,address='-'):
+        '''
+        Input:
+        -address: string, where to publish to (see connect_stream()). '-' for
+        stdout
+        '''
+        self.address=address
+        self.stream=None
+        self.n_published=0
+
+    def write(self,message):
+        if self.stream is None:
+            self.stream=connect_stream(self.address,'wb')
+        self.stream.write(json.dumps(message)+'\n')
+        self.stream.flush()
+
+    def event(self,event):
+        '''
+        Input:
+        -event: event dict
+        '''
+        self.write({'event':dict((name,numpy.asarray(value).item())
+            for name,value in event.items() if numpy.ndim(value)==0)})
+        self.n_published+=1
+
+    def stats(self,stats):
+        '''
+        Input:
+        -stats: dict from LiveLooper.stats()
+        '''
+        self.write({'stats':stats})
+
+    def close(self):
+        if self.stream is not None and self.stream not in [sys.stdout,sys.stderr]:
+            self.stream.close()
+        self.stream=None
+
+class LiveLooper(FileLooper):
+    '''
+    FileLooper that runs the trigger and modules on a live stream of waveform
+    records (see pack_record()) from a socket or pipe, instead of closed files,
+    so pulses show up while the data is being taken. Use replay() to stream
+    existing files for testing.
+
+    A receiving thread reads records into a bounded queue, and the loop takes
+    them off, appends them to a LiveChain and processes each entry as soon as
+    the entries its readout windows can reach into (see
+    Trigger.window_entries()) have arrived. With a block_size above 1, entries
+    that queued up while the analysis was busy go to the trigger together, up
+    to block_size at once, so the analysis catches up with array operations
+    when it falls behind and still handles single entries when it keeps up.
+    Events are handed to the modules as soon as the trigger returns them,
+    rather than waiting for a full batch. The LiveChain has to keep a block
+    and the entries its readout windows reach into, so history has to be at
+    least block_size plus those.
+
+    When the queue is full, policy='block' stops reading, which pushes back on
+    the producer through the socket or pipe; policy='drop' drops new records
+    instead. Records that waited longer than max_latency are dropped too. All
+    drops are counted, and each dropped record leaves a gap marker in its
+    place in the LiveChain: the trigger skips it, and readout windows reaching
+    into it are padded with zeros, like at the ends of a run, instead of
+    stitching together entries from either side of the drop. Every
+    stats_interval seconds the rolling statistics (see stats()) are printed and
+    published with the events.
+    '''
+    def __init__(self,address,logging=True,publisher=None,max_queue=1000,
+        policy='block',max_latency=None,stats_interval=10.,history=64,**kwargs):
+        '''
+        Input:
+        -address: string, where to read records from (see connect_stream())
+        -logging: bool, set to True for periodic useful output
+        -publisher: object with event(event) and stats(stats) methods, e.g. a
+        JSONLinePublisher, to publish to as the loop goes. None to only keep the
+        events in self.events (or the writer)
+        -max_queue: int, number of records the queue holds
+        -policy: string, 'block' or 'drop', what to do when the queue is full
+        -max_latency: float, seconds a record may wait in the queue before it is
+        dropped. None to never drop waiting records
+        -stats_interval: float, seconds between rolling statistics
+        -history: int, number of recent entries to keep for readout windows.
+        at least block_size plus the entries before and after an entry its
+        readout windows reach into
+        -kwargs: other FileLooper arguments (block_size, batch_size, etc.)
+        '''
+        if policy not in ['block','drop']:
+            raise ValueError("policy must be 'block' or 'drop', not %s" % policy)
+        block_size=kwargs.get('block_size',1)
+        if history<block_size+2:
+            raise ValueError("history (%i entries) must be at least block_size "
+                "(%i) plus the entries before and after a block" %
+                (history,block_size))
+        super(LiveLooper,self).__init__([address],None,logging=logging,**kwargs)
+        self.address=address
+        self.publisher=publisher
+        self.max_queue=max_queue
+        self.policy=policy
+        self.max_latency=max_latency
+        self.stats_interval=stats_interval
+        self.history=history
+        self.queue=None
+        self.receiver=None
+        # set to stop the receiving thread
+        self.stopping=threading.Event()
+        # records dropped since the last one queued
+        self.n_gap=0
+        # next entry to process, and the entries after it that have to arrive
+        # first
+        self.next_entry=0
+        self.n_lookahead=0
+        self.n_received=0
+        self.n_processed=0
+        self.n_dropped_full=0
+        self.n_dropped_stale=0
+        # time from receiving an entry to having its events stored, over the
+        # whole loop and since the last statistics
+        self.latency=Stage('latency')
+        self.interval_latency=Stage('latency')
+        self.last_stats=None
+
+    def open_file(self):
+        '''
+        Connects to the stream, and starts the thread receiving records
+        '''
+        self.chain=LiveChain(self.history)
+        self.stream=connect_stream(self.address,'rb')
+        self.queue=Queue.Queue(self.max_queue)
+        self.stopping.clear()
+        self.n_gap=0
+        self.receiver=threading.Thread(target=self.receive)
+        self.receiver.daemon=True
+        self.receiver.start()
+        if self.logging:
+            print "Connected to %s" % self.address
+
+    def receive(self):
+        '''
+        Body of the receiving thread: queue records as they come in, with the
+        time they arrived and the number of records dropped just before them,
+        and None at the end of the stream
+        '''
+        try:
+            while not self.stopping.is_set():
+                try:
+                    record=read_record(self.stream)
+                except (IOError,ValueError,AttributeError,socket.error):
+                    # the loop closed the stream to stop this thread
+                    if self.stopping.is_set():
+                        break
+                    raise
+                if record is None:
+                    break
+                self.n_received+=1
+                if self.policy=='block':
+                    self.put((wall_clock(),record,self.n_gap))
+                    self.n_gap=0
+                    continue
+                try:
+                    self.queue.put_nowait((wall_clock(),record,self.n_gap))
+                    self.n_gap=0
+                except Queue.Full:
+                    self.n_dropped_full+=1
+                    self.n_gap+=1
+        finally:
+            self.put(None)
+
+    def put(self,item):
+        '''
+        Queue an item, waiting while the queue is full, unless the loop stops
+
+        Input:
+        -item: tuple of arrival time, record and number of records dropped
+        before it, or None for the end of the stream
+        '''
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item,timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def stop_receiver(self):
+        '''
+        Stop the receiving thread, and close the stream
+        '''
+        self.stopping.set()
+        # wake the thread if it is waiting on a socket
+        sock=getattr(self.stream,'_sock',None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if self.stream not in [sys.stdin,sys.stdout]:
+            self.stream.close()
+        if self.receiver is not None:
+            self.receiver.join(1.)
+            self.receiver=None
+
+    def lookahead(self):
+        '''
+        Returns:
+        -int, number of entries after an entry that have to arrive before its
+        events can be read out
+        '''
+        return max([0]+[offset+step for offset,step in
+            self.trigger.window_entries().values()])
+
+    def lookback(self):
+        '''
+        Returns:
+        -int, number of entries before an entry its events can be read out from
+        '''
+        return max([0]+[step-offset for offset,step in
+            self.trigger.window_entries().values()])
+
+    def store(self,events):
+        if self.publisher is not None:
+            for event in (events.events() if isinstance(events,EventBlock)
+                else [events]):
+                self.publisher.event(event)
+        super(LiveLooper,self).store(events)
+
+    def stats(self):
+        '''
+        Returns:
+        -dict of the rolling statistics: totals so far, and rates and latencies
+        since the last statistics
+        '''
+        now=wall_clock()
+        n_events=self.events.first_id+len(self.events)
+        elapsed=now-self.last_stats[0]
+        stats={'entries_received':self.n_received,
+            'entries_processed':self.n_processed,
+            'dropped_queue_full':self.n_dropped_full,
+            'dropped_stale':self.n_dropped_stale,
+            'events':n_events,'queue_depth':self.queue.qsize(),
+            'entries_per_second':(self.n_processed-self.last_stats[1])/elapsed,
+            'events_per_second':(n_events-self.last_stats[2])/elapsed,
+            'latency_p50':self.interval_latency.percentile(0.5),
+            'latency_p99':self.interval_latency.percentile(0.99)}
+        self.last_stats=(now,self.n_processed,n_events)
+        self.interval_latency=Stage('latency')
+        return stats
+
+    def report(self):
+        '''
+        Print and publish the rolling statistics
+        '''
+        stats=self.stats()
+        if self.logging:
+            print "%i entries received, %i processed (%.0f/s), %i dropped, %i "\
+                "queued, %i events (%.1f/s), latency p50 %s p99 %s" %\
+                (stats['entries_received'],stats['entries_processed'],
+                stats['entries_per_second'],
+                stats['dropped_queue_full']+stats['dropped_stale'],
+                stats['queue_depth'],stats['events'],stats['events_per_second'],
+                stats['latency_p50'],stats['latency_p99'])
+        if self.publisher is not None:
+            self.publisher.stats(stats)
+
+    def process_entries(self,entries):
+        '''
+        Run the trigger and modules on entries that are ready, and record their
+        latency
+
+        Input:
+        -entries: list of ints, LiveChain positions
+        '''
+        entries=[i for i in entries if not self.chain.is_gap(i)]
+        for k in xrange(0,len(entries),self.block_size):
+            block=entries[k:k+self.block_size]
+            if self.block_size>1:
+                self.process(self.trigger.execute_block(self.chain,block))
+            else:
+                self.process(self.trigger.execute(self.chain,block[0]))
+            # don't hold events back waiting for a full batch
+            if self.n_pending:
+                self.process_batch(EventBlock.concatenate(self.pending))
+                self.pending=[]
+                self.n_pending=0
+            self.flush()
+            now=wall_clock()
+            for i in block:
+                latency=now-self.chain.arrival[i]
+                self.latency.add(latency,0.)
+                self.interval_latency.add(latency,0.)
+            self.n_processed+=len(block)
+
+    def advance(self,ended=False):
+        '''
+        Process the entries whose neighbours have arrived
+
+        Input:
+        -ended: bool, True at the end of the stream, to process all the entries
+        left
+        '''
+        stop=self.chain.GetEntries() if ended else\
+            self.chain.GetEntries()-self.n_lookahead
+        if stop>self.next_entry:
+            self.process_entries(range(self.next_entry,stop))
+            self.next_entry=stop
+
+    def append(self,record,arrival):
+        '''
+        Append an entry (or a gap marker, for a record that was dropped) to the
+        LiveChain, and process the entries waiting as soon as there is a block
+        of them, so none of them drop out of the history before they are
+        processed
+
+        Input:
+        -record: dict from read_record(), or None for a gap marker
+        -arrival: float, wall_clock() time the record was received
+        '''
+        self.chain.append(record,arrival)
+        if self.chain.GetEntries()-self.n_lookahead-self.next_entry>=self.block_size:
+            self.advance()
+
+    def add_item(self,item):
+        '''
+        Input:
+        -item: tuple from the queue, of the arrival time, the record, and the
+        number of records dropped before it
+        '''
+        arrival,record,n_gap=item
+        for k in xrange(n_gap):
+            self.append(None,arrival)
+        if self.max_latency is not None and wall_clock()-arrival>self.max_latency:
+            self.n_dropped_stale+=1
+            record=None
+        self.append(record,arrival)
+
+    def loop(self):
+        '''
+        Process the stream until it ends, as the records come in
+        '''
+        start_time=time.time()
+        self.open_file()
+        try:
+            if self.logging:
+                print "Starting live loop"
+            self.stages=self.plan_schedule()
+            self.attach_modules()
+            self.events.declare(self.schema())
+            self.drops=self.plan_drops()
+            self.n_lookahead=self.lookahead()
+            needed=self.block_size+self.n_lookahead+self.lookback()
+            if self.history<needed:
+                raise ValueError("history (%i entries) must be at least %i: a block "
+                    "of %i, and the %i entries before and %i after an entry %s "
+                    "reads out from" % (self.history,needed,self.block_size,
+                    self.lookback(),self.n_lookahead,self.trigger.name))
+            if self.n_threads>1 and self.batch_size>1 and\
+                any(len(stage)>1 for stage in self.stages):
+                self.pool=ThreadPool(self.n_threads)
+            if self.profiler is not None:
+                self.profiler.instrument(self)
+            self.next_entry=0
+            ended=False
+            self.last_stats=(wall_clock(),0,0)
+            while not ended:
+                try:
+                    item=self.queue.get(timeout=self.stats_interval)
+                except Queue.Empty:
+                    item=False
+                # take what else is waiting. append() hands the trigger a block
+                # at a time
+                while item:
+                    self.add_item(item)
+                    try:
+                        item=self.queue.get_nowait()
+                    except Queue.Empty:
+                        item=False
+                ended=item is None
+                # entries whose neighbours have arrived, or all of them at the end
+                self.advance(ended)
+                if wall_clock()-self.last_stats[0]>=self.stats_interval:
+                    self.report()
+            self.flush(final=True)
+        finally:
+            self.stop_receiver()
+            if self.waveform_store is not None:
+                self.waveform_store.close()
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool=None
+            if self.profiler is not None and self.profiler.wrapped:
+                self.profiler.release(self,self.n_processed)
+        self.report()
+        if self.publisher is not None:
+            self.publisher.close()
+        if self.logging:
+            print "Finished live loop in %3.2f seconds" % (time.time()-start_time)
+
+    def finish(self):
+        '''
+        Calls finish methods of trigger and each module, and prints the drop
+        and latency totals
+        '''
+        super(LiveLooper,self).finish()
+        print "Live loop: %i entries received, %i processed, %i dropped with the "\
+            "queue full, %i dropped after waiting over %s seconds" %\
+            (self.n_received,self.n_processed,self.n_dropped_full,
+            self.n_dropped_stale,self.max_latency)
+        print "Latency: mean %s, p50 %s, p99 %s seconds" %\
+            (self.latency.wall/self.latency.calls if self.latency.calls else None,
+            self.latency.percentile(0.5),self.latency.percentile(0.99))
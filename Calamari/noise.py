@@ -0,0 +1,174 @@
+import numpy
+from scipy.signal import get_window
+from base import *
+
+class NoisePSD(Module):
+    '''
+    Module to measure the noise power spectral density of a whole run, from the
+    data the trigger scans and doesn't read out as events. The trigger hands it
+    every stretch of data outside the readout windows (see
+    Trigger.add_noise_accumulator), which is cut into overlapping windowed
+    segments and Fourier transformed, as in Welch's method. Only the sum of the
+    power spectra and the number of segments are kept, so memory use doesn't
+    grow with the run, and accumulators from different files or workers can be
+    merged by adding them up.
+
+    The events themselves pass through unchanged.
+    '''
+    def __init__(self,name,segment_length,overlap=0.5,window='hann',
+        output_file=None):
+        '''
+        Input:
+        -name: string name of module for pretty printing
+        -segment_length: int, number of samples in each segment. this sets the
+        frequency resolution, 1/(segment_length*dt_sample)
+        -overlap: float, fraction of a segment that consecutive segments overlap
+        -window: string, window function applied to each segment, any name
+        scipy.signal.get_window() knows
+        -output_file: string, name of a numpy .npz file to write the spectrum to
+        at finish(). None to not write anything
+        '''
+        self.segment_length=int(segment_length)
+        self.step=max(1,int(round(self.segment_length*(1-overlap))))
+        self.window_name=window
+        self.window=get_window(window,self.segment_length)
+        self.output_file=output_file
+        # filled from the first stretch of data
+        self.dt_sample=None
+        # running sums
+        self.psd_sum=numpy.zeros(self.segment_length/2+1)
+        self.n_segments=0
+        super(NoisePSD,self).__init__(name)
+
+    def attach(self,trigger):
+        '''
+        Have the trigger feed its untriggered data to this module
+        '''
+        trigger.add_noise_accumulator(self)
+
+    def add(self,waveforms,dt_sample):
+        '''
+        Add the power spectra of all the segments in some stretches of noise
+
+        Input:
+        -waveforms: array, one stretch of noise, or 2D array with one per row.
+        stretches shorter than a segment are ignored
+        -dt_sample: float, time interval of one sample
+        '''
+        if self.dt_sample is None:
+            self.dt_sample=dt_sample
+        elif dt_sample!=self.dt_sample:
+            raise ValueError("%s: sampling interval changed from %g to %g s" %
+                (self.name,self.dt_sample,dt_sample))
+        waveforms=numpy.atleast_2d(numpy.asarray(waveforms,dtype=float))
+        n_rows,n=waveforms.shape
+        if n<self.segment_length:
+            return
+        n_per_row=(n-self.segment_length)/self.step+1
+        # every segment of every row as a view, without copying
+        waveforms=numpy.ascontiguousarray(waveforms)
+        row_stride,sample_stride=waveforms.strides
+        segments=numpy.lib.stride_tricks.as_strided(waveforms,
+            (n_rows,n_per_row,self.segment_length),
+            (row_stride,self.step*sample_stride,sample_stride))
+        # remove the mean of each segment, then window and transform
+        segments=segments-segments.mean(axis=-1)[...,numpy.newaxis]
+        spectra=numpy.fft.rfft(segments*self.window,axis=-1)
+        self.psd_sum+=(spectra.real**2+spectra.imag**2).sum(axis=(0,1))
+        self.n_segments+=n_rows*n_per_row
+
+    def merge(self,other):
+        '''
+        Add the running sums of another accumulator (e.g. from another file or
+        worker) to this one
+
+        Input:
+        -other: NoisePSD with the same segment length and window
+        '''
+        if other.segment_length!=self.segment_length or\
+            other.window_name!=self.window_name or\
+            other.step!=self.step:
+            raise ValueError("%s: can't merge spectra with different segments" %
+                self.name)
+        if other.n_segments==0:
+            super(NoisePSD,self).merge(other)
+            return
+        if self.dt_sample is not None and other.dt_sample!=self.dt_sample:
+            raise ValueError("%s: can't merge spectra with different sampling "
+                "intervals" % self.name)
+        self.dt_sample=other.dt_sample
+        self.psd_sum+=other.psd_sum
+        self.n_segments+=other.n_segments
+        super(NoisePSD,self).merge(other)
+
+    def psd(self):
+        '''
+        One-sided power spectral density averaged over all segments so far,
+        normalized like scipy.signal.welch()
+
+        Returns:
+        -array, frequencies in Hz
+        -array, power spectral density in V^2/Hz
+        '''
+        if self.n_segments==0:
+            raise ValueError("%s has no noise segments" % self.name)
+        frequencies=numpy.fft.rfftfreq(self.segment_length,self.dt_sample)
+        psd=self.psd_sum/self.n_segments*self.dt_sample/(self.window**2).sum()
+        # fold negative frequencies in, except for DC (and Nyquist)
+        if self.segment_length%2:
+            psd[1:]*=2
+        else:
+            psd[1:-1]*=2
+        return frequencies, psd
+
+    def save(self,file_name):
+        '''
+        Write the spectrum and the running sums to a numpy .npz file
+
+        Input:
+        -file_name: string, name of output file
+        '''
+        frequencies,psd=self.psd()
+        numpy.savez(file_name,frequencies=frequencies,psd=psd,
+            psd_sum=self.psd_sum,n_segments=self.n_segments,
+            dt_sample=self.dt_sample,segment_length=self.segment_length,
+            step=self.step,window=self.window_name)
+
+    def merge_file(self,file_name):
+        '''
+        Add the running sums saved in a file by save() to this accumulator
+
+        Input:
+        -file_name: string, name of file
+        '''
+        with numpy.load(file_name) as f:
+            other=NoisePSD(self.name,int(f['segment_length']),
+                window=str(f['window']))
+            other.step=int(f['step'])
+            other.dt_sample=float(f['dt_sample'])
+            other.psd_sum=f['psd_sum']
+            other.n_segments=int(f['n_segments'])
+        self.merge(other)
+
+    def reads(self):
+        return []
+
+    def rejects_events(self):
+        return False
+
+    def config(self):
+        return {'segment_length':self.segment_length,'step':self.step,
+            'window':self.window_name}
+
+    @Module._execute
+    def execute(self,event):
+        return event
+
+    def execute_batch(self,block):
+        return block
+
+    @Module._finish
+    def finish(self):
+        print "%s: noise spectrum from %i segments" % (self.name,self.n_segments)
+        if self.output_file is not None and self.n_segments:
+            self.save(self.output_file)
@@ -0,0 +1,196 @@
+import time
+import itertools
+import multiprocessing
+import numpy
+from base import *
+
+def split_entries(n_entries,n_ranges,start=0):
+    '''
+    Split entries into contiguous ranges of about the same size
+
+    Input:
+    -n_entries: int, number of entries to split
+    -n_ranges: int, number of ranges to split them into
+    -start: int, first entry
+
+    Returns:
+    -list of (first entry, number of entries) for each range
+    '''
+    edges=start+numpy.linspace(0,n_entries,n_ranges+1).astype(int)
+    return [(int(lo),int(hi-lo)) for lo,hi in zip(edges[:-1],edges[1:]) if hi>lo]
+
+def run_range(task):
+    '''
+    Worker for ParallelLooper: loops over one range of entries with its own
+    FileLooper, trigger and modules
+
+    Input:
+    -task: tuple of the FileLooper arguments (file names, tree name, dict of
+    keyword arguments), the setup function, the first entry and number of
+    entries to loop over, and optionally the trigger state to start from (see
+    Trigger.state)
+
+    Returns:
+    -dict of arrays, columns of the events found, without EventID
+    -the worker's trigger
+    -dict of the worker's modules, keyed by name
+    -the trigger state the loop started from
+    '''
+    file_names,tree_name,kwargs,setup,start,n_entries=task[:6]
+    state=task[6] if len(task)>6 else None
+    FL=FileLooper(file_names,tree_name,logging=False,**kwargs)
+    setup(FL)
+    FL.loop(n_entries,start,state)
+    columns=dict((name,FL.events[name]) for name in FL.events.keys()
+        if name!='EventID')
+    return columns,FL.trigger,FL.modules,FL.start_state
+
+def run_ranges(tasks,results,logging=False,max_rerun=None):
+    '''
+    Check that each range of entries started from the state the range before
+    it ended in, and loop over the ranges that didn't again, from that state.
+    The warm-up before a range usually gets the trigger into the right state,
+    but not always (e.g. when the SimpleTrigger skipped different strides after
+    a trigger in the warm-up entries). Ranges looped over again run one after
+    the other in the calling process, so too many of them lose the speedup
+
+    Input:
+    -tasks: list of run_range() tasks, for contiguous ranges in entry order
+    -results: iterable of the run_range() results for the tasks, in order
+    -logging: bool, set to True to print the ranges looped over again
+    -max_rerun: float, fraction of the ranges that may be looped over again.
+    a RuntimeError is raised as soon as more are needed. None for no limit
+
+    Returns:
+    -generator of (bool, True if the range was looped over again, and the
+    exact run_range() result), in order
+    '''
+    end_state=None
+    n_rerun=0
+    for k,(task,result) in enumerate(itertools.izip(tasks,results)):
+        rerun=k>0 and result[3]!=end_state
+        if rerun:
+            n_rerun+=1
+            if max_rerun is not None and n_rerun>max_rerun*len(tasks):
+                raise RuntimeError("%i of %i ranges didn't start from where the "
+                    "range before ended, more than the %i%% allowed to be looped "
+                    "over again; the trigger's warm-up (see Trigger.warm_up) "
+                    "doesn't reach its state" % (n_rerun,len(tasks),
+                    100*max_rerun))
+            if logging:
+                print "Range %i didn't start from where range %i ended, "\
+                    "looping over it again" % (k+1,k)
+            result=run_range(tuple(task[:6])+(end_state,))
+        end_state=result[1].state()
+        yield rerun,result
+
+class ParallelLooper(FileLooper):
+    '''
+    FileLooper that splits the entries of the TChain into contiguous ranges and
+    loops over them in a pool of worker processes. Each worker opens the whole
+    chain (so readout windows and heater/bolometer pairs that cross a range
+    boundary are read as usual), builds its own trigger and modules with the
+    setup function, warms the trigger up on the entries before its range (see
+    Trigger.warm_up), and sends back its events and its trigger and modules.
+
+    The results are merged back in entry order, so the events, EventIDs, and
+    module counters, timers and accumulated results (see Module.merge) are the
+    same as from a single FileLooper. Where the warm-up didn't put the trigger in
+    the state the range before ended in, the range is looped over again in the
+    main process, from that state (see run_ranges); n_rerun counts these, and
+    a warning is printed when there are any. More than max_rerun of the ranges
+    stops the loop with a RuntimeError, since those run one after the other.
+
+    The setup function is also called on the ParallelLooper itself, to build the
+    instances results are merged into. Writers and waveform stores should be
+    added to the ParallelLooper after it is made, not in the setup function.
+    '''
+    def __init__(self,file_names,tree_name,setup,n_workers=None,n_ranges=None,
+        max_rerun=0.25,logging=True,**kwargs):
+        '''
+        Input:
+        -file_names: list of strings corresponding to path of each ROOT
+            file to load
+        -tree_name: string with name of tree in ROOT file
+        -setup: function taking a FileLooper and adding the trigger and modules
+            to it. it has to be picklable, i.e. defined at the top level of a
+            module or script
+        -n_workers: int, number of worker processes. None for one per core
+        -n_ranges: int, number of entry ranges to split the chain into. more
+            ranges than workers balances the load better, at the cost of more
+            warm-up entries. None for 4 per worker
+        -max_rerun: float, fraction of the ranges that may be looped over again
+            in the main process (see run_ranges). None for no limit
+        -logging: bool, set to True for periodic useful output
+        -kwargs: other FileLooper arguments (reader, chunk_size, block_size,
+            etc.), passed to the FileLooper of each worker
+        '''
+        super(ParallelLooper,self).__init__(file_names,tree_name,logging=logging,
+            **kwargs)
+        self.kwargs=kwargs
+        self.setup=setup
+        self.n_workers=n_workers or multiprocessing.cpu_count()
+        self.n_ranges=n_ranges or 4*self.n_workers
+        self.max_rerun=max_rerun
+        self.n_rerun=0
+        setup(self)
+
+    def loop(self,n_events=0,start=0):
+        '''
+        Loop over the entries in the pool of workers, and merge their results
+
+        Input:
+        -n_events: int, number of entries to process. if 0, it processes all
+        entries in files
+        -start: int, TChain entry to start from
+        '''
+        start_time=time.time()
+        self.open_file()
+        n_entries=self.chain.GetEntries()
+        if self.reader is not None:
+            self.chain.stop_prefetch()
+        if n_events==0:
+            n_events=n_entries-start
+        n_events=min(n_events,n_entries-start)
+        self.stages=self.plan_schedule()
+        self.events.declare(self.schema())
+        self.drops=self.plan_drops()
+        # workers keep the fields the waveform store needs too
+        kwargs=dict(self.kwargs)
+        if self.keep_fields is not None and self.waveform_store is not None:
+            kwargs['keep_fields']=list(self.keep_fields)+self.waveform_store.fields
+        tasks=[(self.file_names,self.tree_name,kwargs,self.setup,lo,n)
+            for lo,n in split_entries(n_events,self.n_ranges,start)]
+        if self.logging:
+            print "Starting loop over %i entries in %i ranges with %i workers" %\
+                (n_events,len(tasks),self.n_workers)
+        pool=multiprocessing.Pool(self.n_workers)
+        self.n_rerun=0
+        try:
+            # imap hands back the results in the order of the ranges
+            results=run_ranges(tasks,pool.imap(run_range,tasks),self.logging,
+                self.max_rerun)
+            for k,(rerun,(columns,trigger,modules,state)) in enumerate(results):
+                self.n_rerun+=rerun
+                self.trigger.merge(trigger)
+                for name in self.modules:
+                    self.modules[name].merge(modules[name])
+                if columns:
+                    self.store(EventBlock(columns))
+                    self.flush()
+                if self.logging:
+                    print "Range %i / %i" % (k+1,len(tasks))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        self.flush(final=True)
+        if self.waveform_store is not None:
+            self.waveform_store.close()
+        if self.n_rerun:
+            print "Warning: %i of %i ranges were looped over again in the main "\
+                "process" % (self.n_rerun,len(tasks))
+        if self.logging:
+            print "Finished loop in %3.2f seconds" % (time.time()-start_time)
@@ -0,0 +1,341 @@
+import sys
+import json
+import math
+import time
+import timeit
+import cProfile
+import pstats
+import threading
+import collections
+try:
+    import resource
+except ImportError:
+    # only on unix, for the peak memory
+    resource=None
+try:
+    import ROOT
+except ImportError:
+    ROOT=None
+
+# python 2 has no time.perf_counter(). default_timer is the most precise wall
+# clock there is on each platform, and time.clock() is the CPU time on unix
+wall_clock=timeit.default_timer
+cpu_clock=time.clock
+
+class Stage(object):
+    '''
+    Timing of one stage of the loop (the trigger, a module, writing, ...): wall
+    and CPU time, number of calls and of items (entries or events) handled,
+    and a histogram of the wall time per item, in log-spaced bins
+    '''
+    def __init__(self,name,bins_per_decade=10,min_latency=1e-7,max_latency=1e2):
+        '''
+        Input:
+        -name: string, name of the stage
+        -bins_per_decade: int, number of histogram bins per factor of 10
+        -min_latency: float, lower edge of the first histogram bin, in seconds
+        -max_latency: float, upper edge of the last histogram bin, in seconds
+        '''
+        self.name=name
+        self.wall=0.
+        self.cpu=0.
+        self.calls=0
+        self.items=0
+        self.bins_per_decade=bins_per_decade
+        self.log_min=math.log10(min_latency)
+        n_bins=int(round((math.log10(max_latency)-self.log_min)*bins_per_decade))
+        # plus an underflow and an overflow bin
+        self.histogram=[0]*(n_bins+2)
+
+    def add(self,wall,cpu,items=1):
+        '''
+        Record one call
+
+        Input:
+        -wall: float, wall time of the call, in seconds
+        -cpu: float, CPU time of the call, in seconds
+        -items: int, number of entries or events handled in the call
+        '''
+        self.wall+=wall
+        self.cpu+=cpu
+        self.calls+=1
+        self.items+=items
+        latency=wall/items if items>0 else wall
+        if latency>0:
+            k=int((math.log10(latency)-self.log_min)*self.bins_per_decade)+1
+            k=min(max(k,0),len(self.histogram)-1)
+        else:
+            k=0
+        self.histogram[k]+=items if items>0 else 1
+
+    def edge(self,k):
+        '''
+        Input:
+        -k: int, histogram bin
+
+        Returns:
+        -float, upper edge of the bin in seconds
+        '''
+        return 10**(self.log_min+float(k)/self.bins_per_decade)
+
+    def percentile(self,fraction):
+        '''
+        Input:
+        -fraction: float, between 0 and 1
+
+        Returns:
+        -float, upper edge of the histogram bin the percentile falls in
+        '''
+        total=sum(self.histogram)
+        if total==0:
+            return None
+        count=0
+        for k,n in enumerate(self.histogram):
+            count+=n
+            if count>=fraction*total:
+                return self.edge(k)
+        return self.edge(len(self.histogram)-1)
+
+    def to_dict(self):
+        '''
+        Returns:
+        -dict of the stage's totals, rates and latency histogram, for the report
+        '''
+        return {'wall_seconds':self.wall,'cpu_seconds':self.cpu,
+            'calls':self.calls,'items':self.items,
+            'items_per_second':self.items/self.wall if self.wall>0 else None,
+            'latency_seconds':{'mean':self.wall/self.items if self.items else None,
+                'p50':self.percentile(0.5),'p90':self.percentile(0.9),
+                'p99':self.percentile(0.99)},
+            'latency_histogram':[[self.edge(k),n]
+                for k,n in enumerate(self.histogram) if n]}
+
+class Profiler(object):
+    '''
+    Instrumentation of a FileLooper loop, added with FileLooper.add_profiler().
+    For the length of the loop, the trigger's and each module's execute (or
+    execute_block/execute_batch) method, storing and writing events are
+    wrapped in timers, which adds a few microseconds per call: per entry or
+    event without blocks and batches, per block with them. Reading (for
+    readers) and stitching entries together for readout windows are timed by
+    the reader and the trigger's buffers themselves.
+
+    The report (see report()) has the wall and CPU time, throughput and
+    latency histogram of every stage, the entries/s and events/s of the whole
+    loop, bytes read and written, and the peak memory of the process, and is
+    written as JSON at FileLooper.finish().
+
+    For a closer look, one module (or the trigger) can be run under cProfile,
+    and/or the main thread can be sampled at a fixed interval by a background
+    thread to see where time goes inside the stages.
+    '''
+    def __init__(self,output_file=None,profile_module=None,sample_interval=None,
+        bins_per_decade=10):
+        '''
+        Input:
+        -output_file: string, name of JSON file to write the report to. None to
+        only print a summary
+        -profile_module: string, name of one module (or of the trigger) to run
+        under cProfile. None for none
+        -sample_interval: float, seconds between samples of the main thread's
+        stack. None to not sample
+        -bins_per_decade: int, resolution of the latency histograms
+        '''
+        self.output_file=output_file
+        self.profile_module=profile_module
+        self.sample_interval=sample_interval
+        self.bins_per_decade=bins_per_decade
+        self.stages=collections.OrderedDict()
+        self.wrapped=[]
+        self.wall=0.
+        self.cpu=0.
+        self.n_entries=0
+        self.n_events=0
+        self.bytes_read=0
+        self.read_time=0.
+        self.stitch_time=0.
+        self.bytes_written=0
+        self.cprofile=None
+        self.samples=collections.Counter()
+        self.sampler=None
+        self.stop_sampling=None
+
+    def stage(self,name):
+        if name not in self.stages:
+            self.stages[name]=Stage(name,self.bins_per_decade)
+        return self.stages[name]
+
+    def wrap(self,obj,method_name,stage_name,count):
+        '''
+        Replace a method of one object with a timed version, until release()
+
+        Input:
+        -obj: object whose method to wrap
+        -method_name: string, name of the method
+        -stage_name: string, name of the stage to record the calls in
+        -count: function taking the method's arguments and result, returning
+        the number of items handled
+        '''
+        method=getattr(obj,method_name)
+        stage=self.stage(stage_name)
+        if stage_name==self.profile_module:
+            if self.cprofile is None:
+                self.cprofile=cProfile.Profile()
+            profiled=method
+            method=lambda *args: self.cprofile.runcall(profiled,*args)
+        def timed(*args):
+            wall=wall_clock()
+            cpu=cpu_clock()
+            out=method(*args)
+            stage.add(wall_clock()-wall,cpu_clock()-cpu,count(args,out))
+            return out
+        setattr(obj,method_name,timed)
+        self.wrapped+=[(obj,method_name)]
+
+    def instrument(self,looper):
+        '''
+        Start timing a loop. Called by FileLooper.loop() once the trigger and
+        modules are set up
+
+        Input:
+        -looper: FileLooper
+        '''
+        self.start_wall=wall_clock()
+        self.start_cpu=cpu_clock()
+        self.start_events=looper.events.first_id+len(looper.events)
+        self.start_root_bytes=ROOT.TFile.GetFileBytesRead()\
+            if ROOT is not None and looper.reader is None else 0
+        self.start_stitch=self.stitch_seconds(looper)
+        trigger=looper.trigger
+        if looper.block_size>1:
+            self.wrap(trigger,'execute_block',trigger.name,
+                lambda args,out: len(args[-1]))
+        else:
+            self.wrap(trigger,'execute',trigger.name,lambda args,out: 1)
+        for stage in looper.stages:
+            for name in stage:
+                if looper.batch_size>1:
+                    self.wrap(looper.modules[name],'execute_batch',name,
+                        lambda args,out: len(args[-1]))
+                else:
+                    self.wrap(looper.modules[name],'execute',name,lambda args,out: 1)
+        self.wrap(looper,'store','store',lambda args,out:
+            len(args[0]) if hasattr(args[0],'keep') else 1)
+        if looper.writer is not None:
+            self.wrap(looper.writer,'write','write',lambda args,out: len(args[0]))
+        if self.sample_interval:
+            self.stop_sampling=threading.Event()
+            self.sampler=threading.Thread(target=self.sample,
+                args=(threading.current_thread().ident,))
+            self.sampler.daemon=True
+            self.sampler.start()
+
+    def sample(self,thread_id):
+        '''
+        Body of the sampling thread: count the function the main thread is in,
+        every sample_interval seconds
+
+        Input:
+        -thread_id: int, ident of the thread to sample
+        '''
+        while not self.stop_sampling.wait(self.sample_interval):
+            frame=sys._current_frames().get(thread_id)
+            if frame is not None:
+                code=frame.f_code
+                self.samples['%s:%i(%s)' % (code.co_filename,frame.f_lineno,
+                    code.co_name)]+=1
+
+    def release(self,looper,n_entries):
+        '''
+        Stop timing a loop, and put the original methods back. Called by
+        FileLooper.loop() at the end of the loop
+
+        Input:
+        -looper: FileLooper
+        -n_entries: int, number of TChain entries the loop visited
+        '''
+        self.wall+=wall_clock()-self.start_wall
+        self.cpu+=cpu_clock()-self.start_cpu
+        self.n_entries+=n_entries
+        self.n_events+=looper.events.first_id+len(looper.events)-self.start_events
+        for obj,method_name in self.wrapped:
+            delattr(obj,method_name)
+        self.wrapped=[]
+        if self.sampler is not None:
+            self.stop_sampling.set()
+            self.sampler.join()
+            self.sampler=None
+        if looper.reader is not None:
+            self.bytes_read+=looper.chain.bytes_read
+            self.read_time+=looper.chain.read_time
+        elif ROOT is not None:
+            self.bytes_read+=ROOT.TFile.GetFileBytesRead()-self.start_root_bytes
+        self.stitch_time+=self.stitch_seconds(looper)-self.start_stitch
+        if looper.writer is not None:
+            self.bytes_written=looper.writer.n_bytes
+
+    def stitch_seconds(self,looper):
+        '''
+        Input:
+        -looper: FileLooper
+
+        Returns:
+        -float, time the trigger's buffers have spent stitching entries together
+        '''
+        return sum(buffer.load_time for buffer in
+            looper.trigger.stream_buffers().values())
+
+    def peak_memory(self):
+        '''
+        Returns:
+        -int, peak resident memory of the process in bytes, or None if unknown
+        '''
+        if resource is None:
+            return None
+        peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on mac
+        return peak if sys.platform=='darwin' else peak*1024
+
+    def report(self):
+        '''
+        Put together the report, print a summary, and write it as JSON if there
+        is an output file
+
+        Returns:
+        -dict, the report
+        '''
+        report={'wall_seconds':self.wall,'cpu_seconds':self.cpu,
+            'entries':self.n_entries,'events':self.n_events,
+            'entries_per_second':self.n_entries/self.wall if self.wall>0 else None,
+            'events_per_second':self.n_events/self.wall if self.wall>0 else None,
+            'bytes_read':self.bytes_read,'read_seconds':self.read_time,
+            'stitch_seconds':self.stitch_time,
+            'bytes_written':self.bytes_written,
+            'peak_memory_bytes':self.peak_memory(),
+            'stages':collections.OrderedDict((name,self.stages[name].to_dict())
+                for name in self.stages)}
+        if self.cprofile is not None:
+            stats=pstats.Stats(self.cprofile).stats
+            top=sorted(stats.items(),key=lambda item: -item[1][3])[:25]
+            report['cprofile']={'module':self.profile_module,'functions':[
+                {'function':'%s:%i(%s)' % key,'calls':value[1],
+                'total_seconds':value[2],'cumulative_seconds':value[3]}
+                for key,value in top]}
+        if self.samples:
+            total=sum(self.samples.values())
+            report['samples']={'interval_seconds':self.sample_interval,
+                'total':total,'top':[[name,n] for name,n in
+                self.samples.most_common(25)]}
+        print "Profile: %i entries (%.0f/s), %i events (%.0f/s), %3.2f s wall, "\
+            "%3.2f s CPU, %.1f MB read in %3.2f s, %3.2f s stitching" %\
+            (self.n_entries,report['entries_per_second'] or 0,self.n_events,
+            report['events_per_second'] or 0,self.wall,self.cpu,
+            self.bytes_read/1e6,self.read_time,self.stitch_time)
+        for name in self.stages:
+            stage=self.stages[name]
+            print "  %s: %3.2f s wall, %3.2f s CPU, %i calls, %i items" %\
+                (name,stage.wall,stage.cpu,stage.calls,stage.items)
+        if self.output_file is not None:
+            with open(self.output_file,'w') as f:
+                json.dump(report,f,indent=1)
+        return report
@@ -0,0 +1,390 @@
+import os
+import timeit
+import threading
+import Queue
+import numpy
+try:
+    import ROOT
+    import root_numpy
+except ImportError:
+    # only the ROOT readers need these, the memmap reader works without them
+    ROOT=None
+    root_numpy=None
+
+class Reader(object):
+    '''
+    Base class for bulk waveform readers to plug into FileLooper
+
+    A reader loads entries in large chunks into 2D numpy arrays (one row per
+    entry) instead of going through PyROOT one entry at a time. It presents the
+    current entry the same way a ROOT TChain does: GetEntries(), GetEntry(i), and
+    the Waveform, Ch, t_s, t_mus and dt_s branches as attributes, so triggers
+    written for a TChain work with any reader unchanged.
+
+    A reader can also prefetch: a background thread reads the chunks after the
+    current one, in order, into a bounded queue while the main thread triggers
+    and analyses the current chunk. The data handed to the triggers is the same
+    with or without prefetching.
+
+    Subclasses implement count_entries() and read_chunk()
+    '''
+    # scalar branches read alongside the waveform
+    scalar_names=['Ch','t_s','t_mus','dt_s']
+
+    def __init__(self,file_names,tree_name=None,chunk_size=1000):
+        '''
+        Input:
+        -file_names: list of strings, paths of the files to read, in order
+        -tree_name: string with name of tree in file, if the format has one
+        -chunk_size: int, number of entries to read at once
+        '''
+        self.file_names=list(file_names)
+        self.tree_name=tree_name
+        self.chunk_size=int(chunk_size)
+        self.n_entries=None
+        # entries [chunk_start,chunk_stop) are loaded
+        self.chunk_start=0
+        self.chunk_stop=0
+        self.waveforms=None
+        self.scalars={}
+        # the chunk before the current one is kept as well, since triggers read
+        # neighbouring entries across chunk boundaries
+        self.previous=(0,0,None,{})
+        # prefetching, off unless start_prefetch() is called
+        self.prefetch_depth=0
+        self.prefetch_bytes=None
+        self.thread=None
+        self.queue=None
+        self.stopping=None
+        # start of the next chunk the prefetch thread will deliver
+        self.next_start=None
+        # time spent in load_chunk() reading or waiting for chunks, and what
+        # was loaded, for profiling
+        self.read_time=0.
+        self.bytes_read=0
+        self.chunks_read=0
+
+    def count_entries(self):
+        '''
+        Returns:
+        -int, total number of entries in all files
+        '''
+        raise NotImplementedError
+
+    def read_chunk(self,start,stop):
+        '''
+        Read a range of entries
+
+        Input:
+        -start: int, first entry to read
+        -stop: int, entry after the last one to read
+
+        Returns:
+        -2D array of waveforms, one row per entry
+        -dict of 1D arrays, one for each name in scalar_names
+        '''
+        raise NotImplementedError
+
+    def scan(self,stop=None,start=0):
+        '''
+        Read the scalar branches of all entries, plus the minimum of each entry's
+        waveform, without keeping the waveforms
+
+        Input:
+        -stop: int, entry to stop before. None for all entries
+        -start: int, first entry to read
+
+        Returns:
+        -dict of 1D arrays: Ch, t_s, t_mus and WaveformMin
+        '''
+        if stop is None:
+            stop=self.GetEntries()
+        columns=dict((name,[]) for name in ['Ch','t_s','t_mus','WaveformMin'])
+        for lo in xrange(start,stop,self.chunk_size):
+            waveforms,scalars=self.read_chunk(lo,min(lo+self.chunk_size,stop))
+            for name in ['Ch','t_s','t_mus']:
+                columns[name]+=[scalars[name]]
+            columns['WaveformMin']+=[waveforms.min(axis=1)]
+        return dict((name,numpy.concatenate(columns[name]) if columns[name] else
+            numpy.zeros(0)) for name in columns)
+
+    def GetEntries(self):
+        '''
+        Returns:
+        -int, total number of entries in all files
+        '''
+        if self.n_entries is None:
+            self.n_entries=int(self.count_entries())
+        return self.n_entries
+
+    def GetEntry(self,i):
+        '''
+        Make entry i the current entry, loading its chunk if needed
+
+        Input:
+        -i: int, entry number
+
+        Returns:
+        -int, number of bytes in the entry's waveform, 0 if there is no entry i
+        (like TChain.GetEntry)
+        '''
+        if i<0 or i>=self.GetEntries():
+            return 0
+        if self.chunk_start<=i<self.chunk_stop:
+            k,waveforms,scalars=i-self.chunk_start,self.waveforms,self.scalars
+        elif self.previous[0]<=i<self.previous[1]:
+            start,stop,waveforms,scalars=self.previous
+            k=i-start
+        else:
+            self.load_chunk(i-i%self.chunk_size)
+            k,waveforms,scalars=i-self.chunk_start,self.waveforms,self.scalars
+        self.Waveform=waveforms[k]
+        for name in self.scalar_names:
+            setattr(self,name,scalars[name][k])
+        return self.Waveform.nbytes
+
+    def load_chunk(self,start):
+        '''
+        Make the chunk starting at a given entry the current chunk, taking it
+        from the prefetch queue if it is the next one there
+
+        Input:
+        -start: int, first entry of the chunk
+        '''
+        start_time=timeit.default_timer()
+        stop=min(start+self.chunk_size,self.GetEntries())
+        if self.thread is not None and start==self.next_start:
+            chunk_start,chunk=self.queue.get()
+            if isinstance(chunk,Exception):
+                self.stop_prefetch()
+                raise chunk
+            waveforms,scalars=chunk
+            self.next_start=stop
+        else:
+            # not reading in order, so anything prefetched is useless. read this
+            # chunk directly and prefetch from the one after it
+            self.stop_prefetch()
+            waveforms,scalars=self.read_chunk(start,stop)
+            if self.prefetch_depth>0:
+                self.start_thread(stop,waveforms.nbytes)
+        self.previous=(self.chunk_start,self.chunk_stop,self.waveforms,self.scalars)
+        self.chunk_start=start
+        self.chunk_stop=stop
+        self.waveforms=waveforms
+        self.scalars=scalars
+        self.read_time+=timeit.default_timer()-start_time
+        self.bytes_read+=waveforms.nbytes+sum(scalars[name].nbytes
+            for name in scalars)
+        self.chunks_read+=1
+
+    def start_prefetch(self,depth=2,max_bytes=None):
+        '''
+        Turn on prefetching. The thread starts when the first chunk is loaded
+
+        Input:
+        -depth: int, maximum number of chunks waiting in the queue
+        -max_bytes: int, cap on the waveform bytes waiting in the queue. at least
+        one chunk is always prefetched. None for no cap
+        '''
+        self.prefetch_depth=int(depth)
+        self.prefetch_bytes=max_bytes
+
+    def start_thread(self,start,chunk_bytes):
+        '''
+        Start the prefetch thread
+
+        Input:
+        -start: int, first entry of the first chunk to prefetch
+        -chunk_bytes: int, size of one chunk's waveforms, for the memory cap
+        '''
+        depth=self.prefetch_depth
+        if self.prefetch_bytes is not None and chunk_bytes>0:
+            depth=max(1,min(depth,int(self.prefetch_bytes/chunk_bytes)))
+        self.queue=Queue.Queue(depth)
+        self.stopping=threading.Event()
+        self.next_start=start
+        self.thread=threading.Thread(target=self.prefetch,
+            args=(start,self.queue,self.stopping))
+        self.thread.daemon=True
+        self.thread.start()
+
+    def prefetch(self,start,queue,stopping):
+        '''
+        Body of the prefetch thread. Reads chunks in order from start until the
+        end of the data, or until told to stop
+
+        Input:
+        -start: int, first entry of the first chunk to read
+        -queue: Queue to put (start, (waveforms, scalars)) items in
+        -stopping: threading.Event, set to stop the thread
+        '''
+        n_entries=self.GetEntries()
+        while start<n_entries and not stopping.is_set():
+            stop=min(start+self.chunk_size,n_entries)
+            try:
+                chunk=self.read_chunk(start,stop)
+            except Exception as e:
+                # hand the error to the main thread, which raises it
+                chunk=e
+            while not stopping.is_set():
+                try:
+                    queue.put((start,chunk),timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            if isinstance(chunk,Exception):
+                return
+            start=stop
+
+    def stop_prefetch(self):
+        '''
+        Stop the prefetch thread, if running, and throw away what it read
+        '''
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread=None
+        self.queue=None
+        self.next_start=None
+
+class TreeReader(Reader):
+    '''
+    Reader for ROOT files, which uses root_numpy to convert chunks of the TChain
+    to numpy arrays in one call
+    '''
+    def __init__(self,file_names,tree_name,chunk_size=1000):
+        '''
+        Input:
+        -file_names: list of strings corresponding to path of each ROOT
+            file to load
+        -tree_name: string with name of tree in ROOT file
+        -chunk_size: int, number of entries to read at once
+        '''
+        if root_numpy is None:
+            raise ImportError("TreeReader needs ROOT and root_numpy")
+        super(TreeReader,self).__init__(file_names,tree_name,chunk_size)
+        self.chain=ROOT.TChain(self.tree_name)
+        for f in self.file_names:
+            self.chain.Add(f)
+
+    def count_entries(self):
+        return self.chain.GetEntries()
+
+    def read_chunk(self,start,stop):
+        data=root_numpy.tree2array(self.chain,branches=['Waveform']+self.scalar_names,
+            start=start,stop=stop)
+        # vector branches come back as an object array of 1D arrays
+        waveforms=numpy.vstack(data['Waveform']).astype(float,copy=False)
+        scalars=dict((name,data[name]) for name in self.scalar_names)
+        return waveforms, scalars
+
+    def scan(self,stop=None,start=0):
+        return scan_entries(self.chain,stop,start)
+
+class MemmapReader(Reader):
+    '''
+    Reader for data stored as flat numpy binaries, which are memory-mapped
+    rather than read. Each "file" is a directory holding one .npy file per
+    branch: Waveform.npy with a 2D array of waveforms (one row per entry), and
+    Ch.npy, t_s.npy, t_mus.npy and dt_s.npy with 1D arrays. Use
+    write_memmap_store() to make one. This doesn't need ROOT at all.
+    '''
+    def __init__(self,file_names,tree_name=None,chunk_size=1000):
+        '''
+        Input:
+        -file_names: list of strings, paths of the store directories
+        -tree_name: ignored, stores don't have trees
+        -chunk_size: int, number of entries to read at once
+        '''
+        super(MemmapReader,self).__init__(file_names,tree_name,chunk_size)
+        self.stores=[]
+        # entry number where each store starts, plus the total at the end
+        self.offsets=[0]
+        for f in self.file_names:
+            store={}
+            for name in ['Waveform']+self.scalar_names:
+                store[name]=numpy.load(os.path.join(f,name+'.npy'),mmap_mode='r')
+            self.stores+=[store]
+            self.offsets+=[self.offsets[-1]+len(store['Waveform'])]
+
+    def count_entries(self):
+        return self.offsets[-1]
+
+    def read_chunk(self,start,stop):
+        pieces=[]
+        for k,store in enumerate(self.stores):
+            lo=max(start,self.offsets[k])
+            hi=min(stop,self.offsets[k+1])
+            if lo<hi:
+                pieces+=[(store,lo-self.offsets[k],hi-self.offsets[k])]
+        # concatenating copies the chunk out of the memory map into memory
+        waveforms=numpy.concatenate([store['Waveform'][lo:hi]
+            for store,lo,hi in pieces]).astype(float,copy=False)
+        scalars=dict((name,numpy.concatenate([store[name][lo:hi]
+            for store,lo,hi in pieces])) for name in self.scalar_names)
+        return waveforms, scalars
+
+    def scan(self,stop=None,start=0):
+        # the scalar branches are separate files, so only the waveform minimum
+        # needs the waveforms, and that can be taken straight from the memory map
+        if stop is None:
+            stop=self.GetEntries()
+        columns=dict((name,[]) for name in ['Ch','t_s','t_mus','WaveformMin'])
+        for k,store in enumerate(self.stores):
+            lo=max(start,self.offsets[k])-self.offsets[k]
+            hi=min(stop,self.offsets[k+1])-self.offsets[k]
+            if hi<=0:
+                break
+            if lo>=hi:
+                continue
+            for name in ['Ch','t_s','t_mus']:
+                columns[name]+=[numpy.asarray(store[name][lo:hi])]
+            columns['WaveformMin']+=[numpy.concatenate([
+                store['Waveform'][j:min(j+self.chunk_size,hi)].min(axis=1)
+                for j in xrange(lo,hi,self.chunk_size)])]
+        return dict((name,numpy.concatenate(columns[name]) if columns[name] else
+            numpy.zeros(0)) for name in columns)
+
+def scan_entries(chain,stop=None,start=0):
+    '''
+    Read the scalar branches of a TChain or reader, plus the minimum of each
+    entry's waveform. This is much cheaper than going through the entries with
+    GetEntry, since the waveforms never have to be converted to python
+
+    Input:
+    -chain: ROOT TChain or Reader holding SQUID data
+    -stop: int, entry to stop before. None for all entries
+    -start: int, first entry to read
+
+    Returns:
+    -dict of 1D arrays: Ch, t_s, t_mus and WaveformMin
+    '''
+    if isinstance(chain,Reader):
+        return chain.scan(stop,start)
+    if root_numpy is None:
+        raise ImportError("scanning a TChain needs root_numpy")
+    data=root_numpy.tree2array(chain,branches=['Ch','t_s','t_mus','Min$(Waveform)'],
+        start=start,stop=stop)
+    return {'Ch':data['Ch'],'t_s':data['t_s'],'t_mus':data['t_mus'],
+        'WaveformMin':data['Min$(Waveform)']}
+
+def write_memmap_store(path,Waveform,Ch,t_s,t_mus,dt_s):
+    '''
+    Write waveform data in the format read by MemmapReader
+
+    Input:
+    -path: string, directory to write to. it is created if needed
+    -Waveform: 2D array of waveforms, one row per entry
+    -Ch, t_s, t_mus, dt_s: 1D arrays with one value per entry
+    '''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    columns={'Waveform':Waveform,'Ch':Ch,'t_s':t_s,'t_mus':t_mus,'dt_s':dt_s}
+    n_entries=len(Waveform)
+    for name in columns:
+        data=numpy.asarray(columns[name])
+        if len(data)!=n_entries:
+            raise ValueError("%s has %i entries, Waveform has %i" %
+                (name,len(data),n_entries))
+        numpy.save(os.path.join(path,name+'.npy'),data)
@@ -0,0 +1,315 @@
+import os
+import sys
+import glob
+import json
+import time
+import cPickle
+import hashlib
+import itertools
+import subprocess
+from base import *
+from writer import NPZWriter
+from parallel import split_entries,run_range,run_ranges
+
+def object_path(obj):
+    '''
+    Input:
+    -obj: function or class defined at the top level of an importable module
+
+    Returns:
+    -string 'module:name' that import_object() finds it again with
+    '''
+    module=obj.__module__
+    if module=='__main__':
+        raise ValueError("%s is defined in the main script; shard processes can't"
+            " import it. put it in a module" % obj.__name__)
+    return '%s:%s' % (module,obj.__name__)
+
+def import_object(path):
+    '''
+    Input:
+    -path: string 'module:name', from object_path()
+
+    Returns:
+    -the function or class
+    '''
+    module,name=path.split(':')
+    __import__(module)
+    return getattr(sys.modules[module],name)
+
+def write_manifest(manifest_file,file_names,tree_name,setup,n_shards,
+    output_dir,**kwargs):
+    '''
+    Split the entries of a TChain into shards with about the same number of
+    entries each, and write them to a manifest that run_shard() and
+    merge_shards() work from. Shards are contiguous entry ranges, so a file can
+    be split over several shards, or a shard can span several files
+
+    Input:
+    -manifest_file: string, name of JSON manifest file to write
+    -file_names: list of strings corresponding to path of each ROOT file
+    -tree_name: string with name of tree in ROOT file
+    -setup: function taking a FileLooper and adding the trigger and modules to
+    it, defined at the top level of an importable module (not the main script)
+    -n_shards: int, number of shards
+    -output_dir: string, directory each shard writes its output to, in a
+    subdirectory of its own
+    -kwargs: other FileLooper arguments (reader, chunk_size, block_size, etc.).
+    the reader is stored by name, the rest has to be JSON serializable
+
+    Returns:
+    -dict, the manifest
+    '''
+    FL=FileLooper(file_names,tree_name,logging=False,**kwargs)
+    FL.open_file()
+    n_entries=FL.chain.GetEntries()
+    if FL.reader is not None:
+        FL.chain.stop_prefetch()
+    looper_args=dict(kwargs)
+    if looper_args.get('reader') is not None:
+        looper_args['reader']=object_path(looper_args['reader'])
+    shards=[]
+    for k,(start,n) in enumerate(split_entries(n_entries,n_shards)):
+        shards+=[{'id':k,'start':start,'n_entries':n,
+            'directory':os.path.join(output_dir,'shard_%04i' % k)}]
+    manifest={'file_names':list(file_names),'tree_name':tree_name,
+        'setup':object_path(setup),'looper_args':looper_args,
+        'n_entries':n_entries,'shards':shards,'created':time.time()}
+    manifest['hash']=manifest_hash(manifest)
+    with open(manifest_file,'w') as f:
+        json.dump(manifest,f,indent=1,sort_keys=True)
+    return manifest
+
+def manifest_hash(manifest):
+    '''
+    Input:
+    -manifest: dict, from write_manifest() or read_manifest()
+
+    Returns:
+    -string, hash of everything in the manifest. done markers carry it, so
+    shards done for another manifest (even one with the same shards, written
+    again) aren't taken as done
+    '''
+    content=dict((key,value) for key,value in manifest.items() if key!='hash')
+    return hashlib.sha1(json.dumps(content,sort_keys=True)).hexdigest()
+
+def read_manifest(manifest_file):
+    '''
+    Input:
+    -manifest_file: string, name of JSON manifest file from write_manifest()
+
+    Returns:
+    -dict, the manifest
+    '''
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def looper_arguments(manifest):
+    '''
+    Input:
+    -manifest: dict, from read_manifest()
+
+    Returns:
+    -list of strings, the file names
+    -dict of the other FileLooper arguments, with the reader class imported
+    '''
+    looper_args=dict((str(key),value) for key,value in
+        manifest['looper_args'].items())
+    if looper_args.get('reader') is not None:
+        looper_args['reader']=import_object(looper_args['reader'])
+    return [str(name) for name in manifest['file_names']],looper_args
+
+def make_looper(manifest,logging=False):
+    '''
+    Build a FileLooper with the files, arguments and setup of a manifest
+
+    Input:
+    -manifest: dict, from read_manifest()
+    -logging: bool, set to True for periodic useful output
+
+    Returns:
+    -FileLooper with its trigger and modules added
+    '''
+    file_names,looper_args=looper_arguments(manifest)
+    FL=FileLooper(file_names,manifest['tree_name'],logging=logging,**looper_args)
+    import_object(manifest['setup'])(FL)
+    return FL
+
+def run_shard(manifest_file,shard_id,chunk_size=10000,logging=False):
+    '''
+    Process one shard: loop over its entries (warming the trigger up on the
+    entries before them, see Trigger.warm_up), write its events to its
+    directory with an NPZWriter, and pickle its trigger and modules there,
+    before finish() is called on them, so merge_shards() can add them up,
+    along with the trigger state the shard started from. A done.json marker,
+    with the hash of the manifest, is written last, once everything else is
+    on disk
+
+    Input:
+    -manifest_file: string, name of JSON manifest file
+    -shard_id: int, which shard to process
+    -chunk_size: int, number of events the writer collects before writing
+    -logging: bool, set to True for periodic useful output
+    '''
+    start_time=time.time()
+    manifest=read_manifest(manifest_file)
+    shard=manifest['shards'][shard_id]
+    directory=shard['directory']
+    done_file=os.path.join(directory,'done.json')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    elif os.path.exists(done_file):
+        os.remove(done_file)
+    # events left over from an earlier attempt at this shard
+    for old in glob.glob(os.path.join(directory,'events','chunk_*.npz')):
+        os.remove(old)
+    FL=make_looper(manifest,logging)
+    FL.add_writer(NPZWriter(os.path.join(directory,'events'),chunk_size))
+    FL.loop(shard['n_entries'],shard['start'])
+    with open(os.path.join(directory,'state.pickle'),'wb') as f:
+        cPickle.dump((FL.trigger,FL.modules,FL.start_state),f,
+            cPickle.HIGHEST_PROTOCOL)
+    # written to a temporary name and renamed, so a marker is never half there
+    with open(done_file+'.tmp','w') as f:
+        json.dump({'id':shard_id,'manifest':manifest_hash(manifest),
+            'start':shard['start'],
+            'n_entries':shard['n_entries'],'n_events':FL.writer.n_events,
+            'seconds':time.time()-start_time},f)
+    os.rename(done_file+'.tmp',done_file)
+
+def unfinished_shards(manifest):
+    '''
+    Input:
+    -manifest: dict, from read_manifest()
+
+    Returns:
+    -list of ids of the shards without a done marker matching the manifest
+    '''
+    missing=[]
+    current=manifest_hash(manifest)
+    for shard in manifest['shards']:
+        done_file=os.path.join(shard['directory'],'done.json')
+        if not os.path.exists(done_file):
+            missing+=[shard['id']]
+            continue
+        with open(done_file) as f:
+            done=json.load(f)
+        if done.get('manifest')!=current or done['start']!=shard['start'] or\
+            done['n_entries']!=shard['n_entries']:
+            missing+=[shard['id']]
+    return missing
+
+def merge_shards(manifest_file,writer=None,logging=True,max_rerun=0.25):
+    '''
+    Merge the outputs of all shards, once every shard has finished: their
+    events are concatenated in shard order (and so in entry order) with new
+    EventIDs, and their triggers and modules are merged (see Module.merge), so
+    counters, timers and accumulated results are summed over the shards. As in
+    the ParallelLooper, a shard whose warm-up didn't end in the state the shard
+    before ended in is looped over again here, from that state (see
+    run_ranges); the merged looper's n_rerun counts these, and a warning is
+    printed when there are any
+
+    Input:
+    -manifest_file: string, name of JSON manifest file
+    -writer: Writer to stream the merged events to, or None to keep them in
+    the FileLooper's events
+    -logging: bool, set to True for periodic useful output
+    -max_rerun: float, fraction of the shards that may be looped over again.
+    more raise a RuntimeError, since they run one after the other here. None
+    for no limit
+
+    Returns:
+    -FileLooper with the merged events, trigger and modules. call finish() on
+    it for the summaries, and write_output() if there is no writer
+    '''
+    manifest=read_manifest(manifest_file)
+    missing=unfinished_shards(manifest)
+    if missing:
+        raise RuntimeError("%i of %i shards haven't finished: %s" % (len(missing),
+            len(manifest['shards']),', '.join(str(k) for k in missing)))
+    FL=make_looper(manifest,logging)
+    if writer is not None:
+        FL.add_writer(writer)
+    FL.events.declare(FL.schema())
+    file_names,looper_args=looper_arguments(manifest)
+    setup=import_object(manifest['setup'])
+    tasks=[(file_names,manifest['tree_name'],looper_args,setup,shard['start'],
+        shard['n_entries']) for shard in manifest['shards']]
+    FL.n_rerun=0
+    n_events=0
+    results=run_ranges(tasks,(shard_result(shard) for shard in manifest['shards']),
+        logging,max_rerun)
+    for shard,(rerun,(columns,trigger,modules,state)) in\
+        itertools.izip(manifest['shards'],results):
+        FL.n_rerun+=rerun
+        FL.trigger.merge(trigger)
+        for name in FL.modules:
+            FL.modules[name].merge(modules[name])
+        if columns:
+            FL.store(EventBlock(columns))
+            FL.flush()
+            n_events+=len(columns.values()[0])
+        if logging:
+            print "Merged shard %i / %i" % (shard['id']+1,len(manifest['shards']))
+    FL.flush(final=True)
+    if FL.n_rerun:
+        print "Warning: %i of %i shards were looped over again while merging" %\
+            (FL.n_rerun,len(manifest['shards']))
+    if logging:
+        print "Merged %i events from %i shards" % (n_events,len(manifest['shards']))
+    return FL
+
+def shard_result(shard):
+    '''
+    Read back the output of a finished shard
+
+    Input:
+    -shard: dict, one of the shards of a manifest
+
+    Returns:
+    -the same as run_range(): dict of arrays, the columns of the shard's events
+    without EventID, its trigger, dict of its modules, and the trigger state it
+    started from
+    '''
+    with open(os.path.join(shard['directory'],'state.pickle'),'rb') as f:
+        trigger,modules,state=cPickle.load(f)
+    events=NPZWriter.read(os.path.join(shard['directory'],'events'))
+    columns=dict((name,events[name]) for name in events.dtype.names
+        if name!='EventID') if len(events) else {}
+    return columns,trigger,modules,state
+
+def run_local(manifest_file,n_processes=1,chunk_size=10000):
+    '''
+    Run every shard of a manifest on this machine, each in a separate Python
+    process as on a batch system, n_processes at a time. Shards that already
+    finished are skipped, so this also resumes a partly finished run
+
+    Input:
+    -manifest_file: string, name of JSON manifest file
+    -n_processes: int, number of shard processes to run at once
+    -chunk_size: int, number of events the writers collect before writing
+
+    Returns:
+    -list of ids of the shards whose process failed
+    '''
+    manifest=read_manifest(manifest_file)
+    todo=unfinished_shards(manifest)
+    # shard processes need to import Calamari and the setup module like we do
+    env=dict(os.environ)
+    env['PYTHONPATH']=os.pathsep.join([path or os.getcwd() for path in sys.path])
+    running=[]
+    failed=[]
+    while todo or running:
+        while todo and len(running)<n_processes:
+            k=todo.pop(0)
+            command='import Calamari; Calamari.run_shard(%r,%i,%i)' %\
+                (manifest_file,k,chunk_size)
+            running+=[(k,subprocess.Popen([sys.executable,'-c',command],env=env))]
+        time.sleep(0.05)
+        for k,process in list(running):
+            if process.poll() is not None:
+                running.remove((k,process))
+                if process.returncode!=0:
+                    failed+=[k]
+    return failed
@@ -0,0 +1,162 @@
+import os
+import glob
+import numpy
+
+class WaveformStore(object):
+    '''
+    Compressed, chunked store for event waveforms, kept apart from the table of
+    scalar event data and linked to it by EventID. The FileLooper moves the
+    waveform fields it is given into the store, so the event table stays small.
+
+    Waveforms are stored as float32 by default, so float64 waveforms are rounded
+    to float32 on the way in; pass dtype=numpy.float64 to keep them exactly. The
+    samples are then delta-encoded without further loss: the bits of each
+    sample are read as an integer, and each sample is stored as the difference
+    from the previous one. Neighbouring samples of a slowly
+    varying waveform differ in only the low bits, so the deltas compress well.
+    Every chunk_size events are written to one zip-compressed .npz file.
+    '''
+    def __init__(self,directory,fields,chunk_size=1000,dtype=numpy.float32):
+        '''
+        Input:
+        -directory: string, directory to write the chunk files to
+        -fields: list of strings, names of the waveform fields to store
+        -chunk_size: int, number of events in each chunk file
+        -dtype: numpy float dtype to store the samples as. waveforms are
+        rounded to it, so float64 waveforms are only read back exactly with
+        numpy.float64
+        '''
+        self.directory=directory
+        self.fields=list(fields)
+        self.chunk_size=chunk_size
+        self.dtype=numpy.dtype(dtype)
+        # integer type with the same size as dtype, for delta encoding
+        self.int_dtype=numpy.dtype('i%i' % self.dtype.itemsize)
+        self.pending_ids=[]
+        self.pending={}
+        self.n_pending=0
+        self.n_chunks=0
+        # first and last EventID in each chunk file, for reading back
+        self.chunk_ids=None
+
+    def encode(self,waveforms):
+        '''
+        Input:
+        -waveforms: 2D array, one waveform per row
+
+        Returns:
+        -2D integer array, delta-encoded samples
+        '''
+        bits=numpy.ascontiguousarray(waveforms,dtype=self.dtype).view(self.int_dtype)
+        deltas=numpy.empty_like(bits)
+        deltas[:,0]=bits[:,0]
+        # differences wrap around, and cumsum() wraps back the same way
+        numpy.subtract(bits[:,1:],bits[:,:-1],out=deltas[:,1:])
+        return deltas
+
+    def decode(self,deltas):
+        '''
+        Input:
+        -deltas: 2D integer array, from encode()
+
+        Returns:
+        -2D array, the waveforms
+        '''
+        return deltas.cumsum(axis=1,dtype=deltas.dtype).view(self.dtype)
+
+    def append(self,event_ids,waveforms):
+        '''
+        Add the waveforms of some events
+
+        Input:
+        -event_ids: array of ints, EventID of each event
+        -waveforms: dict of 2D arrays (one row per event), keyed by field name
+        '''
+        if len(event_ids)==0:
+            return
+        if self.n_chunks==0 and self.n_pending==0:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            for old in glob.glob(os.path.join(self.directory,'chunk_*.npz')):
+                os.remove(old)
+        self.pending_ids+=[numpy.asarray(event_ids)]
+        for name in self.fields:
+            self.pending.setdefault(name,[]).append(
+                numpy.array(waveforms[name],dtype=self.dtype,ndmin=2))
+        self.n_pending+=len(event_ids)
+        if self.n_pending>=self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the waveforms collected so far to a chunk file
+        '''
+        if self.n_pending==0:
+            return
+        arrays={'EventID':numpy.concatenate(self.pending_ids)}
+        for name in self.fields:
+            arrays[name]=self.encode(numpy.concatenate(self.pending[name]))
+        numpy.savez_compressed(os.path.join(self.directory,
+            'chunk_%06i.npz' % self.n_chunks),dtype=str(self.dtype),**arrays)
+        self.n_chunks+=1
+        self.pending_ids=[]
+        self.pending={}
+        self.n_pending=0
+        self.chunk_ids=None
+
+    def close(self):
+        '''
+        Write out the last, partial chunk
+        '''
+        self.flush()
+
+    def chunk_files(self):
+        return sorted(glob.glob(os.path.join(self.directory,'chunk_*.npz')))
+
+    def read(self,name,event_ids=None):
+        '''
+        Read waveforms back from the chunk files
+
+        Input:
+        -name: string, name of the waveform field
+        -event_ids: int or array of ints, EventIDs of the events to read. None
+        to read all events
+
+        Returns:
+        -2D array with the waveform of each event, in the order of event_ids (or
+        of the store), or a 1D array for a single int EventID
+        '''
+        single=numpy.ndim(event_ids)==0 and event_ids is not None
+        if self.chunk_ids is None:
+            self.chunk_ids=[]
+            for chunk in self.chunk_files():
+                with numpy.load(chunk) as f:
+                    ids=f['EventID']
+                    self.chunk_ids+=[(chunk,ids.min(),ids.max())]
+        wanted=None if event_ids is None else numpy.atleast_1d(event_ids)
+        ids,waveforms=[],[]
+        for chunk,first,last in self.chunk_ids:
+            if wanted is not None and not ((wanted>=first)&(wanted<=last)).any():
+                continue
+            with numpy.load(chunk) as f:
+                chunk_ids=f['EventID']
+                rows=slice(None) if wanted is None else\
+                    numpy.flatnonzero(numpy.in1d(chunk_ids,wanted))
+                self.dtype=numpy.dtype(str(f['dtype']))
+                self.int_dtype=numpy.dtype('i%i' % self.dtype.itemsize)
+                ids+=[chunk_ids[rows]]
+                waveforms+=[self.decode(f[name][rows])]
+        if not ids:
+            raise KeyError("no %s waveforms for those events in %s" %
+                (name,self.directory))
+        ids=numpy.concatenate(ids)
+        waveforms=numpy.concatenate(waveforms)
+        if wanted is not None:
+            order=numpy.argsort(ids)
+            found=numpy.searchsorted(ids,wanted,sorter=order)
+            if (found>=len(ids)).any() or (ids[order[numpy.minimum(found,
+                len(ids)-1)]]!=wanted).any():
+                raise KeyError("some events have no %s waveform in %s" %
+                    (name,self.directory))
+            waveforms=waveforms[order[found]]
+        return waveforms[0] if single else waveforms
@@ -0,0 +1,186 @@
+import os
+import numpy
+from reader import write_memmap_store
+try:
+    import root_numpy
+except ImportError:
+    root_numpy=None
+
+def pulse_shape(n_samples,dt_sample,rise_time,decay_time):
+    '''
+    Input:
+    -n_samples: int, length of the pulse
+    -dt_sample: float, time interval of one sample
+    -rise_time: float, rise time constant in seconds
+    -decay_time: float, decay time constant in seconds
+
+    Returns:
+    -array, thermal pulse exp(-t/decay)-exp(-t/rise), scaled to a peak of 1
+    '''
+    t=numpy.arange(n_samples)*dt_sample
+    shape=numpy.exp(-t/decay_time)-numpy.exp(-t/rise_time)
+    return shape/shape.max()
+
+def heater_data(n_pairs,n_samples=2000,dt_sample=1e-5,heater_channel=1,
+    bolometer_channel=0,baseline=0.1,noise=1e-4,heater_amplitudes=(0.05,0.1),
+    heater_width=2e-4,fraction_pulsed=0.9,gain=0.2,rise_time=5e-5,
+    decay_time=2e-3,seed=0):
+    '''
+    Make heater pulser data the way the HeaterTrigger expects it: each bolometer
+    entry is followed by a heater entry taken at the same time. Most heater
+    entries have a negative square pulse, and the bolometer entry a thermal
+    pulse starting at the same sample, with an amplitude proportional to the
+    heater's
+
+    Input:
+    -n_pairs: int, number of bolometer/heater entry pairs
+    -n_samples: int, samples per entry
+    -dt_sample: float, time interval of one sample
+    -heater_channel, bolometer_channel: ints, Ch of the heater and bolometer entries
+    -baseline: float, bolometer baseline voltage
+    -noise: float, rms of the white noise on both channels
+    -heater_amplitudes: list of floats, heater pulse heights to draw from
+    -heater_width: float, length of the heater pulse in seconds
+    -fraction_pulsed: float, fraction of pairs with a heater pulse
+    -gain: float, bolometer pulse amplitude per volt of heater pulse
+    -rise_time, decay_time: floats, time constants of the bolometer pulse
+    -seed: int, random seed
+
+    Returns:
+    -dict of arrays with the Waveform, Ch, t_s, t_mus and dt_s branches, and
+    truth arrays with one value per pair: Pulsed, PulseStart and Amplitude
+    (of the heater pulse)
+    '''
+    r=numpy.random.RandomState(seed)
+    waveforms=numpy.empty((2*n_pairs,n_samples))
+    waveforms[0::2]=baseline+noise*r.randn(n_pairs,n_samples)
+    waveforms[1::2]=noise*r.randn(n_pairs,n_samples)
+    width=max(int(round(heater_width/dt_sample)),1)
+    pulsed=r.rand(n_pairs)<fraction_pulsed
+    starts=r.randint(0,n_samples-width,n_pairs)
+    amplitudes=numpy.where(pulsed,r.choice(heater_amplitudes,n_pairs),0.)
+    shape=pulse_shape(n_samples,dt_sample,rise_time,decay_time)
+    for j in numpy.flatnonzero(pulsed):
+        start=starts[j]
+        waveforms[2*j+1,start:start+width]-=amplitudes[j]
+        waveforms[2*j,start:]+=gain*amplitudes[j]*shape[:n_samples-start]
+    # entries are read out back to back
+    times=numpy.arange(n_pairs)*n_samples*dt_sample
+    t_s=numpy.floor(times).astype(numpy.int64)
+    t_mus=numpy.round((times-t_s)*1e6).astype(numpy.int64)
+    return {'Waveform':waveforms,
+        'Ch':numpy.tile([bolometer_channel,heater_channel],n_pairs),
+        't_s':numpy.repeat(t_s,2),'t_mus':numpy.repeat(t_mus,2),
+        'dt_s':numpy.repeat(dt_sample,2*n_pairs),
+        'Pulsed':pulsed,'PulseStart':starts,'Amplitude':amplitudes}
+
+def background_data(n_entries,n_samples=10000,dt_sample=1e-4,channel=0,
+    baseline=0.3,noise=1e-3,pulse_rate=3.,amplitude_range=(1e-3,1e-2),
+    rise_time=5e-4,decay_time=8e-3,lock_loss_rate=0.,lock_loss_time=0.1,
+    lock_loss_level=None,seed=0):
+    '''
+    Make a continuous "background" stream for the SimpleTrigger and
+    MatchedFilterTrigger: white noise on a baseline, with thermal pulses at
+    random times (which can straddle entries), and optionally flat stretches
+    where the SQUID lost lock and the readout sits at a fixed level
+
+    Input:
+    -n_entries: int, number of entries
+    -n_samples: int, samples per entry
+    -dt_sample: float, time interval of one sample
+    -channel: int, Ch of the entries
+    -baseline: float, baseline voltage
+    -noise: float, rms of the white noise
+    -pulse_rate: float, mean number of pulses per second
+    -amplitude_range: (min, max) floats, pulse heights are drawn uniformly
+    in log between these
+    -rise_time, decay_time: floats, time constants of the pulses
+    -lock_loss_rate: float, mean number of lock losses per second
+    -lock_loss_time: float, length of each lock loss in seconds
+    -lock_loss_level: float, readout level during a lock loss. None for the
+    baseline plus 100 times the noise
+    -seed: int, random seed
+
+    Returns:
+    -dict of arrays with the Waveform, Ch, t_s, t_mus and dt_s branches, and
+    truth arrays: PulseSample and Amplitude with one value per pulse (sample
+    counted from the start of the stream), and LockLossStart and LockLossStop
+    with one value per lock loss
+    '''
+    r=numpy.random.RandomState(seed)
+    n_total=n_entries*n_samples
+    stream=baseline+noise*r.randn(n_total)
+    duration=n_total*dt_sample
+    n_pulses=r.poisson(pulse_rate*duration)
+    samples=numpy.sort(r.randint(0,n_total,n_pulses))
+    amplitudes=numpy.exp(r.uniform(numpy.log(amplitude_range[0]),
+        numpy.log(amplitude_range[1]),n_pulses))
+    shape=pulse_shape(int(10*decay_time/dt_sample),dt_sample,rise_time,decay_time)
+    for sample,amplitude in zip(samples,amplitudes):
+        n=min(len(shape),n_total-sample)
+        stream[sample:sample+n]+=amplitude*shape[:n]
+    n_losses=r.poisson(lock_loss_rate*duration)
+    loss_starts=numpy.sort(r.randint(0,n_total,n_losses))
+    loss_stops=numpy.minimum(loss_starts+int(round(lock_loss_time/dt_sample)),
+        n_total)
+    if lock_loss_level is None:
+        lock_loss_level=baseline+100*noise
+    for start,stop in zip(loss_starts,loss_stops):
+        stream[start:stop]=lock_loss_level
+    times=numpy.arange(n_entries)*n_samples*dt_sample
+    t_s=numpy.floor(times).astype(numpy.int64)
+    return {'Waveform':stream.reshape(n_entries,n_samples),
+        'Ch':numpy.repeat(channel,n_entries),'t_s':t_s,
+        't_mus':numpy.round((times-t_s)*1e6).astype(numpy.int64),
+        'dt_s':numpy.repeat(dt_sample,n_entries),
+        'PulseSample':samples,'Amplitude':amplitudes,
+        'LockLossStart':loss_starts,'LockLossStop':loss_stops}
+
+def write_synthetic(path,data,n_files=1,file_format='memmap',tree_name='data_tree',
+    entry_step=1):
+    '''
+    Write synthetic data (or any dict of branch arrays) to files in a format
+    the FileLooper reads
+
+    Input:
+    -path: string, directory to write the files to. it is created if needed
+    -data: dict of arrays from heater_data() or background_data(). only the
+    Waveform, Ch, t_s, t_mus and dt_s branches are written
+    -n_files: int, number of files to split the entries over
+    -file_format: string, 'memmap' for MemmapReader stores (see write_memmap_store),
+    or 'root' for ROOT files for the TChain and TreeReader (needs root_numpy)
+    -tree_name: string, name of the tree in ROOT files
+    -entry_step: int, files only split at multiples of this many entries. 2
+    keeps heater/bolometer pairs together
+
+    Returns:
+    -list of strings, the file names, in order
+    '''
+    if file_format not in ['memmap','root']:
+        raise ValueError("unknown format %s" % file_format)
+    if file_format=='root' and root_numpy is None:
+        raise ImportError("writing ROOT files needs root_numpy")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    n_steps=len(data['Waveform'])/entry_step
+    bounds=[entry_step*(n_steps*k/n_files) for k in range(n_files)]+\
+        [len(data['Waveform'])]
+    file_names=[]
+    for k in range(n_files):
+        rows=slice(bounds[k],bounds[k+1])
+        if file_format=='memmap':
+            name=os.path.join(path,'%04i' % k)
+            write_memmap_store(name,data['Waveform'][rows],data['Ch'][rows],
+                data['t_s'][rows],data['t_mus'][rows],data['dt_s'][rows])
+        else:
+            name=os.path.join(path,'%04i.root' % k)
+            waveforms=data['Waveform'][rows]
+            out=numpy.empty(len(waveforms),dtype=[
+                ('Waveform',numpy.float64,(waveforms.shape[1],)),
+                ('Ch',numpy.int32),('t_s',numpy.int64),('t_mus',numpy.int64),
+                ('dt_s',numpy.float64)])
+            for field in out.dtype.names:
+                out[field]=data[field][rows]
+            root_numpy.array2root(out,name,tree_name,mode='recreate')
+        file_names+=[name]
+    return file_names
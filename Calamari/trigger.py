@@ -1,8 +1,10 @@
-import ROOT
+import math
 import numpy
 from base import *
+from buffer import *
+from reader import scan_entries
 
-class SimpleTrigger(Module):
+class SimpleTrigger(Trigger):
     '''
     Module to loop through waveforms in chunks, trigger on pieces of waveforms
     that are a certain number of standard deviations above the mean baseline,
@@ -10,6 +12,14 @@ class SimpleTrigger(Module):
     as an "event". This is meant for "background" data, ie. data where every entry
     in the TChain is bolometer data, not interspersed with heater waveforms
     '''
+    # the baseline comes from the strides of the previous two entries that
+    # weren't skipped after a trigger, which after a lot of triggers reach
+    # further back. warm_up() starts this many entries back, and goes back
+    # further (up to max_warmup_entries) until it ends in the same state from
+    # two starting points
+    warmup_entries=3
+    max_warmup_entries=48
+
     def __init__(self,name,dt_trigger,dt_sample,n_samples,n_sigma,readout_length):
         '''
         Inputs:
@@ -27,13 +37,157 @@ class SimpleTrigger(Module):
         self.dt_sample=dt_sample
         self.n_samples=int(n_samples)
         self.n_sigma=n_sigma
-        # daq_buffer contains daq data from the previous two entries
-        self.daq_buffer=numpy.zeros(2*n_samples)
         self.readout_length=readout_length
-        self.stride=self.dt_trigger/self.dt_sample
+        self.stride=int(round(self.dt_trigger/self.dt_sample))
+        if self.n_samples%self.stride!=0:
+            raise ValueError("n_samples (%i) must be a multiple of the trigger "
+                "stride (%i samples)" % (self.n_samples,self.stride))
+        # number of strides in one TChain entry
+        self.n_strides=self.n_samples/self.stride
+        self.window=int(round(self.readout_length/self.dt_sample))
+        if self.window/2>self.n_samples:
+            raise ValueError("readout window can't reach beyond the neighbouring "
+                "entries")
+        # previous, current and next entries, readout windows are cut from here.
+        # the buffer reads through the cache, which also holds the scalar
+        # branches of the current entry for the event times
+        self.cache=EntryCache(4)
+        self.buffer=StitchedBuffer(1,self.cache)
+        # the baseline is built from the strides of the previous two entries.
+        # instead of keeping those samples around, keep the sum and sum of squares
+        # of each stride in a ring buffer, plus running totals over the ring
+        self.n_slots=2*self.n_strides
+        self.stride_sums=numpy.zeros(self.n_slots)
+        self.stride_sumsqs=numpy.zeros(self.n_slots)
+        self.total_sum=0.
+        self.total_sumsq=0.
+        # ring position of the newest stride
+        self.slot=self.n_slots-1
+        # sums are taken relative to this offset (set from the first stride) to
+        # avoid cancellation when computing the variance of a large DC baseline
+        self.offset=None
         super(SimpleTrigger,self).__init__(name)
 
-    #TODO: could probably cache means of strides to calc full mean more efficiently
+    def reset_baseline(self,offset):
+        '''
+        Fill the ring buffer as if the previous two entries were all zeros, with
+        sums taken relative to a new offset
+
+        Input:
+        -offset: float, voltage subtracted from every sample before summing
+        '''
+        self.offset=offset
+        self.stride_sums[:]=-offset*self.stride
+        self.stride_sumsqs[:]=offset*offset*self.stride
+        self.total_sum=self.stride_sums.sum()
+        self.total_sumsq=self.stride_sumsqs.sum()
+
+    def add_stride(self,stride_sum,stride_sumsq):
+        '''
+        Push the sum and sum of squares of a new stride into the ring buffer,
+        dropping the oldest stride
+
+        Input:
+        -stride_sum: float, sum of (sample-offset) over the stride
+        -stride_sumsq: float, sum of (sample-offset)**2 over the stride
+        '''
+        self.slot=(self.slot+1)%self.n_slots
+        self.total_sum+=stride_sum-self.stride_sums[self.slot]
+        self.total_sumsq+=stride_sumsq-self.stride_sumsqs[self.slot]
+        self.stride_sums[self.slot]=stride_sum
+        self.stride_sumsqs[self.slot]=stride_sumsq
+
+    def resum(self):
+        '''
+        Recompute the running totals from the ring buffer. Done at the start of
+        each entry, so rounding errors from the running updates don't accumulate,
+        and the totals only depend on what is in the ring, not on where it starts
+        '''
+        self.total_sum=math.fsum(self.stride_sums)
+        self.total_sumsq=math.fsum(self.stride_sumsqs)
+
+    def stride_sums_of(self,wf):
+        '''
+        Input:
+        -wf: array, waveform of one entry
+
+        Returns:
+        -array, sum of (sample-offset) over each stride of the entry
+        -array, sum of (sample-offset)**2 over each stride of the entry
+        '''
+        strides=wf.reshape(self.n_strides,self.stride)-self.offset
+        return strides.sum(axis=1),(strides*strides).sum(axis=1)
+
+    def fill_ring(self,chain,first):
+        '''
+        Fill the ring buffer with the strides of the two entries before an
+        entry, as if nothing had triggered in them
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -first: int, position in TChain of the entry after the two
+        '''
+        for i in [first-2,first-1]:
+            if i>=0:
+                stride_sums,stride_sumsqs=self.stride_sums_of(
+                    self.buffer.fetch(chain,i))
+            else:
+                # entries before the first are zeros, with exactly the sums
+                # reset_baseline() gives them, as in a loop from the first entry
+                stride_sums=numpy.repeat(-self.offset*self.stride,self.n_strides)
+                stride_sumsqs=numpy.repeat(self.offset*self.offset*self.stride,
+                    self.n_strides)
+            for j in xrange(self.n_strides):
+                self.add_stride(stride_sums[j],stride_sumsqs[j])
+
+    def warm_up(self,chain,start):
+        '''
+        Take the baseline offset from the first entry, and run execute() on the
+        entries before start, from a ring buffer filled with the two entries
+        before those. Start twice as far back until two warm-ups end in the same
+        state (see state()), so the triggers in the warm-up entries have made up
+        for the guess at the ring buffer
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -start: int, first entry the loop will visit
+        '''
+        if self.offset is None:
+            self.reset_baseline(self.buffer.fetch(chain,0)[:self.stride].mean())
+        counter=self.counter
+        self.noise_paused=True
+        n_entries=self.warmup_entries
+        last_state=None
+        while True:
+            first=max(0,start-n_entries)
+            self.fill_ring(chain,first)
+            self.noise_spill=0
+            for i in xrange(first,start):
+                self.execute(chain,i)
+            state=self.state()
+            if first==0 or state==last_state or n_entries>=self.max_warmup_entries:
+                break
+            last_state=state
+            n_entries*=2
+        self.noise_paused=False
+        self.counter=counter
+
+    def state(self):
+        '''
+        Returns:
+        -tuple of the baseline offset, noise_spill, and the stride sums and sums
+        of squares in the ring buffer, oldest first
+        '''
+        order=numpy.roll(numpy.arange(self.n_slots),-(self.slot+1))
+        return (self.offset,self.noise_spill,tuple(self.stride_sums[order]),
+            tuple(self.stride_sumsqs[order]))
+
+    def set_state(self,state):
+        self.offset,self.noise_spill,stride_sums,stride_sumsqs=state
+        self.stride_sums[:]=stride_sums
+        self.stride_sumsqs[:]=stride_sumsqs
+        self.slot=self.n_slots-1
+
     def trigger(self):
         '''
         Apply trigger condition
@@ -41,41 +195,41 @@ class SimpleTrigger(Module):
         Returns:
         -bool, True if trigger was triggered
         '''
-        # mean and std calculated using the waveform buffer up to the current chunk
-        mean=numpy.mean(self.daq_buffer[:-self.stride])
-        std=numpy.std(self.daq_buffer[:-self.stride])
-        return numpy.mean(self.daq_buffer[-self.stride:])>mean+self.n_sigma*std
+        # mean and std calculated using the strides in the ring buffer up to
+        # the current one
+        n=(self.n_slots-1)*self.stride
+        mean=(self.total_sum-self.stride_sums[self.slot])/n
+        var=(self.total_sumsq-self.stride_sumsqs[self.slot])/n-mean*mean
+        std=numpy.sqrt(max(var,0.))
+        return self.stride_sums[self.slot]/self.stride>mean+self.n_sigma*std
 
-    def build_event(self,chain,i,j):
+    def build_event(self,j,entry):
         '''
         Extract a sub-piece of the waveform around the triggered chunk
+
+        Input:
+        -j: int, index of the triggered chunk in the current entry
+        -entry: DecodedEntry of the current entry
+
+        Returns:
+        -dict, event with the time of its first sample, the sample interval, the
+        readout window as a view of the stitched buffer, and the same window of
+        each stream-filtered waveform
+        -int, index of the chunk to continue looking for triggers from
         '''
-        # put extracted waveform here
-        waveform=numpy.zeros(self.readout_length/self.dt_sample)
-        # indices of TChain waveform to start/end extraction
-        start=int(j*self.stride-self.readout_length/2/self.dt_sample)
-        end=int(j*self.stride+self.readout_length/2/self.dt_sample)
-        if start>0 and end<=self.n_samples:
-            waveform=numpy.array(chain.Waveform[start:end])
-        elif start<0:
-            # if readout start falls in previous waveform, go back 1 entry in chain
-            waveform[-1*start:]=chain.Waveform[:end]
-            chain.GetEntry(i-1)
-            waveform[:-1*start]=chain.Waveform[self.n_samples+start:]
-        elif end>=n_samples:
-            # if readout end falls in next waveform, go forward 1 entry in chain
-            waveform[:self.n_samples-start]=chain.Waveform[start:]
-            chain.GetEntry(i+1)
-            waveform[self.n_samples-start:]=chain.Waveform[:end-self.n_samples]
+        # readout window may start in the previous or end in the next entry,
+        # the stitched buffer holds both
+        start=j*self.stride-self.window/2
+        event={'Waveform':self.buffer.window(start,start+self.window)}
+        event.update(self.buffer.filtered_windows(start,start+self.window))
+        event['Time']=entry.t_s+entry.t_mus*1e-6+start*self.dt_sample
+        event['dt_sample']=entry.dt_s
+        self.locate_event(event,self.buffer.i,start,self.window)
 
         # skip ahead in waveform to after readout window before once again looking
         # for chunks to trigger
-        #TODO: eek, if readout_length, n_samples, and stride don't all match up,
-        # this will cause stride to be shifted, may not be divisible into n_samples
-        # evenly, and inner loop below (j) could try to read beyond end of waveform
         j_out=j+int(self.readout_length/2/self.dt_sample/self.stride)
-        chain.GetEntry(i)
-        return waveform, j_out
+        return event, j_out
 
     @Module._execute
     def execute(self,chain,i):
@@ -88,42 +242,239 @@ class SimpleTrigger(Module):
         Input:
         -chain: ROOT TChain holding SQUID data
         -i: int, current position in TChain
+
+        Returns:
+        -list of event dicts, one for each trigger in this entry
         '''
-        chain.GetEntry(i)
+        self.buffer.load(chain,i)
+        wf=self.buffer.current()
+        entry=self.cache.get(chain,i)
+        if self.offset is None:
+            self.reset_baseline(wf[:self.stride].mean())
+        self.resum()
+        # sums and sums of squares of every stride in this entry, in one pass
+        stride_sums,stride_sumsqs=self.stride_sums_of(wf)
         # we look at chunks in waveform of length self.stride
         # j is the index to loop through chunks of waveform
         j=0
         events=[]
-        while j < self.n_samples/self.stride:
-            # shift daq_buffer left, fill end with current stride
-            self.daq_buffer[:-self.stride]=self.daq_buffer[self.stride:]
-            start=int(self.stride*j)
-            end=int(self.stride*(j+1))
-            self.daq_buffer[-self.stride:]=chain.Waveform[start:end]
+        windows=[]
+        while j < self.n_strides:
+            self.add_stride(stride_sums[j],stride_sumsqs[j])
             # if current stride satisfies trigger condition, read out waveform
             # and form event
             if self.trigger():
-                wf,j_out=self.build_event(chain,i,j)
-                events+=[{'Waveform':wf}]
-                j=j_out
-                #TODO: add other event data (times, etc.) to dict!
-                print "got event!"
+                start=j*self.stride-self.window/2
+                windows+=[(start,start+self.window)]
+                event,j=self.build_event(j,entry)
+                events+=[event]
             else:
                 j+=1
-        if len(events)==0:
-            return False
-        elif len(events)==1:
-            return events[0]
-        elif len(events)>1:
-            #TODO: need to figure out how to put multiple events back into
-            # control flow for FileLooper.loop() to deal with...
-            return events[0]
+        self.accumulate_noise(wf,windows,self.dt_sample)
+        return events
+
+    def stream_buffers(self):
+        return {'Waveform':self.buffer}
+
+    def config(self):
+        return {'dt_trigger':self.dt_trigger,'dt_sample':self.dt_sample,
+            'n_samples':self.n_samples,'n_sigma':self.n_sigma,
+            'readout_length':self.readout_length}
+
+    def schema(self):
+        return {'Time':float,'dt_sample':float,'Waveform':float}
 
     @Module._finish
     def finish(self):
         pass
 
-class HeaterTrigger(Module):
+class MatchedFilterTrigger(Trigger):
+    '''
+    Module to trigger on pulses with a matched filter. Each entry in the TChain
+    is correlated with a pulse template in one FFT pass, and the trigger fires on
+    peaks in the filtered stream that are a certain number of standard deviations
+    above its noise. The end of the previous entry is carried into the filter of
+    the current one (overlap-save), so the filtered stream is continuous across
+    entries and pulses straddling two entries are still found. Like the
+    SimpleTrigger, this is meant for "background" data
+    '''
+    # the dead time after a trigger can reach back into the previous entries
+    warmup_entries=2
+    def __init__(self,name,template,dt_sample,n_samples,n_sigma,readout_length):
+        '''
+        Inputs:
+        -name: string name of module
+        -template: array, pulse shape to search for, sampled every dt_sample. only
+        the shape matters, the template is normalized to zero mean and unit norm,
+        so the filter ignores the baseline voltage
+        -dt_sample: float, time interval of one sample in the waveform
+        -n_samples: int, number of samples in waveform in TChain
+        -n_sigma: float, trigger threshold in number of standard deviations of the
+        filtered stream above its median
+        -readout_length: float, time in seconds corresponding to how much of the
+        waveform around the pulse peak to read out
+        '''
+        template=numpy.array(template,dtype=float)
+        template-=template.mean()
+        norm=numpy.sqrt(numpy.sum(template**2))
+        if norm==0:
+            raise ValueError("template must not be flat")
+        self.template=template/norm
+        self.n_template=len(self.template)
+        # position of the pulse peak within the template, the readout window is
+        # centered on it
+        self.template_peak=int(numpy.argmax(self.template))
+        self.dt_sample=dt_sample
+        self.n_samples=int(n_samples)
+        self.n_sigma=n_sigma
+        self.readout_length=readout_length
+        self.window=int(round(self.readout_length/self.dt_sample))
+        if self.window/2+self.n_template>self.n_samples:
+            raise ValueError("template plus half the readout window must fit "
+                "in one entry")
+        # FFT length covering one entry plus the overlap from the previous one.
+        # the template spectrum only has to be computed once
+        self.n_fft=2**int(numpy.ceil(numpy.log2(self.n_samples+self.n_template-1)))
+        self.template_fft=numpy.conj(numpy.fft.rfft(self.template,self.n_fft))
+        # previous, current and next entries, for the overlap and for readout
+        # windows that spill into a neighbouring entry
+        self.buffer=StitchedBuffer()
+        # position of the last trigger, in samples from the start of the TChain
+        self.last_trigger=None
+        super(MatchedFilterTrigger,self).__init__(name)
+
+    def filter(self,first):
+        '''
+        Correlate the current entry in the buffer with the template
+
+        Input:
+        -first: bool, True if there is no entry before the current one
+
+        Returns:
+        -array, filtered stream for the current entry. element k is the overlap
+        of the template with the waveform starting at sample k-(n_template-1)
+        '''
+        if first:
+            # nothing came before the first entry, so extend its first sample
+            # backwards rather than padding with a step from zero. execute()
+            # ignores peaks from this part of the stream
+            wf=self.buffer.current()
+            data=numpy.concatenate((numpy.repeat(wf[0],self.n_template-1),wf))
+        else:
+            data=self.buffer.window(1-self.n_template,self.n_samples)
+        filtered=numpy.fft.irfft(numpy.fft.rfft(data,self.n_fft)*self.template_fft,
+            self.n_fft)
+        return filtered[:self.n_samples]
+
+    def find_peaks(self,filtered,thresh):
+        '''
+        Find the maximum of each stretch of the filtered stream above threshold
+
+        Input:
+        -filtered: array, filtered stream for the current entry
+        -thresh: float, trigger threshold
+
+        Returns:
+        -list of ints, indices of the peaks in the filtered stream
+        '''
+        above=numpy.concatenate(([False],filtered>thresh,[False]))
+        edges=numpy.flatnonzero(above[1:]!=above[:-1])
+        return [start+int(numpy.argmax(filtered[start:end]))
+            for start,end in zip(edges[::2],edges[1::2])]
+
+    def build_event(self,center):
+        '''
+        Extract a sub-piece of the waveform centered on a triggered pulse
+
+        Input:
+        -center: int, index in the current entry of the pulse peak. can be
+        negative if the pulse peaked in the previous entry
+
+        Returns:
+        -dict, event with the view of the stitched buffer covering the readout
+        window, and the same window of each stream-filtered waveform
+        '''
+        start=center-self.window/2
+        event={'Waveform':self.buffer.window(start,start+self.window)}
+        event.update(self.buffer.filtered_windows(start,start+self.window))
+        self.locate_event(event,self.buffer.i,start,self.window)
+        return event
+
+    @Module._execute
+    def execute(self,chain,i):
+        '''
+        Do this on each entry in TChain. Filters the whole entry with the template,
+        estimates the noise of the filtered stream, and reads out a window around
+        each peak above threshold.
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -i: int, current position in TChain
+
+        Returns:
+        -list of event dicts, one for each trigger in this entry
+        '''
+        self.buffer.load(chain,i)
+        first=i==0
+        filtered=self.filter(first)
+        # noise from the median absolute deviation, so pulses in the entry
+        # don't inflate the threshold
+        median=numpy.median(filtered)
+        noise=1.4826*numpy.median(numpy.abs(filtered-median))
+        events=[]
+        windows=[]
+        for k in self.find_peaks(filtered,median+self.n_sigma*noise):
+            if first and k<self.n_template-1:
+                # template overlaps the padding before the first entry
+                continue
+            center=k-(self.n_template-1)+self.template_peak
+            # like SimpleTrigger, don't trigger again within half a readout
+            # window of the last trigger
+            position=i*self.n_samples+center
+            if self.last_trigger is not None and\
+                position-self.last_trigger<=self.window/2:
+                continue
+            self.last_trigger=position
+            windows+=[(center-self.window/2,center-self.window/2+self.window)]
+            event=self.build_event(center)
+            event['MatchedFilterSNR']=filtered[k]/noise
+            events+=[event]
+        self.accumulate_noise(self.buffer.current(),windows,self.dt_sample)
+        return events
+
+    def state(self):
+        '''
+        Returns:
+        -tuple of the position of the last trigger, if it is close enough to
+        the next entry to hold off a trigger there, and noise_spill
+        '''
+        last_trigger=self.last_trigger
+        if last_trigger is not None and self.buffer.i is not None:
+            # the earliest pulse the next entry can trigger on
+            earliest=(self.buffer.i+1)*self.n_samples-self.n_template
+            if earliest-last_trigger>self.window/2:
+                last_trigger=None
+        return (last_trigger,self.noise_spill)
+
+    def set_state(self,state):
+        self.last_trigger,self.noise_spill=state
+
+    def stream_buffers(self):
+        return {'Waveform':self.buffer}
+
+    def config(self):
+        return {'template':self.template.tolist(),'dt_sample':self.dt_sample,
+            'n_samples':self.n_samples,'n_sigma':self.n_sigma,
+            'readout_length':self.readout_length}
+
+    def schema(self):
+        return {'Waveform':float,'MatchedFilterSNR':float}
+
+    @Module._finish
+    def finish(self):
+        pass
+
+class HeaterTrigger(Trigger):
     '''
     Trigger to find bolometer pulses from heater events
     For a given tree entry that contains data from Ch 0 (aka the bolometer),
@@ -134,7 +485,7 @@ class HeaterTrigger(Module):
     surrounding time window
     '''
     def __init__(self,name,window_time,min_voltage_trigger_threshold,
-        heater_channel,bolometer_channel):
+        heater_channel,bolometer_channel,cache_size=8,prescan=False):
         '''
         Input:
         -name: string, name to call module for pretty printing
@@ -144,6 +495,11 @@ class HeaterTrigger(Module):
         which we decide the data has a pulse and trigger. this is set-up to assume
         the heater pulses are negative (neg. spikes in voltage) while the bolometer
         pulses show a baseline increase
+        -cache_size: int, number of decoded entries to keep around. a heater/
+        bolometer pair and the neighbours of each need 6
+        -prescan: bool, if True, read only the scalar branches and the heater
+        minimum of every entry before looping, and only visit the bolometer
+        entries whose heater pulse passes the threshold
         '''
         self.window_time=window_time
         self.min_voltage_trigger_threshold=min_voltage_trigger_threshold
@@ -153,17 +509,75 @@ class HeaterTrigger(Module):
         self.n_samples=0
         self.heater_channel=heater_channel
         self.bolometer_channel=bolometer_channel
+        self.prescan=prescan
+        # counts of bad entries, reported in finish()
+        self.n_unpaired=0 # bolometer entries not followed by a heater entry
+        self.n_mispaired=0 # bolometer/heater pairs with different times
+        self.n_unknown=0 # entries from neither channel
+        # every entry is decoded once into this cache, and read from here by
+        # execute() and both buffers
+        self.cache=EntryCache(cache_size)
+        # chain alternates heater/bolometer entries, so neighbouring entries of
+        # the same stream are 2 entries apart
+        self.bolometer_buffer=StitchedBuffer(2,self.cache)
+        self.heater_buffer=StitchedBuffer(2,self.cache)
         super(HeaterTrigger,self).__init__(name)
 
-    def calculate_heater_params(self,chain_entry,min_ind):
+    def select_entries(self,chain,n_entries,start=0):
+        '''
+        Without prescan, visit every entry. With prescan, read only the scalar
+        branches and the minimum of each waveform, and find the bolometer entries
+        that are followed by a heater entry from the same time whose pulse passes
+        the threshold. Only those are visited (or, with noise accumulators
+        attached, all paired bolometer entries). Unpaired and mispaired entries
+        are counted and reported in finish()
+
+        Input:
+        -chain: ROOT TChain holding SQUID data
+        -n_entries: int, entry to stop before
+        -start: int, first entry to consider
+
+        Returns:
+        -iterable of ints, the TChain positions of bolometer entries to visit
+        '''
+        if not self.prescan:
+            return xrange(start,n_entries)
+        # the heater entry following the last bolometer entry is needed too
+        scan=scan_entries(chain,min(n_entries+1,chain.GetEntries()),start)
+        ch=scan['Ch']
+        n=n_entries-start
+        bolometer=numpy.flatnonzero(ch[:n]==self.bolometer_channel)
+        self.n_unknown+=numpy.sum((ch[:n]!=self.bolometer_channel)&
+            (ch[:n]!=self.heater_channel))
+        # bolometer entry at the very end has no heater entry to pair with
+        has_next=bolometer+1<len(ch)
+        self.n_unpaired+=numpy.sum(~has_next)
+        bolometer=bolometer[has_next]
+        heater=bolometer+1
+        paired=ch[heater]==self.heater_channel
+        self.n_unpaired+=numpy.sum(~paired)
+        bolometer,heater=bolometer[paired],heater[paired]
+        same_time=(scan['t_s'][heater]==scan['t_s'][bolometer])&\
+            (scan['t_mus'][heater]==scan['t_mus'][bolometer])
+        self.n_mispaired+=numpy.sum(~same_time)
+        bolometer,heater=bolometer[same_time],heater[same_time]
+        passing=scan['WaveformMin'][heater]<=self.min_voltage_trigger_threshold
+        # bolometer entries without a heater pulse are needed for noise spectra
+        if self.noise_accumulators:
+            return (bolometer+start).tolist()
+        return (bolometer[passing]+start).tolist()
+
+    def skips_entries(self):
+        return self.prescan
+
+    def calculate_heater_params(self,w,min_ind):
         '''
         Function to calculate parameters of the heater pulse. This could also
         be moved to a separate module in the future, since it doesn't really
         depend on the trigger.  But for now its convenient to have it here.
 
         Input:
-        -chain_entry: entry in ROOT TChain corresponding to a piece of
-        heater pulse data
+        -w: array, waveform of the heater pulse data
         -min_ind: index of Waveform array corresponding to the minimum (ie. the
         peak of the negative heater pulse)
 
@@ -176,13 +590,12 @@ class HeaterTrigger(Module):
         waveform start
 
         '''
-        w=numpy.array(chain_entry.Waveform)
         # width is defined as the amount of time the square heater pulse is beyond
         # 90% of its peak value.  remember: the heater pulse is a negative spike in
         # voltage
         thresh=w[min_ind]*0.9
         pulse=w[w<thresh]
-        heater_width=len(pulse)*chain_entry.dt_s # seconds
+        heater_width=len(pulse)*self.dt_sample # seconds
 
         heater_leading_edge_time=min(numpy.argwhere(w<thresh))[0]*self.dt_sample
         # baseline is mean value of waveform, excluding samples that have 90%
@@ -193,41 +606,62 @@ class HeaterTrigger(Module):
         heater_energy=heater_amp**2*heater_width
         return heater_amp, heater_width, heater_energy, heater_leading_edge_time
 
-    def read_out_waveform(self,chain,i,ind):
+    def calculate_heater_params_block(self,w,min_ind):
+        '''
+        Calculate the parameters of many heater pulses at once, with array
+        operations over a 2D block of heater waveforms. The means are summed in
+        the same order as in calculate_heater_params() (see masked_mean()), so
+        the results are bit for bit the same as one pulse at a time
+
+        Input:
+        -w: 2D array, heater waveforms, one per row
+        -min_ind: array, index in each row corresponding to the minimum (ie. the
+        peak of the negative heater pulse)
+
+        Returns:
+        -arrays of the amplitudes, widths, energy proxies and leading edge times
+        of the heater pulses, as for calculate_heater_params()
+        '''
+        # width is defined as the amount of time the square heater pulse is beyond
+        # 90% of its peak value.  remember: the heater pulse is a negative spike in
+        # voltage
+        thresh=w[numpy.arange(len(w)),min_ind]*0.9
+        pulse=w<thresh[:,numpy.newaxis]
+        n_pulse=pulse.sum(axis=1)
+        heater_width=n_pulse*self.dt_sample # seconds
+
+        heater_leading_edge_time=pulse.argmax(axis=1)*self.dt_sample
+        # baseline is mean value of waveform, excluding samples that have 90%
+        # or more of the heater pulse peak voltage
+        baseline=masked_mean(w,w>thresh[:,numpy.newaxis])
+        heater_amp=masked_mean(w,pulse)-baseline
+        # energy proxy, need resistance to convert to energy. numpy.power() is
+        # what a float's **2 calls; an array's **2 multiplies, which can round
+        # differently in the last bit
+        heater_energy=numpy.power(heater_amp,2.)*heater_width
+        return heater_amp, heater_width, heater_energy, heater_leading_edge_time
+
+    def read_out_waveform(self,buffer,ind):
         '''
         Isolates a sub-section of the total waveform that is centered on the pulse
 
         Input:
-        -chain: TChain containing heater and bolometer data
-        -i: TChain index corresponding to current bolometer event to trigger
+        -buffer: StitchedBuffer holding the current bolometer (or heater) entry
+        and its neighbours in the same stream
         -ind: index in waveform array corresponding to peak of heater pulse
 
         Returns:
         -waveform array containing bolomoter data at time triggered by heater pulse,
-        +/- a time window given by total time window self.window_time
+        +/- a time window given by total time window self.window_time. this is a
+        view of the buffer, not a copy
         -int corresponding to the index in the array where the readout window will
         start.  can be negative (gives position in waveform of previous bolo event)
         '''
-        chain.GetEntry(i)
         start=ind-self.window/2
         end=ind+self.window/2
-        waveform=numpy.zeros(end-start)
-        if start<0:
-            # if readout window spills into previous pulse, get that pulse from chain
-            waveform[-1*start:]=chain.Waveform[:end]
-            # chain alternates heater/bolometer entries, so go back 2 entries
-            # to get last bolometer data
-            chain.GetEntry(i-2)
-            waveform[:-1*start]=chain.Waveform[self.n_samples+start:]
-        elif end>self.n_samples:
-            # if readout window spills into next pulse
-            waveform[:self.n_samples-start]=chain.Waveform[start:]
-            chain.GetEntry(i+2) # again, jump 2 spots
-            waveform[self.n_samples-start:]=chain.Waveform[:end-self.n_samples]
-        else:
-            # readout window fully contained in current waveform
-            waveform=numpy.array(chain.Waveform[start:end])
-        return waveform, start
+        # if readout window spills into the previous or next pulse, the buffer
+        # already holds it
+        return buffer.window(start,end), start
 
     @Module._execute
     def execute(self,chain,i):
@@ -240,58 +674,243 @@ class HeaterTrigger(Module):
         -i: int corresponding to current position in the TChain
 
         Output:
-        -dictionary containing triggered bolometer waveform, heater waveform for same
-        time window, time of the start of the window, and various heater pulse
-        parameters
+        -list with one dictionary containing triggered bolometer waveform, heater
+        waveform for same time window, time of the start of the window, and various
+        heater pulse parameters, or an empty list if nothing triggered
         '''
         event={}
-        chain.GetEntry(i)
+        entry=self.cache.get(chain,i)
 
         # ch 1 is heater channel, i want bolometer events
-        if chain.Ch==self.heater_channel:
-            return False
-        assert chain.Ch==self.bolometer_channel
+        if entry.Ch==self.heater_channel:
+            return []
+        if entry.Ch!=self.bolometer_channel:
+            self.n_unknown+=1
+            return []
 
         # fill info that should be the same for all events
         if self.n_samples==0:
-            self.n_samples=len(chain.Waveform)
+            self.n_samples=len(entry.Waveform)
         if self.dt_sample==0:
-            self.dt_sample=chain.dt_s
+            self.dt_sample=entry.dt_s
             self.window=int(self.window_time/self.dt_sample)
 
         # get event time
-        t_s=chain.t_s
-        t_mus=chain.t_mus
+        t_s=entry.t_s
+        t_mus=entry.t_mus
         event['Time']=t_s+t_mus*1e-6
-        event['dt_sample']=chain.dt_s
+        event['dt_sample']=entry.dt_s
 
         # get corresponding heater pulse
-        chain.GetEntry(i+1)
-        assert chain.t_s==t_s
-        assert chain.t_mus==t_mus
-        ind=numpy.argmin(chain.Waveform)
+        heater_entry=self.cache.get(chain,i+1)
+        if heater_entry is None or heater_entry.Ch!=self.heater_channel:
+            self.n_unpaired+=1
+            return []
+        if heater_entry.t_s!=t_s or heater_entry.t_mus!=t_mus:
+            self.n_mispaired+=1
+            return []
+        # stream filters only carry their state over entries the buffer sees
+        if self.stream_filters:
+            self.bolometer_buffer.load(chain,i)
+        self.heater_buffer.load(chain,i+1)
+        heater=self.heater_buffer.current()
+        ind=numpy.argmin(heater)
 
-        # throw away pulses below heater trigger threshold
-        if chain.Waveform[ind]>self.min_voltage_trigger_threshold:
-            return False
+        # throw away pulses below heater trigger threshold. without a heater
+        # pulse, the bolometer entry is noise
+        if heater[ind]>self.min_voltage_trigger_threshold:
+            self.accumulate_noise(entry.Waveform,[],self.dt_sample)
+            return []
 
         # find time,energy,etc of heater pulse
         heater_amp, heater_width, heater_energy, heater_leading_edge_time=\
-            self.calculate_heater_params(chain,ind)
+            self.calculate_heater_params(heater,ind)
         event['HeaterAmplitude']=heater_amp
         event['HeaterWidth']=heater_width
         event['HeaterEnergy']=heater_energy
         event['HeaterLeadingEdgeTime']=heater_leading_edge_time+event['Time']
 
         # read out bolometer waveform for heater time +/- window/2
-        event['Waveform'],start=self.read_out_waveform(chain,i,ind)
-        event['HeaterWaveform'],start=self.read_out_waveform(chain,i+1,ind)
+        self.bolometer_buffer.load(chain,i)
+        event['Waveform'],start=self.read_out_waveform(self.bolometer_buffer,ind)
+        event['HeaterWaveform'],start=self.read_out_waveform(self.heater_buffer,ind)
+        for buffer in self.bolometer_buffer,self.heater_buffer:
+            event.update(buffer.filtered_windows(start,start+self.window))
+        self.locate_event(event,i,start,2*(self.window/2))
 
         event['Time']+=start*self.dt_sample
 
         # return event dictionary
-        return event
+        return [event]
+
+    def read_entries(self,chain,index):
+        '''
+        Decode a set of entries into a 2D block, through the entry cache
+
+        Input:
+        -chain: ROOT TChain containing data to process
+        -index: sorted array of TChain positions
+
+        Returns:
+        -2D array, waveform of each entry, one per row. rows for positions outside
+        the chain are zeros
+        -dict of arrays, the Ch, t_s, t_mus and dt_s of each entry. Ch is -1 for
+        positions outside the chain
+        '''
+        decoded=[self.cache.get(chain,i) for i in index]
+        if self.n_samples==0:
+            self.n_samples=len([e for e in decoded if e is not None][0].Waveform)
+        block=numpy.zeros((len(index),self.n_samples))
+        scalars=dict((name,numpy.zeros(len(index))) for name in EntryCache.scalar_names)
+        scalars['Ch'][:]=-1
+        for k,entry in enumerate(decoded):
+            if entry is not None:
+                block[k]=entry.Waveform
+                for name in EntryCache.scalar_names:
+                    scalars[name][k]=getattr(entry,name)
+        return block, scalars
+
+    def execute_block(self,chain,entries):
+        '''
+        Called by FileLooper on a block of TChain entries. Stream filters need the
+        entries one after the other, so with any attached this falls back to
+        execute() on each entry.
+
+        Input:
+        -chain: ROOT TChain containing data to process
+        -entries: list of ints, TChain positions to process, in increasing order
+
+        Output:
+        -list of event dicts, or an EventBlock
+        '''
+        if self.stream_filters:
+            return super(HeaterTrigger,self).execute_block(chain,entries)
+        return self.execute_vectorized(chain,entries)
+
+    @Module._execute_block
+    def execute_vectorized(self,chain,entries):
+        '''
+        Vectorized version of execute() for a block of entries. The heater pulses
+        of all the bolometer entries in the block are found and measured with
+        array operations, and all the readout windows are extracted with one
+        fancy-indexing step each. Gives the same events as calling execute() on
+        each entry.
+
+        Input:
+        -chain: ROOT TChain containing data to process
+        -entries: list of ints, TChain positions to process, in increasing order
+
+        Output:
+        -EventBlock with the same events execute() would give, in order
+        '''
+        entries=numpy.asarray(entries,dtype=int)
+        if len(entries)==0:
+            return []
+        # every entry that could be needed: the heater entry after each entry,
+        # and the neighbours of both for readout windows that spill over
+        index=numpy.unique(numpy.concatenate([entries+k for k in range(-2,4)]))
+        block,scalars=self.read_entries(chain,index)
+        ch=scalars['Ch']
+
+        # ch 1 is heater channel, i want bolometer events
+        row=numpy.searchsorted(index,entries)
+        bolometer=ch[row]==self.bolometer_channel
+        self.n_unknown+=numpy.sum(~bolometer&(ch[row]!=self.heater_channel))
+        row=row[bolometer]
+        # chain alternates heater/bolometer entries, the heater pulse is next
+        heater_row=row+1
+        paired=ch[heater_row]==self.heater_channel
+        self.n_unpaired+=numpy.sum(~paired)
+        row,heater_row=row[paired],heater_row[paired]
+        same_time=(scalars['t_s'][heater_row]==scalars['t_s'][row])&\
+            (scalars['t_mus'][heater_row]==scalars['t_mus'][row])
+        self.n_mispaired+=numpy.sum(~same_time)
+        row,heater_row=row[same_time],heater_row[same_time]
+        if len(row)==0:
+            return []
+
+        # fill info that should be the same for all events
+        if self.dt_sample==0:
+            self.dt_sample=scalars['dt_s'][row[0]]
+            self.window=int(self.window_time/self.dt_sample)
+
+        # throw away pulses below heater trigger threshold
+        heater=block[heater_row]
+        ind=heater.argmin(axis=1)
+        passing=heater[numpy.arange(len(ind)),ind]<=\
+            self.min_voltage_trigger_threshold
+        # without a heater pulse, the bolometer entry is noise
+        if self.noise_accumulators and not passing.all():
+            for accumulator in self.noise_accumulators:
+                accumulator.add(block[row[~passing]],self.dt_sample)
+        row,heater_row,ind,heater=\
+            row[passing],heater_row[passing],ind[passing],heater[passing]
+
+        # find time,energy,etc of heater pulses
+        heater_amp, heater_width, heater_energy, heater_leading_edge_time=\
+            self.calculate_heater_params_block(heater,ind)
+        event_time=scalars['t_s'][row]+scalars['t_mus'][row]*1e-6
+
+        # read out bolometer and heater waveforms for heater time +/- window/2.
+        # samples before 0 or past n_samples come from the previous or next
+        # entry of the same stream, 2 entries away
+        start=ind-self.window/2
+        samples=start[:,numpy.newaxis]+numpy.arange(2*(self.window/2))
+        if len(samples) and (samples.min()<-self.n_samples or
+            samples.max()>=2*self.n_samples):
+            raise IndexError("readout window reaches beyond the neighbouring "
+                "entries")
+        shift=numpy.floor_divide(samples,self.n_samples)
+        samples-=shift*self.n_samples
+        waveform=block[numpy.searchsorted(index,
+            index[row][:,numpy.newaxis]+2*shift),samples]
+        heater_waveform=block[numpy.searchsorted(index,
+            index[heater_row][:,numpy.newaxis]+2*shift),samples]
+
+        events={'Time':event_time+start*self.dt_sample,
+            'dt_sample':scalars['dt_s'][row],
+            'HeaterAmplitude':heater_amp,
+            'HeaterWidth':heater_width,
+            'HeaterEnergy':heater_energy,
+            'HeaterLeadingEdgeTime':heater_leading_edge_time+event_time,
+            'Waveform':waveform,
+            'HeaterWaveform':heater_waveform}
+        self.locate_event(events,index[row],start,
+            numpy.repeat(2*(self.window/2),len(row)))
+        return EventBlock(events)
+
+    def stream_buffers(self):
+        return {'Waveform':self.bolometer_buffer,
+            'HeaterWaveform':self.heater_buffer}
+
+    def window_entries(self):
+        # the heater entry follows its bolometer entry
+        return {'Waveform':(0,2),'HeaterWaveform':(1,2)}
+
+    def config(self):
+        return {'window_time':self.window_time,
+            'min_voltage_trigger_threshold':self.min_voltage_trigger_threshold,
+            'heater_channel':self.heater_channel,
+            'bolometer_channel':self.bolometer_channel}
+
+    def schema(self):
+        return dict((name,float) for name in ['Time','dt_sample',
+            'HeaterAmplitude','HeaterWidth','HeaterEnergy',
+            'HeaterLeadingEdgeTime','Waveform','HeaterWaveform'])
+
+    def merge(self,other):
+        super(HeaterTrigger,self).merge(other)
+        self.n_unpaired+=other.n_unpaired
+        self.n_mispaired+=other.n_mispaired
+        self.n_unknown+=other.n_unknown
+        self.cache.hits+=other.cache.hits
+        self.cache.misses+=other.cache.misses
 
     @Module._finish
     def finish(self):
-        pass
+        print "%s: entry cache %i hits, %i misses" %\
+            (self.name, self.cache.hits, self.cache.misses)
+        if self.n_unpaired or self.n_mispaired or self.n_unknown:
+            print "%s: skipped %i unpaired bolometer entries, %i mispaired "\
+                "bolometer/heater entries, %i entries from unknown channels" %\
+                (self.name, self.n_unpaired, self.n_mispaired, self.n_unknown)
@@ -0,0 +1,188 @@
+import os
+import glob
+import time
+import numpy
+try:
+    import root_numpy
+except ImportError:
+    root_numpy=None
+try:
+    import h5py
+except ImportError:
+    # only needed for HDF5Writer
+    h5py=None
+
+class Writer(object):
+    '''
+    Base class for writers that stream events to disk during FileLooper.loop().
+    Whenever the FileLooper has collected chunk_size events, it hands them to
+    the writer as a structured array and drops them from memory, so memory use
+    is bounded by the chunk size instead of the length of the run.
+
+    Subclasses implement write_chunk() and, if needed, close_file().
+    '''
+    def __init__(self,file_name,chunk_size=10000):
+        '''
+        Input:
+        -file_name: string, name of output file (or directory)
+        -chunk_size: int, number of events to collect before writing them out
+        '''
+        self.file_name=file_name
+        self.chunk_size=chunk_size
+        self.n_events=0
+        self.n_bytes=0
+        self.n_chunks=0
+        self.write_time=0.
+
+    def write(self,events):
+        '''
+        Write a chunk of events
+
+        Input:
+        -events: numpy structured array, one record per event
+        '''
+        if len(events)==0:
+            return
+        start_time=time.time()
+        self.write_chunk(events)
+        self.write_time+=time.time()-start_time
+        self.n_events+=len(events)
+        self.n_bytes+=events.nbytes
+        self.n_chunks+=1
+
+    def write_chunk(self,events):
+        '''
+        Append a chunk of events to the output
+        '''
+        pass
+
+    def close(self):
+        '''
+        Finish writing, and report the throughput
+        '''
+        self.close_file()
+        rate=self.n_bytes/1e6/self.write_time if self.write_time>0 else 0.
+        print "%s: wrote %i events (%.1f MB) in %i chunks to %s, %3.2f seconds, "\
+            "%.1f MB/s" % (type(self).__name__, self.n_events, self.n_bytes/1e6,
+            self.n_chunks, self.file_name, self.write_time, rate)
+
+    def close_file(self):
+        pass
+
+class RootWriter(Writer):
+    '''
+    Writer appending events to a tree in a ROOT file, with root_numpy
+    '''
+    def __init__(self,file_name,chunk_size=10000,tree_name='tree'):
+        '''
+        Input:
+        -file_name: string, name of output ROOT file
+        -chunk_size: int, number of events to collect before writing them out
+        -tree_name: string, name of the tree to write
+        '''
+        if root_numpy is None:
+            raise ImportError("writing ROOT files needs root_numpy")
+        self.tree_name=tree_name
+        super(RootWriter,self).__init__(file_name,chunk_size)
+
+    def write_chunk(self,events):
+        # the first chunk creates the file, later ones are added to the tree
+        mode='recreate' if self.n_chunks==0 else 'update'
+        root_numpy.array2root(events,self.file_name,self.tree_name,mode=mode)
+
+class HDF5Writer(Writer):
+    '''
+    Writer appending events to an HDF5 file, with h5py. Each field is one
+    chunked, resizable dataset, with one row per event
+    '''
+    def __init__(self,file_name,chunk_size=10000,compression='gzip',
+        compression_level=4):
+        '''
+        Input:
+        -file_name: string, name of output HDF5 file
+        -chunk_size: int, number of events to collect before writing them out.
+        also the HDF5 chunk size of the datasets
+        -compression: string, HDF5 compression filter ('gzip' or 'lzf'), or
+        None for no compression
+        -compression_level: int, gzip compression level, 0-9
+        '''
+        if h5py is None:
+            raise ImportError("writing HDF5 files needs h5py")
+        self.compression=compression
+        self.compression_level=compression_level if compression=='gzip' else None
+        self.file=None
+        super(HDF5Writer,self).__init__(file_name,chunk_size)
+
+    def write_chunk(self,events):
+        if self.file is None:
+            self.file=h5py.File(self.file_name,'w')
+            for name in events.dtype.names:
+                shape=events.dtype[name].shape
+                self.file.create_dataset(name,(0,)+shape,
+                    dtype=events.dtype[name].base,maxshape=(None,)+shape,
+                    chunks=(min(self.chunk_size,len(events)),)+shape,
+                    compression=self.compression,
+                    compression_opts=self.compression_level)
+        for name in events.dtype.names:
+            dataset=self.file[name]
+            dataset.resize(self.n_events+len(events),axis=0)
+            dataset[self.n_events:]=events[name]
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file=None
+
+class NPZWriter(Writer):
+    '''
+    Writer saving each chunk of events to a numpy .npz file in an output
+    directory, one array per field. This needs nothing beyond numpy, and the
+    files are read back without unpickling anything (see read())
+    '''
+    def __init__(self,file_name,chunk_size=10000,compress=True):
+        '''
+        Input:
+        -file_name: string, name of output directory
+        -chunk_size: int, number of events to collect before writing them out
+        -compress: bool, if True zip-compress the chunk files
+        '''
+        self.compress=compress
+        super(NPZWriter,self).__init__(file_name,chunk_size)
+
+    def write_chunk(self,events):
+        if self.n_chunks==0:
+            if not os.path.isdir(self.file_name):
+                os.makedirs(self.file_name)
+            for old in glob.glob(os.path.join(self.file_name,'chunk_*.npz')):
+                os.remove(old)
+        save=numpy.savez_compressed if self.compress else numpy.savez
+        save(os.path.join(self.file_name,'chunk_%06i.npz' % self.n_chunks),
+            **dict((name,events[name]) for name in events.dtype.names))
+
+    @staticmethod
+    def read(file_name):
+        '''
+        Read back the events written to a directory
+
+        Input:
+        -file_name: string, name of directory
+
+        Returns:
+        -numpy structured array with all the events, in order
+        '''
+        columns={}
+        for chunk in sorted(glob.glob(os.path.join(file_name,'chunk_*.npz'))):
+            with numpy.load(chunk) as f:
+                for name in f.files:
+                    columns.setdefault(name,[]).append(f[name])
+        if not columns:
+            return numpy.zeros(0)
+        columns=dict((name,numpy.concatenate(columns[name])) for name in columns)
+        names=sorted(columns)
+        if 'EventID' in columns:
+            names=['EventID']+[name for name in names if name!='EventID']
+        out=numpy.empty(len(columns[names[0]]),dtype=[(name,columns[name].dtype,
+            columns[name].shape[1:]) for name in names])
+        for name in names:
+            out[name]=columns[name]
+        return out
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import numpy
+import Calamari
+
+################################################################
+# Time the triggers, Filter, PulseParams and write_output on   #
+# synthetic data of several sizes, and compare with a baseline #
+#                                                              #
+# python Benchmark.py [run|compare|save] [baseline] [scale]    #
+#                                                              #
+# "run" (the default) only prints the timings. "compare" also  #
+# prints the change from the baseline, and exits with 1 if     #
+# anything got slower by more than the tolerance. "save"       #
+# writes the timings as the new baseline. The baseline is      #
+# benchmark_baseline.json next to this script unless given,    #
+# and scale multiplies the data sizes. Timings only compare    #
+# on the same machine, so the baseline isn't kept in the repo: #
+# run "save" on your machine before making changes.            #
+#                                                              #
+# "run" and "compare" also check PulseParams on blocks is at   #
+# least 10 times faster than one event at a time, on the same  #
+# pulses; that ratio doesn't depend on the machine             #
+################################################################
+
+command=sys.argv[1] if len(sys.argv)>1 else 'run'
+baseline_file=sys.argv[2] if len(sys.argv)>2 else\
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),'benchmark_baseline.json')
+scale=float(sys.argv[3]) if len(sys.argv)>3 else 1.
+
+# numbers of heater/bolometer entry pairs. the background runs get the same
+# number of samples, in entries 5 times longer
+sizes=[int(scale*n) for n in [250,1000,4000]]
+# timings are the best of this many runs
+n_repeats=3
+# fraction a timing may grow by before "compare" calls it a regression, and
+# differences in seconds too small to count
+tolerance=0.25
+min_difference=0.01
+# number of pulses for the PulseParams comparison, and the speedup of blocks
+# over single events it has to reach
+n_pulses=int(scale*10000)
+min_speedup=10.
+
+data_dir=tempfile.mkdtemp()
+
+def heater_run(file_names,block_size,batch_size):
+    '''
+    Returns:
+    -dict of (seconds, items) for the trigger, each module and write_output
+    '''
+    FL=Calamari.FileLooper(file_names,None,logging=False,
+        reader=Calamari.MemmapReader,block_size=block_size,batch_size=batch_size)
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+    FL.add_module(Calamari.Filter('Filter',5e3,2,1e-5,'Waveform','FilteredWaveform'))
+    FL.add_module(Calamari.PulseParams('PulseParams','Waveform'))
+    profiler=Calamari.Profiler()
+    FL.add_profiler(profiler)
+    FL.loop()
+    timings=dict((name,(stage.wall,stage.items))
+        for name,stage in profiler.stages.items() if name not in ['store','write'])
+    start=time.time()
+    FL.write_output(os.path.join(data_dir,'output'),ROOT=False,pickle=True)
+    timings['write_output']=(time.time()-start,len(FL.events))
+    return timings
+
+def background_run(file_names,trigger):
+    '''
+    Returns:
+    -dict of (seconds, items) for the trigger
+    '''
+    FL=Calamari.FileLooper(file_names,None,logging=False,
+        reader=Calamari.MemmapReader)
+    FL.add_trigger(trigger)
+    profiler=Calamari.Profiler()
+    FL.add_profiler(profiler)
+    FL.loop()
+    stage=profiler.stages[trigger.name]
+    return {trigger.name:(stage.wall,stage.items)}
+
+def pulse_params_run(n_pulses,block_size=1000):
+    '''
+    Returns:
+    -dict of (seconds, items) for PulseParams one event at a time, and on blocks
+    of events
+    '''
+    r=numpy.random.RandomState(n_pulses)
+    pulse=Calamari.pulse_shape(300,1e-5,5e-5,5e-4)
+    waveforms=0.1+1e-4*r.randn(n_pulses,300)
+    for k,start in enumerate(r.randint(30,200,n_pulses)):
+        waveforms[k,start:]+=r.uniform(0.01,0.05)*pulse[:300-start]
+    PP=Calamari.PulseParams('PulseParams','Waveform')
+    start=time.time()
+    for waveform in waveforms:
+        PP.execute({'Waveform':waveform,'dt_sample':1e-5,'Time':0.})
+    timings={'PulseParams_events':(time.time()-start,n_pulses)}
+    blocks=[Calamari.EventBlock({'Waveform':waveforms[k:k+block_size],
+        'dt_sample':numpy.full(len(waveforms[k:k+block_size]),1e-5),
+        'Time':numpy.zeros(len(waveforms[k:k+block_size]))})
+        for k in range(0,n_pulses,block_size)]
+    start=time.time()
+    for block in blocks:
+        PP.execute_batch(block)
+    timings['PulseParams_blocks']=(time.time()-start,n_pulses)
+    return timings
+
+template=Calamari.pulse_shape(100,1e-4,5e-4,8e-3)
+benchmarks=[
+    ('heater',lambda files: heater_run(files,1,1)),
+    ('heater_blocks',lambda files: heater_run(files,1000,1000)),
+    ('background',lambda files: background_run(files,
+        Calamari.SimpleTrigger('SimpleTrigger',0.01,1e-4,1e4,5,0.5))),
+    ('background',lambda files: background_run(files,
+        Calamari.MatchedFilterTrigger('MatchedFilterTrigger',template,1e-4,1e4,5,0.5))),
+]
+
+results={}
+for size in sizes:
+    heater_files=Calamari.write_synthetic(os.path.join(data_dir,'heater'),
+        Calamari.heater_data(size,seed=size),n_files=2,entry_step=2)
+    background_files=Calamari.write_synthetic(os.path.join(data_dir,'background'),
+        Calamari.background_data(2*size/5,lock_loss_rate=0.05,seed=size),n_files=2)
+    for data,run in benchmarks:
+        files=heater_files if data.startswith('heater') else background_files
+        best={}
+        for k in range(n_repeats):
+            for name,(seconds,items) in run(files).items():
+                if name not in best or seconds<best[name][0]:
+                    best[name]=(seconds,items)
+        for name in sorted(best):
+            seconds,items=best[name]
+            key='%s/%s/%i' % (data,name,size)
+            results[key]={'seconds':seconds,'items':items}
+            print "%-40s %8.3f s %10.0f items/s" % (key,seconds,
+                items/seconds if seconds>0 else 0)
+    shutil.rmtree(os.path.join(data_dir,'heater'))
+    shutil.rmtree(os.path.join(data_dir,'background'))
+shutil.rmtree(data_dir)
+
+best={}
+for k in range(n_repeats):
+    for name,(seconds,items) in pulse_params_run(n_pulses).items():
+        if name not in best or seconds<best[name][0]:
+            best[name]=(seconds,items)
+for name in sorted(best):
+    seconds,items=best[name]
+    key='pulses/%s/%i' % (name,n_pulses)
+    results[key]={'seconds':seconds,'items':items}
+    print "%-40s %8.3f s %10.0f items/s" % (key,seconds,
+        items/seconds if seconds>0 else 0)
+speedup=best['PulseParams_events'][0]/best['PulseParams_blocks'][0]
+print "PulseParams on blocks is %.1f times faster than one event at a time" %\
+    speedup
+
+if command in ['run','compare'] and speedup<min_speedup:
+    print "PulseParams blocks are less than %g times faster" % min_speedup
+    sys.exit(1)
+
+if command=='save':
+    with open(baseline_file,'w') as f:
+        json.dump({'machine':platform.platform(),'python':platform.python_version(),
+            'numpy':numpy.__version__,'time':time.strftime('%Y-%m-%d'),
+            'results':results},f,indent=1,sort_keys=True)
+    print "Saved baseline to %s" % baseline_file
+
+elif command=='compare':
+    if not os.path.exists(baseline_file):
+        print "No baseline %s; run \"python Benchmark.py save\" on this machine "\
+            "first" % baseline_file
+        sys.exit(1)
+    with open(baseline_file) as f:
+        baseline=json.load(f)
+    print "Compared with baseline from %s (%s, python %s, numpy %s)" %\
+        (baseline['time'],baseline['machine'],baseline['python'],baseline['numpy'])
+    regressions=[]
+    for key in sorted(results):
+        if key not in baseline['results']:
+            continue
+        old=baseline['results'][key]['seconds']
+        new=results[key]['seconds']
+        slower=new>old*(1+tolerance) and new-old>min_difference
+        if slower:
+            regressions+=[key]
+        print "%-40s %8.3f s -> %8.3f s %+6.0f%%%s" % (key,old,new,
+            100*(new/old-1) if old>0 else 0,' SLOWER' if slower else '')
+    if regressions:
+        print "%i regressions" % len(regressions)
+        sys.exit(1)
+
+elif command!='run':
+    print "Unknown command %s" % command
+    sys.exit(1)
@@ -0,0 +1,142 @@
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+import numpy
+import Calamari
+
+################################################################
+# Benchmark the ParallelLooper against a single FileLooper on  #
+# synthetic heater pulse data and background data for the      #
+# SimpleTrigger, for increasing numbers of cores               #
+#                                                              #
+# python BenchmarkParallel.py [n_pairs] [max_workers]          #
+#                                                              #
+# Besides the measured speedup on the cores there are, it      #
+# prints the speedup projected for up to max_workers (default  #
+# 8) workers: the ranges are timed one after another, handed   #
+# out to the workers the way the pool does, and the ranges     #
+# looped over again in the main process are added on. This is  #
+# the speedup the ranges allow, without the cost of starting   #
+# processes and sending results back                           #
+################################################################
+
+# number of heater/bolometer entry pairs, and samples per entry
+n_pairs=int(sys.argv[1]) if len(sys.argv)>1 else 20000
+max_workers=int(sys.argv[2]) if len(sys.argv)>2 else 8
+n_samples=2000
+dt_sample=1e-5
+
+# heater pulses in the heater entries, bolometer pulses following them in the
+# bolometer entries. written as memmap stores, so this runs without ROOT
+data_dir=tempfile.mkdtemp()
+r=numpy.random.RandomState(1)
+file_names=[]
+n_files=8
+for k in range(n_files):
+    n=n_pairs/n_files
+    waveforms=numpy.empty((2*n,n_samples))
+    waveforms[0::2]=0.1+1e-4*r.randn(n,n_samples)
+    waveforms[1::2]=1e-4*r.randn(n,n_samples)
+    peaks=r.randint(0,n_samples-30,n)
+    for j in range(n):
+        waveforms[2*j+1,peaks[j]:peaks[j]+20]-=0.1
+        waveforms[2*j,peaks[j]:]+=0.02*numpy.exp(-numpy.arange(n_samples-peaks[j])/200.)
+    times=numpy.repeat(numpy.arange(k*n,(k+1)*n),2)
+    Calamari.write_memmap_store('%s/%i' % (data_dir,k),waveforms,
+        numpy.tile([0,1],n),times,numpy.zeros(2*n),numpy.repeat(dt_sample,2*n))
+    file_names+=['%s/%i' % (data_dir,k)]
+
+# the same number of samples of background data, in entries 5 times longer,
+# with a pulse rate that keeps the SimpleTrigger busy
+background_names=Calamari.write_synthetic(data_dir+'/background',
+    Calamari.background_data(2*n_pairs/5,pulse_rate=10.,lock_loss_rate=0.05,seed=2),
+    n_files=n_files)
+
+def setup(FL):
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+    FL.add_module(Calamari.PulseParams('PulseParams','Waveform'))
+
+def background_setup(FL):
+    FL.add_trigger(Calamari.SimpleTrigger('SimpleTrigger',0.01,1e-4,1e4,5,0.5))
+    FL.add_module(Calamari.NoisePSD('NoisePSD',1000))
+
+def projected_time(file_names,setup,looper_args,n_workers):
+    '''
+    Returns:
+    -float, seconds a ParallelLooper with n_workers workers would take on as
+    many cores, not counting the overhead of the pool
+    -int, number of ranges looped over again
+    '''
+    tasks=[(file_names,None,looper_args,setup,lo,n) for lo,n in
+        Calamari.split_entries(Calamari.MemmapReader(file_names).GetEntries(),
+        4*n_workers)]
+    times=[]
+    def timed_ranges():
+        for task in tasks:
+            start=time.time()
+            result=Calamari.run_range(task)
+            times.append(time.time()-start)
+            yield result
+    start=time.time()
+    n_rerun=0
+    for rerun,result in Calamari.run_ranges(tasks,timed_ranges()):
+        n_rerun+=rerun
+    rerun_time=time.time()-start-sum(times)
+    # the pool hands each range to the first worker to be free
+    loads=[0.]*n_workers
+    for seconds in times:
+        loads[loads.index(min(loads))]+=seconds
+    return max(loads)+rerun_time,n_rerun
+
+looper_args={'reader':Calamari.MemmapReader,'block_size':1000,'batch_size':1000}
+background_args={'reader':Calamari.MemmapReader,'batch_size':100}
+
+for title,names,setup_function,args in [('heater',file_names,setup,looper_args),
+    ('background',background_names,background_setup,background_args)]:
+    print title
+
+    ##########
+    # Serial #
+    ##########
+
+    start=time.time()
+    FL=Calamari.FileLooper(names,None,logging=False,**args)
+    setup_function(FL)
+    FL.loop()
+    serial_time=time.time()-start
+    print "serial: %i events, %3.2f seconds" % (len(FL.events),serial_time)
+
+    ############
+    # Parallel #
+    ############
+
+    n_workers=1
+    while n_workers<=multiprocessing.cpu_count():
+        start=time.time()
+        PL=Calamari.ParallelLooper(names,None,setup_function,n_workers=n_workers,
+            logging=False,**args)
+        PL.loop()
+        parallel_time=time.time()-start
+        same=len(PL.events)==len(FL.events) and all(numpy.array_equal(PL.events[name],
+            FL.events[name]) for name in FL.events.keys())
+        print "%i workers: %i events, %3.2f seconds, speedup %.2f (%.0f%% of linear), "\
+            "%i ranges looped over again, same events: %s" % (n_workers,
+            len(PL.events),parallel_time,serial_time/parallel_time,
+            100*serial_time/parallel_time/n_workers,PL.n_rerun,same)
+        n_workers*=2
+
+    #############
+    # Projected #
+    #############
+
+    n_workers=2
+    while n_workers<=max_workers:
+        seconds,n_rerun=projected_time(names,setup_function,args,n_workers)
+        print "%i workers projected: %3.2f seconds, speedup %.2f (%.0f%% of linear), "\
+            "%i ranges looped over again" % (n_workers,seconds,serial_time/seconds,
+            100*serial_time/seconds/n_workers,n_rerun)
+        n_workers*=2
+
+shutil.rmtree(data_dir)
@@ -1,4 +1,5 @@
 import glob
+import os
 import numpy
 import pylab
 import Calamari
@@ -41,6 +42,18 @@ FL.add_trigger(trigger)
 pulse_params=Calamari.PulseParams('PulseParams','Waveform')
 FL.add_module(pulse_params)
 
+# fit each pulse with an average pulse template, which gives a less noisy pulse
+# height than PulseParams. the first run builds the template from high-energy
+# heater pulses and saves it, later runs fit with it
+template_file=out_dir+'pulse_template.npz'
+if os.path.exists(template_file):
+    template_fit=Calamari.TemplateFit('TemplateFit','Waveform',
+        template=template_file)
+else:
+    template_fit=Calamari.TemplateFit('TemplateFit','Waveform',
+        selection=lambda event: event['HeaterEnergy']>0.4e-7)
+FL.add_module(template_fit)
+
 #####################
 # Process the data! #
 #####################
@@ -48,6 +61,8 @@ FL.add_module(pulse_params)
 FL.loop()
 FL.finish()
 FL.write_output('heater_pulses')
+if not os.path.exists(template_file):
+    template_fit.save_template(template_file)
 
 ##################################
 # Extra stuff - make plots, etc. #
@@ -62,7 +77,7 @@ plot_heater_data=False
 if plot_heater_data:
 
     import pandas
-    data=pandas.DataFrame(FL.events)
+    data=FL.events.to_dataframe(waveforms=False)
 
     # select events with a certain heater width
     # fit pulse height vs. heater energy with a linear function
@@ -72,6 +87,9 @@ if plot_heater_data:
     high=data.HeaterEnergy>0.4e-7 # only fit high-energy data
     x=data['HeaterEnergy'][width]
     y=data['PulseParams_PulseHeight'][width]
+    # once the template exists, the template fit amplitude is a better estimate
+    if 'TemplateFit_Amplitude' in data:
+        y=data['TemplateFit_Amplitude'][width]
     m1,b1,r,p,std=stats.linregress(x[high],y[high])
     line=lambda x,m,b: m*x+b
 
@@ -0,0 +1,50 @@
+import os
+import sys
+import glob
+import Calamari
+
+################################################################
+# Analyze a live stream of waveform records, or replay files   #
+# as one.                                                      #
+#                                                              #
+# python Live.py replay <address> '<file glob>' [speed]        #
+# python Live.py analyze <address> <module:setup> [publish]    #
+#                                                              #
+# <address> is a UNIX socket path, host:port, a named pipe or  #
+# - for stdin/stdout. "replay" serves the entries of the files #
+# (memmap stores or ROOT files) at speed times real time (0 as #
+# fast as possible), and waits for "analyze" to connect; start #
+# it first. "analyze" runs the trigger and modules added by    #
+# the setup function on the records as they arrive, and        #
+# publishes events and statistics as JSON lines to <publish>   #
+# (default stdout). With pipes:                                #
+#   python Live.py replay - '<glob>' | python Live.py analyze  #
+#       - <module:setup> <publish>                             #
+################################################################
+
+command=sys.argv[1]
+address=sys.argv[2]
+
+if command=='replay':
+    file_names=sorted(glob.glob(sys.argv[3]))
+    speed=float(sys.argv[4]) if len(sys.argv)>4 else 1.
+    reader=Calamari.MemmapReader if os.path.isdir(file_names[0]) else None
+    # keep the logging out of the records on stdout
+    logging=address!='-'
+    Calamari.replay(file_names,'data_tree',address,reader,speed,logging=logging)
+
+elif command=='analyze':
+    setup=Calamari.import_object(sys.argv[3])
+    publish=sys.argv[4] if len(sys.argv)>4 else '-'
+    publisher=Calamari.JSONLinePublisher(publish)
+    # don't mix the logging into published JSON on stdout
+    LL=Calamari.LiveLooper(address,logging=publish!='-',publisher=publisher,
+        max_queue=1000,policy='block')
+    setup(LL)
+    LL.loop()
+    if publish!='-':
+        LL.finish()
+
+else:
+    print "Unknown command %s" % command
+    sys.exit(1)
@@ -0,0 +1,79 @@
+import sys
+import glob
+import json
+import Calamari
+
+################################################################
+# Split a run into shards, run them, and merge their outputs.  #
+#                                                              #
+# python RunShard.py make <manifest> '<file glob>' <tree name> #
+#     <module:setup> <n shards> <output dir> [name=value ...]  #
+# python RunShard.py run <manifest> <shard id>                 #
+# python RunShard.py local <manifest> <n processes>            #
+# python RunShard.py merge <manifest> <output>                 #
+#                                                              #
+# "make" writes the manifest; the setup function adding the    #
+# trigger and modules has to be in a module on the PYTHONPATH. #
+# name=value pairs are FileLooper arguments: reader=<name of a #
+# Calamari reader, or module:name>, the others are JSON, e.g.  #
+# block_size=1000 keep_fields='["Time","PulseHeight"]'         #
+# "run" is what each batch job calls. "local" runs all the     #
+# unfinished shards as separate processes on this machine.     #
+# "merge" checks every shard finished and writes the merged    #
+# events, to a ROOT file if <output> ends in .root, otherwise  #
+# to a directory of .npz files                                 #
+################################################################
+
+command=sys.argv[1]
+manifest_file=sys.argv[2]
+
+def looper_argument(name,value):
+    '''
+    Returns:
+    -the value of a FileLooper argument given on the command line
+    '''
+    if name=='reader':
+        if ':' in value:
+            return Calamari.import_object(value)
+        return getattr(Calamari,value)
+    try:
+        return json.loads(value)
+    except ValueError:
+        # a plain string
+        return value
+
+if command=='make':
+    file_names=sorted(glob.glob(sys.argv[3]))
+    tree_name=sys.argv[4]
+    setup=Calamari.import_object(sys.argv[5])
+    n_shards=int(sys.argv[6])
+    kwargs={}
+    for argument in sys.argv[8:]:
+        name,value=argument.split('=',1)
+        kwargs[name]=looper_argument(name,value)
+    manifest=Calamari.write_manifest(manifest_file,file_names,tree_name,setup,
+        n_shards,sys.argv[7],**kwargs)
+    print "Wrote %i shards of %i entries to %s" % (len(manifest['shards']),
+        manifest['n_entries'],manifest_file)
+
+elif command=='run':
+    Calamari.run_shard(manifest_file,int(sys.argv[3]),logging=True)
+
+elif command=='local':
+    failed=Calamari.run_local(manifest_file,int(sys.argv[3]))
+    if failed:
+        print "Shards failed: %s" % ', '.join(str(k) for k in failed)
+        sys.exit(1)
+
+elif command=='merge':
+    output=sys.argv[3]
+    if output.endswith('.root'):
+        writer=Calamari.RootWriter(output)
+    else:
+        writer=Calamari.NPZWriter(output)
+    FL=Calamari.merge_shards(manifest_file,writer)
+    FL.finish()
+
+else:
+    print "Unknown command %s" % command
+    sys.exit(1)
@@ -0,0 +1,53 @@
+import numpy
+import Calamari
+
+def background_files(path,n_entries,n_files=2,**kwargs):
+    '''
+    Write a synthetic background run (see Calamari.background_data) as memmap
+    stores
+
+    Returns:
+    -list of strings, the store directories
+    -dict of arrays, the data written
+    '''
+    data=Calamari.background_data(n_entries,**kwargs)
+    return Calamari.write_synthetic(str(path),data,n_files=n_files),data
+
+def heater_files(path,n_pairs,n_files=2,**kwargs):
+    '''
+    Write a synthetic heater run (see Calamari.heater_data) as memmap stores
+
+    Returns:
+    -list of strings, the store directories
+    -dict of arrays, the data written
+    '''
+    data=Calamari.heater_data(n_pairs,**kwargs)
+    return Calamari.write_synthetic(str(path),data,n_files=n_files,
+        entry_step=2),data
+
+def run_looper(file_names,setup,**kwargs):
+    '''
+    Run a FileLooper over memmap stores
+
+    Returns:
+    -FileLooper, after its loop
+    '''
+    kwargs.setdefault('reader',Calamari.MemmapReader)
+    FL=Calamari.FileLooper(file_names,None,logging=False,**kwargs)
+    setup(FL)
+    FL.loop()
+    return FL
+
+def assert_same_events(a,b,exact=True):
+    '''
+    Check two event stores (or loopers) hold the same events
+    '''
+    a=getattr(a,'events',a)
+    b=getattr(b,'events',b)
+    assert sorted(a.keys())==sorted(b.keys())
+    assert len(a)==len(b)
+    for name in a.keys():
+        if exact:
+            assert numpy.array_equal(a[name],b[name]),name
+        else:
+            assert numpy.allclose(a[name],b[name],rtol=1e-12,atol=1e-15),name
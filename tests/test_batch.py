@@ -0,0 +1,55 @@
+import numpy
+import Calamari
+from helpers import *
+
+class Energetic(Calamari.Module):
+    '''
+    Per-event module without execute_batch(), rejecting low heater energies
+    '''
+    @Calamari.Module._execute
+    def execute(self,event):
+        if event['HeaterEnergy']<1e-6:
+            return False
+        event['Area']=event['FilteredWaveform'].sum()*event['dt_sample']
+        return event
+
+    def schema(self):
+        return {'Area':float}
+
+def batch_setup(FL):
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+    FL.add_module(Calamari.Filter('Filter',5e3,2,1e-5,'Waveform',
+        'FilteredWaveform'))
+    FL.add_module(Energetic('Energetic'))
+    FL.add_module(Calamari.PulseParams('PulseParams','Waveform'))
+
+def test_same_as_per_event(tmpdir):
+    file_names,data=heater_files(tmpdir,120,seed=29)
+    FL=run_looper(file_names,batch_setup)
+    assert 0<len(FL.events)<data['Pulsed'].sum()
+    for batch_size,block_size in [(7,1),(64,64),(1000,16)]:
+        batched=run_looper(file_names,batch_setup,batch_size=batch_size,
+            block_size=block_size)
+        assert_same_events(FL,batched,exact=False)
+        for name in FL.modules:
+            assert FL.modules[name].counter==batched.modules[name].counter
+
+def test_event_block():
+    events=[{'Time':float(k),'Waveform':numpy.arange(4.)+k} for k in range(5)]
+    block=Calamari.EventBlock.from_events(events)
+    assert block['Waveform'].shape==(5,4)
+    for k in range(5):
+        event=block.event(k)
+        assert event['Time']==k
+        assert numpy.array_equal(event['Waveform'],events[k]['Waveform'])
+    other=block.copy()
+    other.keep[[1,3]]=False
+    other['Extra']=numpy.zeros(5)
+    assert block.keep.all() and 'Extra' not in block
+    assert [event['Time'] for event in other.events()]==[0.,2.,4.]
+    assert list(other.compress()['Time'])==[0.,2.,4.]
+    joined=Calamari.EventBlock.concatenate([other.take(slice(0,2)),
+        Calamari.EventBlock({}),other.take(slice(2,5))])
+    assert list(joined.keep)==list(other.keep)
+    assert numpy.array_equal(joined['Waveform'],block['Waveform'])
+    assert len(Calamari.EventBlock.from_events([]))==0
@@ -0,0 +1,109 @@
+import collections
+import numpy
+import pytest
+import Calamari
+from helpers import *
+
+class CountingReader(Calamari.MemmapReader):
+    '''
+    MemmapReader that counts how often each entry is read
+    '''
+    def __init__(self,*args,**kwargs):
+        super(CountingReader,self).__init__(*args,**kwargs)
+        self.reads=collections.Counter()
+
+    def GetEntry(self,i):
+        self.reads[i]+=1
+        return super(CountingReader,self).GetEntry(i)
+
+class ListChain(object):
+    '''
+    Chain of entries held in memory, with the TChain calls the buffer uses
+    '''
+    def __init__(self,waveforms):
+        self.waveforms=waveforms
+        self.reads=collections.Counter()
+
+    def GetEntries(self):
+        return len(self.waveforms)
+
+    def GetEntry(self,i):
+        self.reads[i]+=1
+        self.Waveform=self.waveforms[i]
+        return 1
+
+class RunningSum(object):
+    '''
+    Stream filter that gives the running sum of the stream
+    '''
+    output_name='Summed'
+
+    def initial_state(self,first):
+        return 0.
+
+    def apply_filter(self,waveform,zi):
+        summed=zi+numpy.cumsum(waveform)
+        return summed,summed[-1]
+
+def test_stitched_buffer():
+    r=numpy.random.RandomState(27)
+    waveforms=r.randn(30,50)
+    chain=ListChain(waveforms)
+    buffer=Calamari.StitchedBuffer()
+    buffer.add_filter(RunningSum())
+    padded=numpy.concatenate((numpy.zeros(50),waveforms.ravel(),numpy.zeros(50)))
+    summed=numpy.concatenate((numpy.zeros(50),numpy.cumsum(waveforms.ravel()),
+        numpy.zeros(50)))
+    storage=None
+    for i in range(30):
+        data=buffer.load(chain,i)
+        assert numpy.array_equal(data,padded[50*i:50*(i+3)])
+        assert numpy.allclose(buffer.filtered['Summed'],summed[50*i:50*(i+3)])
+        # windows are views of the buffer, which is allocated once
+        window=buffer.window(-10,60)
+        assert numpy.may_share_memory(window,data)
+        assert numpy.array_equal(window,padded[50*i+40:50*i+110])
+        storage=storage if storage is not None else buffer.storage
+        assert buffer.storage is storage
+    # moving forward one entry at a time reads each entry once
+    assert set(chain.reads.values())=={1}
+    # other moves reuse the entries already in the buffer
+    for i in [28,27,20,22,21,0]:
+        data=buffer.load(chain,i)
+        assert numpy.array_equal(data,padded[50*i:50*(i+3)])
+    assert buffer.storage is storage
+    assert chain.reads[29]==1 and chain.reads[21]==2
+
+def test_window_beyond_neighbours():
+    chain=ListChain(numpy.ones((3,50)))
+    buffer=Calamari.StitchedBuffer()
+    buffer.load(chain,1)
+    with pytest.raises(IndexError):
+        buffer.window(-60,10)
+
+def test_entry_cache(tmpdir):
+    file_names,data=background_files(tmpdir,6,n_samples=100,seed=25)
+    chain=CountingReader(file_names,None)
+    cache=Calamari.EntryCache(3)
+    for i in [0,1,2,0,3,1]:
+        entry=cache.get(chain,i)
+        assert numpy.array_equal(entry.Waveform,data['Waveform'][i])
+        assert entry.t_mus==data['t_mus'][i]
+    # 0 was used again before 3 came in, so 1 was the least recently used
+    assert (cache.hits,cache.misses)==(1,5)
+    assert chain.reads==collections.Counter({0:1,1:2,2:1,3:1})
+    assert cache.get(chain,-1) is None
+    assert cache.get(chain,6) is None
+    assert len(cache.entries)==3
+
+def test_heater_trigger_reads_entries_once(tmpdir):
+    file_names,data=heater_files(tmpdir,40,n_samples=200,seed=26)
+    trigger=Calamari.HeaterTrigger('HeaterTrigger',3e-4,-0.025,1,0)
+    chain=CountingReader(file_names,None)
+    for i in xrange(chain.GetEntries()):
+        trigger.execute(chain,i)
+    # the heater entry, the bolometer entry and the neighbours of both are
+    # all looked at, but each is read from the chain once
+    assert set(chain.reads.values())=={1}
+    assert len(chain.reads)==80
+    assert trigger.cache.hits>trigger.cache.misses
@@ -0,0 +1,71 @@
+import os
+import Calamari
+from helpers import *
+
+def checkpoint_setup(FL):
+    FL.add_trigger(Calamari.SimpleTrigger('SimpleTrigger',0.01,1e-4,1e4,2,0.5))
+    FL.add_module(Calamari.NoisePSD('NoisePSD',1000))
+
+def longer_segments_setup(FL):
+    FL.add_trigger(Calamari.SimpleTrigger('SimpleTrigger',0.01,1e-4,1e4,2,0.5))
+    FL.add_module(Calamari.NoisePSD('NoisePSD',2000))
+
+def run_checkpoint(file_names,directory,setup=checkpoint_setup,**kwargs):
+    CL=Calamari.CheckpointLooper(file_names,None,setup,str(directory),
+        logging=False,reader=Calamari.MemmapReader,**kwargs)
+    CL.loop()
+    return CL
+
+def test_same_as_serial_and_resumed(tmpdir):
+    file_names,data=background_files(tmpdir.join('data'),40,n_files=4,
+        pulse_rate=20.,lock_loss_rate=0.05,seed=1)
+    FL=run_looper(file_names,checkpoint_setup)
+    assert len(FL.events)>50
+    CL=run_checkpoint(file_names,tmpdir.join('checkpoints'))
+    assert (CL.n_processed,CL.n_restored)==(4,0)
+    assert_same_events(FL,CL)
+    # resumed from the checkpoints
+    CL=run_checkpoint(file_names,tmpdir.join('checkpoints'))
+    assert (CL.n_processed,CL.n_restored)==(0,4)
+    assert_same_events(FL,CL)
+    assert CL.modules['NoisePSD'].n_segments==FL.modules['NoisePSD'].n_segments
+    # a file whose checkpoint is lost is processed again, from the state of
+    # the file before it
+    os.remove(os.path.join(CL.checkpoint_directory(file_names[2]),'done.json'))
+    CL=run_checkpoint(file_names,tmpdir.join('checkpoints'))
+    assert (CL.n_processed,CL.n_restored)==(1,3)
+    assert_same_events(FL,CL)
+
+def test_state_skips_warm_up(tmpdir,monkeypatch):
+    file_names,data=background_files(tmpdir.join('data'),20,n_files=4,
+        pulse_rate=20.,seed=3)
+    FL=run_looper(file_names,checkpoint_setup)
+    CL=run_checkpoint(file_names,tmpdir.join('checkpoints'))
+    warm_ups=[]
+    warm_up=Calamari.SimpleTrigger.warm_up
+    def counted_warm_up(self,chain,start):
+        warm_ups.append(start)
+        warm_up(self,chain,start)
+    monkeypatch.setattr(Calamari.SimpleTrigger,'warm_up',counted_warm_up)
+    # files processed again start from the state the file before ended in,
+    # without a warm-up
+    for name in file_names[1:3]:
+        os.remove(os.path.join(CL.checkpoint_directory(name),'done.json'))
+    CL=run_checkpoint(file_names,tmpdir.join('checkpoints'))
+    assert (CL.n_processed,CL.n_restored)==(2,2)
+    assert warm_ups==[]
+    assert_same_events(FL,CL)
+
+def test_settings_invalidate_checkpoints(tmpdir):
+    file_names,data=background_files(tmpdir.join('data'),6,n_files=3,seed=2)
+    run_checkpoint(file_names,tmpdir.join('checkpoints'))
+    # module settings
+    CL=run_checkpoint(file_names,tmpdir.join('checkpoints'),longer_segments_setup)
+    assert CL.n_restored==0
+    # FileLooper arguments that change the results
+    CL=run_checkpoint(file_names,tmpdir.join('checkpoints'),batch_size=10)
+    assert CL.n_restored==0
+    # and those that don't
+    CL=run_checkpoint(file_names,tmpdir.join('checkpoints'),batch_size=10,
+        chunk_size=2)
+    assert CL.n_restored==3
@@ -0,0 +1,66 @@
+import pickle
+import numpy
+import pytest
+import Calamari
+from helpers import *
+
+def test_expression():
+    cut=Calamari.CutExpression('cut','1 < x <= 3 and not abs(y) > 2 or z == -1')
+    assert cut.fields==['x','y','z']
+    x=numpy.array([0.,2.,3.,4.,2.])
+    y=numpy.array([0.,1.,-3.,0.,0.])
+    z=numpy.array([-1.,0.,0.,0.,-1.])
+    expected=[True,True,False,False,True]
+    assert list(cut.evaluate({'x':x,'y':y,'z':z}))==expected
+    for k in range(5):
+        assert bool(cut.evaluate({'x':x[k],'y':y[k],'z':z[k]}))==expected[k]
+    arithmetic=Calamari.CutExpression('cut','sqrt(x**2)%3*pi/2-1>+log10(y)')
+    assert arithmetic.evaluate({'x':4.,'y':0.1})==(4.%3*numpy.pi/2-1>-1.)
+    # the parse tree is rebuilt on unpickling
+    cut=pickle.loads(pickle.dumps(cut))
+    assert list(cut.evaluate({'x':x,'y':y,'z':z}))==expected
+
+@pytest.mark.parametrize('expression',["__import__('os').system('true')",
+    "x.real>0","x[0]>0","open('f')","(lambda: 1)()","x if y else z",
+    "abs(x,key=y)","[x]==[y]","'a'<x"])
+def test_rejects_unsafe_expressions(expression):
+    with pytest.raises(ValueError):
+        Calamari.CutExpression('cut',expression)
+
+def params_setup(FL):
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+    FL.add_module(Calamari.PulseParams('PulseParams','Waveform'))
+
+def cut_setup(FL):
+    params_setup(FL)
+    FL.add_module(Calamari.Cut('Cut',['PulseParams_PulseHeight>0.02',
+        'HeaterAmplitude<-0.07',('baseline','abs(PulseParams_Baseline)<1')],
+        reorder_every=20))
+
+def test_same_as_selection(tmpdir):
+    file_names,data=heater_files(tmpdir,100,seed=42)
+    everything=run_looper(file_names,params_setup)
+    FL=run_looper(file_names,cut_setup)
+    passed=(everything.events['PulseParams_PulseHeight']>0.02)&\
+        (everything.events['HeaterAmplitude']<-0.07)
+    assert 0<passed.sum()<(everything.events['HeaterAmplitude']<-0.07).sum()
+    assert numpy.array_equal(FL.events['Time'],everything.events['Time'][passed])
+    for batch_size in [16,1000]:
+        batched=run_looper(file_names,cut_setup,batch_size=batch_size)
+        assert_same_events(FL,batched,exact=False)
+        assert batched.modules['Cut'].counter==FL.modules['Cut'].counter
+
+def test_reorder():
+    cut=Calamari.Cut('Cut',['x>0','x>5','y>0'],reorder_every=10)
+    x=numpy.arange(10.)
+    block=Calamari.EventBlock({'x':x,'y':numpy.ones(10)})
+    cut.execute_batch(block)
+    # all cuts are tested once before the first reordering, then the one that
+    # rejects the most comes first; the one that never rejects comes last
+    assert cut.n_tested=={'x>0':10,'x>5':9,'y>0':4}
+    assert [c.name for c in cut.cuts]==['x>5','x>0','y>0']
+    assert cut.n_reorders==1
+    assert list(block.keep)==[False]*6+[True]*4
+    fixed=Calamari.Cut('Cut',['x>0','x>5','y>0'],reorder_every=0)
+    fixed.execute_batch(Calamari.EventBlock({'x':x,'y':numpy.ones(10)}))
+    assert [c.name for c in fixed.cuts]==['x>0','x>5','y>0']
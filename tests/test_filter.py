@@ -0,0 +1,78 @@
+import numpy
+import pytest
+from scipy.signal import butter,lfilter,sosfilt,sosfilt_zi
+import Calamari
+from helpers import *
+
+def heater_trigger(prescan=False):
+    return Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0,prescan=prescan)
+
+def stream_filter():
+    return Calamari.Filter('Filter',2e3,3,1e-5,'Waveform','FilteredWaveform',
+        stream=True)
+
+def stream_setup(FL):
+    FL.add_trigger(heater_trigger())
+    FL.add_module(stream_filter())
+
+def test_same_as_transfer_function():
+    r=numpy.random.RandomState(9)
+    waveforms=r.randn(3,1000)
+    for btype,cutoff in [('low',2e3),('high',500.),('band',(500.,5e3))]:
+        F=Calamari.Filter('Filter',cutoff,3,1e-5,'Waveform','FilteredWaveform',
+            btype=btype)
+        b,a=butter(3,numpy.asarray(cutoff)/(0.5/1e-5),btype=btype)
+        block=F.execute_batch(Calamari.EventBlock({'Waveform':waveforms}))
+        assert numpy.allclose(block['FilteredWaveform'],
+            lfilter(b,a,waveforms),atol=1e-8)
+
+def test_stream_filter(tmpdir):
+    file_names,data=heater_files(tmpdir,40,seed=10)
+    FL=run_looper(file_names,stream_setup,block_size=16)
+    F=FL.modules['Filter']
+    # the bolometer entries filtered as one stream, from a flat start
+    stream=data['Waveform'][0::2].ravel()
+    filtered,zi=sosfilt(F.sos,stream,zi=sosfilt_zi(F.sos)*stream[0])
+    n_samples=data['Waveform'].shape[1]
+    padded=numpy.concatenate((numpy.zeros(n_samples),filtered,
+        numpy.zeros(n_samples)))
+    entry_times=data['t_s'][0::2]+data['t_mus'][0::2]*1e-6
+    assert len(FL.events)==data['Pulsed'].sum()
+    for event in FL.events:
+        pair=numpy.argmin(abs(entry_times-event['Time']))
+        if entry_times[pair]>event['Time']:
+            pair-=1
+        start=n_samples*(pair+1)+int(round((event['Time']-entry_times[pair])/1e-5))
+        window=padded[start:start+len(event['FilteredWaveform'])]
+        assert numpy.allclose(event['FilteredWaveform'],window,rtol=1e-10,
+            atol=1e-12)
+
+def test_refused_when_entries_are_skipped(tmpdir):
+    file_names,data=heater_files(tmpdir,10,seed=11)
+    with pytest.raises(ValueError):
+        stream_filter().attach(heater_trigger(prescan=True))
+    def prescan_setup(FL):
+        FL.add_trigger(heater_trigger(prescan=True))
+        FL.add_module(stream_filter())
+    with pytest.raises(ValueError):
+        run_looper(file_names,prescan_setup)
+
+def test_trigger_index_unused(tmpdir):
+    file_names,data=heater_files(tmpdir.mkdir('data'),30,seed=12)
+    index=str(tmpdir.join('index'))
+    def index_setup(FL):
+        stream_setup(FL)
+        FL.add_trigger_index(index)
+    first=run_looper(file_names,index_setup)
+    # the index exists now, but the stream filter needs every entry
+    second=run_looper(file_names,index_setup)
+    assert not isinstance(second.trigger,Calamari.IndexedTrigger)
+    assert_same_events(first,second)
+
+def test_skipped_modules_not_attached(tmpdir):
+    file_names,data=heater_files(tmpdir,10,seed=13)
+    FL=run_looper(file_names,stream_setup,keep_fields=['Time','HeaterEnergy'])
+    assert FL.trigger.stream_filters==[]
+    assert 'FilteredWaveform' not in FL.events.keys()
+    FL=run_looper(file_names,stream_setup)
+    assert FL.trigger.stream_filters==[FL.modules['Filter']]
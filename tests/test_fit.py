@@ -0,0 +1,112 @@
+import cPickle
+import numpy
+import pytest
+import Calamari
+from helpers import *
+
+def shifted_pulse(n_samples,shift):
+    '''
+    Pulse starting at sample 100+shift (shift can be a fraction of a sample)
+    '''
+    t=(numpy.arange(n_samples)-100-shift)*1e-5
+    with numpy.errstate(over='ignore'):
+        pulse=numpy.where(t>0,numpy.exp(-t/2e-3)-numpy.exp(-t/5e-5),0.)
+    return pulse/pulse.max()
+
+def test_fit_parameters():
+    template=shifted_pulse(300,0.)
+    TF=Calamari.TemplateFit('TemplateFit','Waveform',template)
+    amplitudes=numpy.array([0.5,1.,2.])
+    baselines=numpy.array([0.1,-0.2,0.])
+    waveforms=amplitudes[:,numpy.newaxis]*template+baselines[:,numpy.newaxis]
+    params=TF.fit(waveforms,numpy.repeat(1e-5,3))
+    assert numpy.allclose(params['Amplitude'],amplitudes)
+    assert numpy.allclose(params['Baseline'],baselines)
+    assert numpy.allclose(params['Shift'],0.,atol=1e-12)
+    assert numpy.allclose(params['Chi2'],0.,atol=1e-20)
+    # a small shift is fit to first order
+    params=TF.fit(shifted_pulse(300,0.3)[numpy.newaxis],numpy.array([1e-5]))
+    assert abs(params['Shift'][0]-0.3e-5)<0.05e-5
+
+def test_same_as_least_squares():
+    template=shifted_pulse(300,0.)
+    r=numpy.random.RandomState(30)
+    waveforms=r.uniform(0.5,2.,(5,1))*template+0.01*r.randn(5,300)
+    for fit_shift in [True,False]:
+        TF=Calamari.TemplateFit('TemplateFit','Waveform',template,
+            fit_shift=fit_shift)
+        params=TF.fit(waveforms,numpy.repeat(1e-5,5))
+        for k,waveform in enumerate(waveforms):
+            solution,residual,rank,sv=numpy.linalg.lstsq(TF.model,waveform,
+                rcond=None)
+            assert numpy.isclose(params['Amplitude'][k],solution[0])
+            assert numpy.isclose(params['Baseline'][k],solution[1])
+            assert numpy.isclose(params['Chi2'][k],
+                residual[0]/(300-TF.model.shape[1]))
+
+def test_build_and_fit_template(tmpdir):
+    file_names,data=heater_files(tmpdir.mkdir('data'),100,seed=31)
+    def build_setup(FL):
+        FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+        FL.add_module(Calamari.TemplateFit('TemplateFit','Waveform',
+            selection=lambda event: event['HeaterAmplitude']<-0.07))
+    FL=run_looper(file_names,build_setup,batch_size=16)
+    FL.modules['TemplateFit'].finish()
+    template_file=str(tmpdir.join('template.npz'))
+    FL.modules['TemplateFit'].save_template(template_file)
+    assert FL.modules['TemplateFit'].n_summed==(data['Amplitude']==0.1).sum()
+    def fit_setup(FL):
+        FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+        FL.add_module(Calamari.TemplateFit('TemplateFit','Waveform',
+            template_file))
+    FL=run_looper(file_names,fit_setup)
+    # the bolometer pulse height is 0.2 times the heater pulse height
+    expected=0.2*data['Amplitude'][data['Pulsed']]
+    error=abs(FL.events['TemplateFit_Amplitude']/expected-1)
+    # the window is placed from the noisy heater pulse minimum, so pulses are
+    # shifted by up to the heater pulse width, and a few windows also hold
+    # the tail of the pulse before
+    assert numpy.median(error)<0.02
+    assert numpy.mean(error<0.1)>0.9
+    batched=run_looper(file_names,fit_setup,batch_size=16)
+    assert_same_events(FL,batched,exact=False)
+
+def test_merge():
+    waveforms=numpy.random.RandomState(32).randn(10,50)
+    whole=Calamari.TemplateFit('TemplateFit','Waveform')
+    whole.add_to_template(waveforms)
+    first=Calamari.TemplateFit('TemplateFit','Waveform')
+    first.add_to_template(waveforms[:4])
+    second=Calamari.TemplateFit('TemplateFit','Waveform')
+    second.add_to_template(waveforms[4:])
+    first.merge(second)
+    assert first.n_summed==whole.n_summed==10
+    assert numpy.allclose(first.template_sum,whole.template_sum)
+
+def test_merge_keeps_first_events():
+    waveforms=numpy.random.RandomState(33).randn(10,50)
+    whole=Calamari.TemplateFit('TemplateFit','Waveform',n_template_events=6)
+    whole.add_to_template(waveforms[:3])
+    whole.add_to_template(waveforms[3:])
+    parts=[]
+    for rows in [slice(0,4),slice(4,7),slice(7,10)]:
+        part=Calamari.TemplateFit('TemplateFit','Waveform',n_template_events=6)
+        part.add_to_template(waveforms[rows])
+        parts+=[part]
+    parts[0].merge(parts[1])
+    parts[0].merge(parts[2])
+    assert parts[0].n_summed==whole.n_summed==6
+    assert numpy.allclose(parts[0].template_sum,waveforms[:6].sum(axis=0))
+    assert numpy.allclose(parts[0].template_sum,whole.template_sum)
+
+def top_level_selection(event):
+    return event['HeaterAmplitude']<-0.07
+
+def test_pickle_selection():
+    TF=Calamari.TemplateFit('TemplateFit','Waveform',
+        selection=top_level_selection)
+    assert cPickle.loads(cPickle.dumps(TF)).selection is top_level_selection
+    TF=Calamari.TemplateFit('TemplateFit','Waveform',
+        selection=lambda event: True)
+    with pytest.raises(cPickle.PicklingError):
+        cPickle.dumps(TF)
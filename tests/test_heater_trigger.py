@@ -0,0 +1,138 @@
+import numpy
+import Calamari
+from helpers import *
+
+def scalar_heater_params(w,min_ind,dt_sample):
+    '''
+    Heater pulse amplitude, width, energy proxy and leading edge time of one
+    heater waveform, as HeaterTrigger calculated them before it worked on blocks
+    '''
+    thresh=w[min_ind]*0.9
+    pulse=w[w<thresh]
+    heater_width=len(pulse)*dt_sample
+    heater_leading_edge_time=min(numpy.argwhere(w<thresh))[0]*dt_sample
+    baseline=numpy.mean(w[w>thresh])
+    heater_amp=numpy.mean(pulse)-baseline
+    heater_energy=heater_amp**2*heater_width
+    return heater_amp, heater_width, heater_energy, heater_leading_edge_time
+
+def per_event_heater_events(data,window_time,threshold):
+    '''
+    The events the HeaterTrigger should find in heater_data(), one bolometer/
+    heater pair at a time, with readout windows cut out of each zero-padded
+    stream
+
+    Returns:
+    -list of event dicts
+    '''
+    waveforms=data['Waveform']
+    dt_sample=data['dt_s'][0]
+    n_samples=waveforms.shape[1]
+    window=int(window_time/dt_sample)
+    padding=numpy.zeros(n_samples)
+    streams=[numpy.concatenate([padding]+list(waveforms[k::2])+[padding])
+        for k in [0,1]]
+    events=[]
+    for j in range(len(waveforms)/2):
+        heater=waveforms[2*j+1]
+        ind=numpy.argmin(heater)
+        if heater[ind]>threshold:
+            continue
+        amp,width,energy,leading_edge=scalar_heater_params(heater,ind,dt_sample)
+        time=data['t_s'][2*j]+data['t_mus'][2*j]*1e-6
+        start=ind-window/2
+        first=(j+1)*n_samples+start
+        events+=[{'Time':time+start*dt_sample,'dt_sample':dt_sample,
+            'HeaterAmplitude':amp,'HeaterWidth':width,'HeaterEnergy':energy,
+            'HeaterLeadingEdgeTime':leading_edge+time,
+            'Waveform':streams[0][first:first+2*(window/2)],
+            'HeaterWaveform':streams[1][first:first+2*(window/2)]}]
+    return events
+
+def test_params_same_as_scalar():
+    data=Calamari.heater_data(2000,seed=3)
+    trigger=Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0)
+    trigger.dt_sample=1e-5
+    w=data['Waveform'][1::2][data['Pulsed']]
+    ind=w.argmin(axis=1)
+    block=trigger.calculate_heater_params_block(w,ind)
+    for k in range(len(w)):
+        expected=scalar_heater_params(w[k],ind[k],1e-5)
+        # bit for bit, from a block and one waveform at a time
+        assert [values[k] for values in block]==list(expected)
+        assert list(trigger.calculate_heater_params(w[k],ind[k]))==list(expected)
+
+def heater_setup(FL):
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+
+def test_same_as_per_event(tmpdir):
+    file_names,data=heater_files(tmpdir,150,n_files=3,seed=6)
+    reference=per_event_heater_events(data,3e-3,-0.025)
+    assert len(reference)==data['Pulsed'].sum()
+    FL=run_looper(file_names,heater_setup)
+    assert len(FL.events)==len(reference)
+    for event,expected in zip(FL.events,reference):
+        for name,value in expected.items():
+            assert numpy.array_equal(event[name],value),name
+
+def test_block_same_as_entry_by_entry(tmpdir):
+    file_names,data=heater_files(tmpdir,150,n_files=3,seed=7)
+    FL=run_looper(file_names,heater_setup)
+    for block_size in [7,64,1000]:
+        block=run_looper(file_names,heater_setup,block_size=block_size)
+        assert_same_events(FL,block)
+        block=run_looper(file_names,heater_setup,block_size=block_size,
+            batch_size=block_size)
+        assert_same_events(FL,block)
+
+def test_bad_pairs(tmpdir):
+    data=Calamari.heater_data(60,seed=8)
+    # a heater entry from another time, a heater entry turned into a bolometer
+    # entry (leaving it and the one before unpaired), and an entry from an
+    # unknown channel
+    data['t_mus'][11]+=1
+    data['Ch'][21]=0
+    data['Ch'][40]=5
+    file_names=Calamari.write_synthetic(str(tmpdir),data,n_files=2,entry_step=2)
+    def prescan_setup(FL):
+        FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0,
+            prescan=True))
+    loopers=[run_looper(file_names,heater_setup),
+        run_looper(file_names,heater_setup,block_size=16),
+        run_looper(file_names,prescan_setup)]
+    for FL in loopers:
+        assert_same_events(loopers[0],FL)
+        trigger=FL.trigger
+        assert (trigger.n_mispaired,trigger.n_unpaired,trigger.n_unknown)==(1,2,1)
+
+def test_prescan(tmpdir):
+    file_names,data=heater_files(tmpdir,100,n_files=3,seed=27)
+    def prescan_setup(FL):
+        FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0,
+            prescan=True))
+    FL=run_looper(file_names,heater_setup)
+    prescanned=run_looper(file_names,prescan_setup)
+    assert_same_events(FL,prescanned)
+    # only the bolometer entries of pairs with a heater pulse are visited
+    assert prescanned.trigger.counter==data['Pulsed'].sum()
+    chain=Calamari.MemmapReader(file_names,None)
+    entries=prescanned.trigger.select_entries(chain,150,51)
+    assert entries==[2*j for j in numpy.flatnonzero(data['Pulsed'])
+        if 51<=2*j<150]
+
+def test_prescan_noise(tmpdir):
+    file_names,data=heater_files(tmpdir,60,seed=28)
+    def noise_setup(prescan):
+        def setup(FL):
+            FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,
+                1,0,prescan=prescan))
+            FL.add_module(Calamari.NoisePSD('NoisePSD',500))
+        return setup
+    FL=run_looper(file_names,noise_setup(False))
+    prescanned=run_looper(file_names,noise_setup(True))
+    assert_same_events(FL,prescanned)
+    # the bolometer entries without a heater pulse are visited for the noise
+    assert prescanned.trigger.counter==60
+    assert FL.modules['NoisePSD'].n_segments==prescanned.modules['NoisePSD'].n_segments>0
+    assert numpy.array_equal(FL.modules['NoisePSD'].psd_sum,
+        prescanned.modules['NoisePSD'].psd_sum)
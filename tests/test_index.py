@@ -0,0 +1,52 @@
+import numpy
+import Calamari
+from helpers import *
+
+def index_setup(directory,cuts=None,**kwargs):
+    def setup(FL):
+        FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+        if cuts:
+            FL.add_module(Calamari.Cut('Cut',cuts))
+        FL.add_module(Calamari.PulseParams('PulseParams','Waveform'))
+        FL.add_trigger_index(directory)
+    return setup
+
+def test_same_events_from_index(tmpdir):
+    file_names,data=heater_files(tmpdir.mkdir('data'),80,seed=16)
+    setup=index_setup(str(tmpdir.join('index')))
+    recorded=run_looper(file_names,setup)
+    assert not isinstance(recorded.trigger,Calamari.IndexedTrigger)
+    indexed=run_looper(file_names,setup)
+    assert isinstance(indexed.trigger,Calamari.IndexedTrigger)
+    assert_same_events(recorded,indexed)
+    assert numpy.array_equal(recorded.events['TriggerEventID'],
+        numpy.arange(len(recorded.events)))
+    # blocks give the same index
+    blocks=run_looper(file_names,setup,block_size=32,batch_size=32)
+    assert_same_events(recorded,blocks)
+
+def test_trigger_event_id(tmpdir):
+    file_names,data=heater_files(tmpdir.mkdir('data'),80,seed=17)
+    # the cut rejects events, so EventID and the index position part ways
+    setup=index_setup(str(tmpdir.join('index')),['HeaterAmplitude < -0.07'])
+    recorded=run_looper(file_names,setup)
+    indexed=run_looper(file_names,setup,keep_fields=['HeaterAmplitude',
+        'PulseParams_PulseHeight'])
+    assert 0<len(recorded.events)<data['Pulsed'].sum()
+    assert numpy.array_equal(recorded.events['TriggerEventID'],
+        indexed.events['TriggerEventID'])
+    assert not numpy.array_equal(recorded.events['TriggerEventID'],
+        recorded.events['EventID'])
+    index=indexed.trigger.index
+    for event in recorded.events:
+        waveform=index.waveform(indexed.chain,event['TriggerEventID'])
+        assert numpy.array_equal(waveform,event['Waveform'])
+
+def test_index_key(tmpdir):
+    file_names,data=heater_files(tmpdir,10,seed=18)
+    trigger=Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0)
+    key=Calamari.TriggerIndex('index',file_names,None,trigger).key
+    assert Calamari.TriggerIndex('other',file_names,None,trigger).key==key
+    other=Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.03,1,0)
+    assert Calamari.TriggerIndex('index',file_names,None,other).key!=key
+    assert Calamari.TriggerIndex('index',file_names[:1],None,trigger).key!=key
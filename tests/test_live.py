@@ -0,0 +1,104 @@
+import os
+import Queue
+import threading
+import numpy
+import Calamari
+from helpers import *
+
+def heater_setup(FL):
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+    FL.add_module(Calamari.PulseParams('PulseParams','Waveform'))
+
+def simple_setup(FL):
+    FL.add_trigger(Calamari.SimpleTrigger('SimpleTrigger',0.01,1e-4,1e4,5,0.5))
+
+def run_live(tmpdir,file_names,setup,**kwargs):
+    '''
+    Replay files through a named pipe to a LiveLooper
+    '''
+    fifo=str(tmpdir.join('fifo'))
+    os.mkfifo(fifo)
+    producer=threading.Thread(target=Calamari.replay,args=(file_names,None,fifo),
+        kwargs={'reader':Calamari.MemmapReader,'speed':0,'logging':False})
+    producer.start()
+    LL=Calamari.LiveLooper(fifo,logging=False,**kwargs)
+    setup(LL)
+    LL.loop()
+    producer.join()
+    return LL
+
+class QueuedLooper(Calamari.LiveLooper):
+    '''
+    LiveLooper fed a list of queue items (arrival time, record, number of
+    records dropped before it) instead of a stream
+    '''
+    def __init__(self,items,**kwargs):
+        super(QueuedLooper,self).__init__(os.devnull,logging=False,**kwargs)
+        self.items=items
+
+    def open_file(self):
+        self.chain=Calamari.LiveChain(self.history)
+        self.stream=open(os.devnull)
+        self.queue=Queue.Queue()
+        for item in self.items:
+            self.queue.put(item)
+        self.queue.put(None)
+
+def records(data):
+    return [dict((name,data[name][i]) for name in ['Ch','t_s','t_mus','dt_s',
+        'Waveform']) for i in range(len(data['Waveform']))]
+
+def test_heater_same_as_offline(tmpdir):
+    file_names,data=heater_files(tmpdir.join('data'),300,seed=1)
+    for block_size in [1,128]:
+        FL=run_looper(file_names,heater_setup,block_size=block_size)
+        LL=run_live(tmpdir.mkdir('%i' % block_size),file_names,heater_setup,
+            block_size=block_size,history=200)
+        assert len(FL.events)==data['Pulsed'].sum()
+        assert LL.n_processed==600
+        assert_same_events(FL,LL)
+
+def test_simple_trigger_same_as_offline(tmpdir):
+    file_names,data=background_files(tmpdir.join('data'),12,pulse_rate=5.,seed=2)
+    FL=run_looper(file_names,simple_setup)
+    LL=run_live(tmpdir,file_names,simple_setup)
+    assert len(FL.events)>5
+    assert_same_events(FL,LL)
+
+def test_history_checked():
+    try:
+        Calamari.LiveLooper('-',logging=False,block_size=128)
+    except ValueError:
+        pass
+    else:
+        assert False,"history shorter than a block"
+
+def test_dropped_records_leave_gaps(tmpdir):
+    file_names,data=heater_files(tmpdir,20,fraction_pulsed=1.,seed=3)
+    FL=run_looper(file_names,heater_setup)
+    assert len(FL.events)==20
+    # drop the heater entry of pair 5: pair 5 has no event, and pair 6 is still
+    # paired up
+    items=[(Calamari.wall_clock(),record,0) for record in records(data)]
+    items=items[:11]+[items[12][:2]+(1,)]+items[13:]
+    LL=QueuedLooper(items,block_size=4)
+    heater_setup(LL)
+    LL.loop()
+    assert LL.chain.GetEntries()==40
+    assert LL.trigger.n_unpaired==1
+    keep=numpy.arange(20)!=5
+    for name in FL.events.keys():
+        if name!='EventID':
+            assert numpy.array_equal(FL.events[name][keep],LL.events[name]),name
+
+def test_gap_markers_read_as_zeros():
+    chain=Calamari.LiveChain(8)
+    for k in range(3):
+        chain.append({'Ch':0,'t_s':k,'t_mus':0,'dt_s':1e-4,
+            'Waveform':numpy.ones(10)} if k!=1 else None,0.)
+    assert chain.GetEntry(0)==1 and chain.GetEntry(1)==0
+    buffer=Calamari.StitchedBuffer()
+    data=buffer.load(chain,0)
+    assert numpy.array_equal(data[10:20],numpy.ones(10))
+    assert numpy.array_equal(data[20:30],numpy.zeros(10))
+    assert Calamari.EntryCache().get(chain,1) is None
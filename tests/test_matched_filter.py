@@ -0,0 +1,65 @@
+import numpy
+import Calamari
+from helpers import *
+
+template=Calamari.pulse_shape(100,1e-4,5e-4,8e-3)
+
+def matched_filter_trigger(n_sigma=5):
+    return Calamari.MatchedFilterTrigger('MatchedFilterTrigger',template,1e-4,
+        1e4,n_sigma,0.5)
+
+def event_centers(FL):
+    '''
+    Returns:
+    -array, sample of the center of each event's readout window, counted from
+    the start of the stream
+    '''
+    window=FL.trigger.window
+    return FL.events['Entry']*10000+FL.events['WindowStart']+window/2
+
+def locating_setup(FL):
+    FL.add_trigger(matched_filter_trigger())
+    FL.trigger.locate=True
+
+def test_filter_is_correlation(tmpdir):
+    file_names,data=background_files(tmpdir,4,seed=19)
+    chain=Calamari.MemmapReader(file_names,None)
+    trigger=matched_filter_trigger()
+    stream=data['Waveform'].ravel()
+    n=trigger.n_template
+    for i in range(1,4):
+        trigger.buffer.load(chain,i)
+        # overlap-save carries the end of the previous entry over
+        reference=numpy.correlate(stream[i*10000-(n-1):(i+1)*10000],
+            trigger.template,'valid')
+        assert numpy.allclose(trigger.filter(False),reference,rtol=0,atol=1e-12)
+
+def test_finds_pulses(tmpdir):
+    file_names,data=background_files(tmpdir,60,pulse_rate=0.5,
+        amplitude_range=(2e-2,5e-2),seed=20)
+    FL=run_looper(file_names,locating_setup)
+    peaks=data['PulseSample']+numpy.argmax(template)
+    # pulses far enough from the others not to fall in their dead time
+    gaps=numpy.diff(numpy.concatenate(([-10**6],peaks,[10**8])))
+    isolated=peaks[(gaps[:-1]>5000)&(gaps[1:]>5000)&(peaks>100)]
+    assert len(isolated)>10
+    centers=event_centers(FL)
+    for peak in isolated:
+        assert numpy.min(numpy.abs(centers-peak))<=5
+    # and nothing triggers on the noise
+    for center in centers:
+        assert numpy.min(numpy.abs(peaks-center))<=5
+
+def test_pulse_across_entries(tmpdir):
+    data=Calamari.background_data(3,pulse_rate=0.,seed=21)
+    # a pulse rising at the end of the second entry and peaking in the third
+    start=2*10000-3
+    shape=Calamari.pulse_shape(1000,1e-4,5e-4,8e-3)
+    stream=data['Waveform'].ravel()
+    stream[start:start+1000]+=2e-2*shape
+    data['Waveform']=stream.reshape(3,10000)
+    file_names=Calamari.write_synthetic(str(tmpdir),data,n_files=1)
+    FL=run_looper(file_names,locating_setup)
+    assert len(FL.events)==1
+    assert abs(event_centers(FL)[0]-(start+numpy.argmax(shape)))<=5
+    assert FL.events['MatchedFilterSNR'][0]>5
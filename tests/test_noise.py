@@ -0,0 +1,68 @@
+import numpy
+import pytest
+import scipy.signal
+import Calamari
+from helpers import *
+
+def test_same_as_welch():
+    r=numpy.random.RandomState(33)
+    stretch=1+r.randn(5000)
+    for overlap,window in [(0.5,'hann'),(0.,'boxcar'),(0.75,'hamming')]:
+        noise=Calamari.NoisePSD('NoisePSD',256,overlap=overlap,window=window)
+        noise.add(stretch,1e-4)
+        frequencies,psd=noise.psd()
+        f,reference=scipy.signal.welch(stretch,1e4,window=window,nperseg=256,
+            noverlap=256-noise.step,detrend='constant')
+        assert numpy.allclose(frequencies,f)
+        assert numpy.allclose(psd,reference,rtol=1e-10,atol=0)
+
+def test_rows_and_short_stretches():
+    waveforms=numpy.random.RandomState(34).randn(4,1000)
+    rows=Calamari.NoisePSD('NoisePSD',100)
+    rows.add(waveforms,1e-4)
+    one_by_one=Calamari.NoisePSD('NoisePSD',100)
+    for waveform in waveforms:
+        one_by_one.add(waveform,1e-4)
+    # stretches shorter than a segment are left out
+    one_by_one.add(waveforms[0,:99],1e-4)
+    assert rows.n_segments==one_by_one.n_segments==4*19
+    assert numpy.allclose(rows.psd_sum,one_by_one.psd_sum)
+    with pytest.raises(ValueError):
+        rows.add(waveforms,2e-4)
+
+def test_merge(tmpdir):
+    waveforms=numpy.random.RandomState(35).randn(6,1000)
+    whole=Calamari.NoisePSD('NoisePSD',200)
+    whole.add(waveforms,1e-4)
+    first=Calamari.NoisePSD('NoisePSD',200)
+    first.add(waveforms[:2],1e-4)
+    second=Calamari.NoisePSD('NoisePSD',200)
+    second.add(waveforms[2:],1e-4)
+    second.save(str(tmpdir.join('second.npz')))
+    first.merge_file(str(tmpdir.join('second.npz')))
+    assert first.n_segments==whole.n_segments
+    assert numpy.allclose(first.psd(),whole.psd())
+    # an empty accumulator merges in either way
+    empty=Calamari.NoisePSD('NoisePSD',200)
+    empty.merge(first)
+    first.merge(Calamari.NoisePSD('NoisePSD',200))
+    assert numpy.allclose(empty.psd(),first.psd())
+    with pytest.raises(ValueError):
+        first.merge(Calamari.NoisePSD('NoisePSD',100))
+    with pytest.raises(ValueError):
+        first.merge(Calamari.NoisePSD('NoisePSD',200,window='boxcar'))
+
+def test_white_noise_level(tmpdir):
+    file_names,data=background_files(tmpdir,20,pulse_rate=0.,seed=36)
+    def noise_setup(FL):
+        FL.add_trigger(Calamari.MatchedFilterTrigger('MatchedFilterTrigger',
+            Calamari.pulse_shape(100,1e-4,5e-4,8e-3),1e-4,1e4,6,0.5))
+        FL.add_module(Calamari.NoisePSD('NoisePSD',1000))
+    FL=run_looper(file_names,noise_setup)
+    # nothing triggers, so every entry is noise
+    assert len(FL.events)==0
+    assert FL.modules['NoisePSD'].n_segments==20*19
+    frequencies,psd=FL.modules['NoisePSD'].psd()
+    # one-sided density of white noise with rms 1e-3, sampled every 1e-4 s
+    level=2*1e-3**2*1e-4
+    assert abs(psd[1:-1].mean()/level-1)<0.02
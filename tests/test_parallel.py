@@ -0,0 +1,86 @@
+import numpy
+import Calamari
+from helpers import *
+
+def simple_setup(FL):
+    FL.add_trigger(Calamari.SimpleTrigger('SimpleTrigger',0.01,1e-4,1e4,2,0.5))
+    FL.add_module(Calamari.NoisePSD('NoisePSD',1000))
+
+def matched_filter_setup(FL):
+    FL.add_trigger(Calamari.MatchedFilterTrigger('MatchedFilterTrigger',
+        Calamari.pulse_shape(100,1e-4,5e-4,8e-3),1e-4,1e4,5,0.5))
+    FL.add_module(Calamari.NoisePSD('NoisePSD',1000))
+
+def heater_setup(FL):
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+    FL.add_module(Calamari.PulseParams('PulseParams','Waveform'))
+
+def run_parallel(file_names,setup,**kwargs):
+    kwargs.setdefault('reader',Calamari.MemmapReader)
+    PL=Calamari.ParallelLooper(file_names,None,setup,n_workers=2,n_ranges=8,
+        logging=False,**kwargs)
+    PL.loop()
+    return PL
+
+def assert_same_noise(a,b):
+    assert a.modules['NoisePSD'].n_segments==b.modules['NoisePSD'].n_segments
+    assert numpy.allclose(a.modules['NoisePSD'].psd_sum,
+        b.modules['NoisePSD'].psd_sum,rtol=1e-12)
+
+def test_simple_trigger(tmpdir):
+    # lots of triggers, so the strides skipped after them reach back further
+    # than the warm-up
+    file_names,data=background_files(tmpdir,40,n_files=4,pulse_rate=20.,
+        lock_loss_rate=0.05,seed=1)
+    FL=run_looper(file_names,simple_setup)
+    PL=run_parallel(file_names,simple_setup)
+    assert len(FL.events)>50
+    assert_same_events(FL,PL)
+    assert_same_noise(FL,PL)
+    # the warm-ups end in the exact state, nothing is looped over again
+    assert PL.n_rerun==0
+
+def test_matched_filter_trigger(tmpdir):
+    file_names,data=background_files(tmpdir,24,n_files=3,pulse_rate=10.,seed=2)
+    FL=run_looper(file_names,matched_filter_setup)
+    PL=run_parallel(file_names,matched_filter_setup)
+    assert len(FL.events)>50
+    assert_same_events(FL,PL)
+    assert_same_noise(FL,PL)
+
+def test_heater_trigger(tmpdir):
+    file_names,data=heater_files(tmpdir,200,n_files=3,seed=3)
+    FL=run_looper(file_names,heater_setup,block_size=50,batch_size=50)
+    PL=run_parallel(file_names,heater_setup,block_size=50,batch_size=50)
+    assert len(FL.events)==data['Pulsed'].sum()
+    assert_same_events(FL,PL)
+    assert FL.modules['PulseParams'].counter==PL.modules['PulseParams'].counter
+
+class StartedFrom(object):
+    '''
+    Stands in for a trigger in run_range() results, ending in a given state
+    '''
+    def __init__(self,end_state):
+        self.end_state=end_state
+
+    def state(self):
+        return self.end_state
+
+def test_rerun_limit():
+    # the second range didn't start where the first ended
+    results=[({},StartedFrom(1),{},None),({},StartedFrom(3),{},2),
+        ({},StartedFrom(4),{},3),({},StartedFrom(5),{},4)]
+    tasks=[None]*len(results)
+    reruns=Calamari.run_ranges(tasks,results,max_rerun=0.2)
+    assert next(reruns)[0] is False
+    try:
+        next(reruns)
+    except RuntimeError:
+        pass
+    else:
+        assert False,"looped over a range again"
+
+def test_split_entries():
+    ranges=Calamari.split_entries(10,4,5)
+    assert ranges==[(5,2),(7,3),(10,2),(12,3)]
+    assert Calamari.split_entries(2,4)==[(0,1),(1,1)]
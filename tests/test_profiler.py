@@ -0,0 +1,61 @@
+import json
+import numpy
+import Calamari
+from helpers import *
+
+def test_stage_histogram():
+    stage=Calamari.Stage('stage',bins_per_decade=1,min_latency=1e-6,
+        max_latency=1.)
+    assert len(stage.histogram)==8
+    assert stage.percentile(0.5) is None
+    # 10 items at 5 us each, one call of 1 item at 0.5 s, one too slow to bin
+    stage.add(5e-5,4e-5,10)
+    stage.add(0.5,0.5)
+    stage.add(10.,1.)
+    assert (stage.calls,stage.items)==(3,12)
+    assert stage.histogram==[0,10,0,0,0,0,1,1]
+    assert numpy.isclose(stage.percentile(0.5),1e-5)
+    assert numpy.isclose(stage.percentile(0.8),1e-5)
+    assert numpy.isclose(stage.percentile(0.9),1.)
+    assert numpy.isclose(stage.percentile(1.),10.)
+    report=stage.to_dict()
+    assert report['items']==12
+    assert numpy.isclose(report['latency_seconds']['mean'],(10.5+5e-5)/12)
+    assert [n for edge,n in report['latency_histogram']]==[10,1,1]
+
+def profiled_setup(FL):
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+    FL.add_module(Calamari.PulseParams('PulseParams','Waveform'))
+    FL.add_module(Calamari.Cut('Cut',['PulseParams_PulseHeight>0.02']))
+
+def test_report(tmpdir):
+    file_names,data=heater_files(tmpdir.mkdir('data'),60,seed=43)
+    FL=run_looper(file_names,profiled_setup)
+    report_file=str(tmpdir.join('profile.json'))
+    for block_size,batch_size in [(1,1),(8,16)]:
+        profiler=Calamari.Profiler(report_file,profile_module='PulseParams',
+            sample_interval=1e-3)
+        def setup(FL):
+            profiled_setup(FL)
+            FL.add_profiler(profiler)
+        profiled=run_looper(file_names,setup,block_size=block_size,
+            batch_size=batch_size)
+        assert_same_events(FL,profiled,exact=False)
+        # the methods are back to the class ones
+        for module in profiled.modules.values()+[profiled.trigger]:
+            assert not set(['execute','execute_batch','execute_block'])&\
+                set(vars(module))
+        profiled.finish()
+        with open(report_file) as f:
+            report=json.load(f)
+        assert report['entries']==120
+        assert report['events']==len(FL.events)
+        assert report['bytes_read']>0
+        stages=report['stages']
+        assert sorted(stages)==['Cut','HeaterTrigger','PulseParams','store']
+        assert stages['HeaterTrigger']['items']==120
+        assert stages['HeaterTrigger']['calls']==120/block_size
+        assert stages['PulseParams']['items']==data['Pulsed'].sum()
+        assert stages['Cut']['items']==stages['PulseParams']['items']
+        assert report['cprofile']['module']=='PulseParams'
+        assert report['cprofile']['functions']
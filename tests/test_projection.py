@@ -0,0 +1,64 @@
+import numpy
+import pytest
+import Calamari
+from helpers import *
+
+def projection_setup(FL):
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+    FL.add_module(Calamari.Filter('Filter',5e3,2,1e-5,'Waveform',
+        'FilteredWaveform'))
+    FL.add_module(Calamari.PulseParams('PulseParams','FilteredWaveform'))
+    FL.add_module(Calamari.Filter('SlowFilter',1e3,2,1e-5,'Waveform',
+        'SlowWaveform'))
+
+def test_keep_fields(tmpdir):
+    file_names,data=heater_files(tmpdir,50,seed=38)
+    FL=run_looper(file_names,projection_setup)
+    keep=['Time','PulseParams_PulseHeight']
+    for batch_size in [1,16]:
+        projected=run_looper(file_names,projection_setup,keep_fields=keep,
+            batch_size=batch_size)
+        assert sorted(projected.events.keys())==sorted(keep+['EventID'])
+        for name in projected.events.keys():
+            assert numpy.allclose(projected.events[name],FL.events[name],
+                rtol=1e-12,atol=0),name
+        # SlowFilter adds nothing that is kept, so it doesn't run; the filtered
+        # waveform is still made for PulseParams
+        assert projected.stages==[['Filter'],['PulseParams']]
+        assert projected.modules['SlowFilter'].counter==0
+
+def test_waveform_store_round_trip(tmpdir):
+    r=numpy.random.RandomState(39)
+    waveforms=numpy.cumsum(r.randn(12,300),axis=1)
+    waveforms[3,:]=0.
+    waveforms[4,::7]=numpy.inf
+    for dtype in [numpy.float32,numpy.float64]:
+        store=Calamari.WaveformStore(str(tmpdir.join(numpy.dtype(dtype).name)),
+            ['Waveform'],chunk_size=5,dtype=dtype)
+        store.append(numpy.arange(7),{'Waveform':waveforms[:7]})
+        store.append(numpy.arange(7,12),{'Waveform':waveforms[7:]})
+        store.close()
+        # a chunk is written once it has at least chunk_size events
+        assert len(store.chunk_files())==2
+        expected=waveforms.astype(dtype)
+        # lossless in the stored precision
+        assert numpy.array_equal(store.read('Waveform'),expected)
+        assert numpy.array_equal(store.read('Waveform',[11,0,6]),
+            expected[[11,0,6]])
+        assert numpy.array_equal(store.read('Waveform',4),expected[4])
+        with pytest.raises(KeyError):
+            store.read('Waveform',[2,12])
+
+def test_waveform_store_in_loop(tmpdir):
+    file_names,data=heater_files(tmpdir.mkdir('data'),50,seed=40)
+    FL=run_looper(file_names,projection_setup)
+    directory=str(tmpdir.join('waveforms'))
+    def storing_setup(FL):
+        projection_setup(FL)
+        FL.add_waveform_store(Calamari.WaveformStore(directory,
+            ['FilteredWaveform'],chunk_size=8))
+    stored=run_looper(file_names,storing_setup,keep_fields=['Time'])
+    assert sorted(stored.events.keys())==['EventID','Time']
+    store=Calamari.WaveformStore(directory,['FilteredWaveform'])
+    assert numpy.array_equal(store.read('FilteredWaveform',stored.events['EventID']),
+        FL.events['FilteredWaveform'].astype(numpy.float32))
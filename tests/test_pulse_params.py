@@ -0,0 +1,98 @@
+import warnings
+import numpy
+import Calamari
+from helpers import *
+
+def scalar_pulse_params(waveform,dt_sample,event_time):
+    '''
+    The pulse parameters of one waveform, one sample at a time, as PulseParams
+    calculated them before it worked on blocks
+
+    Returns:
+    -dict of the parameters, None for waveforms it dropped
+    '''
+    # flat waveforms have an empty baseline, which numpy warns about
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',RuntimeWarning)
+        return scalar_pulse_params_of(waveform,dt_sample,event_time)
+
+def scalar_pulse_params_of(waveform,dt_sample,event_time):
+    ind=numpy.argmax(waveform)
+    baseline=numpy.mean(waveform[0:int(0.75*ind)])
+    std=numpy.std(waveform[0:int(0.75*ind)])
+    height=waveform[ind]-baseline
+    thresh=baseline+height*(1/numpy.e)
+    try:
+        decay_time=(max(numpy.argwhere(waveform>thresh))[0]-ind)*dt_sample
+    except ValueError:
+        return None
+    try:
+        leading_edge=min(numpy.argwhere(waveform>baseline+5*std))[0]*dt_sample+\
+            event_time
+    except ValueError:
+        leading_edge=-1
+    return {'LeadingEdgeTime':leading_edge,'Baseline':baseline,
+        'BaselineRMS':std,'PulseHeight':height,'DecayTime':decay_time}
+
+def heater_setup(FL):
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+    FL.add_module(Calamari.PulseParams('PulseParams','Waveform'))
+
+def test_same_as_scalar(tmpdir):
+    file_names,data=heater_files(tmpdir,100,seed=4)
+    FL=run_looper(file_names,heater_setup)
+    assert len(FL.events)>50
+    for event in FL.events:
+        reference=scalar_pulse_params(event['Waveform'],event['dt_sample'],
+            event['Time'])
+        assert reference is not None
+        for name,value in reference.items():
+            assert event['PulseParams_'+name]==value,name
+    # and the same again a block at a time
+    block=run_looper(file_names,heater_setup,block_size=20,batch_size=20)
+    assert_same_events(FL,block)
+
+def test_block_same_as_scalar():
+    # pulses at every position, including right at the start, so the
+    # baselines have every length
+    r=numpy.random.RandomState(6)
+    pulse=Calamari.pulse_shape(300,1e-5,5e-5,5e-4)
+    waveforms=0.1+1e-3*r.randn(2000,300)
+    starts=r.randint(0,300,2000)
+    for k,start in enumerate(starts):
+        waveforms[k,start:]+=r.uniform(0.01,0.05)*pulse[:300-start]
+    dt_sample=numpy.full(2000,1e-5)
+    event_time=r.uniform(0,100,2000)
+    PP=Calamari.PulseParams('PulseParams','Waveform')
+    params,good=PP.calculate_pulse_params(waveforms,dt_sample,event_time)
+    for k in range(2000):
+        reference=scalar_pulse_params(waveforms[k],1e-5,event_time[k])
+        assert (reference is not None)==good[k]
+        if good[k]:
+            assert dict((name,params[name][k]) for name in params)==reference
+
+def test_schema():
+    PP=Calamari.PulseParams('PulseParams','Waveform')
+    block=Calamari.EventBlock({'Waveform':numpy.array([[0.,0.,0.,1.,0.5]]),
+        'dt_sample':numpy.array([1e-5]),'Time':numpy.array([0.])})
+    PP.execute_batch(block)
+    assert sorted(PP.schema())==sorted(name for name in block.keys()
+        if name.startswith('PulseParams_'))
+
+def test_rejects_flat_waveforms():
+    pulse=Calamari.pulse_shape(200,1e-5,5e-5,5e-4)
+    pulse=numpy.concatenate([numpy.zeros(50),pulse])[:200]+1e-4*\
+        numpy.random.RandomState(5).randn(200)
+    waveforms=numpy.array([numpy.full(200,0.3),
+        numpy.linspace(1.,0.,200),pulse])
+    PP=Calamari.PulseParams('PulseParams','Waveform')
+    block=Calamari.EventBlock({'Waveform':waveforms,
+        'dt_sample':numpy.full(3,1e-5),'Time':numpy.zeros(3)})
+    block=PP.execute_batch(block)
+    assert list(block.keep)==[False,False,True]
+    for waveform,keep in zip(waveforms,block.keep):
+        assert (scalar_pulse_params(waveform,1e-5,0.) is not None)==keep
+        event={'Waveform':waveform,'dt_sample':1e-5,'Time':0.}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',RuntimeWarning)
+            assert (PP.execute(event) is not False)==keep
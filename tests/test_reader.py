@@ -0,0 +1,95 @@
+import threading
+import numpy
+import pytest
+import Calamari
+from helpers import *
+
+def heater_setup(FL):
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+    FL.add_module(Calamari.PulseParams('PulseParams','Waveform'))
+
+class Failing(Calamari.Module):
+    '''
+    Module that raises on the n-th event
+    '''
+    def __init__(self,name,n):
+        self.n=n
+        super(Failing,self).__init__(name)
+
+    @Calamari.Module._execute
+    def execute(self,event):
+        if self.counter==self.n:
+            raise RuntimeError("failing on purpose")
+        return event
+
+def test_memmap_reader_entries(tmpdir):
+    file_names,data=background_files(tmpdir,23,n_files=3,n_samples=100,seed=22)
+    chain=Calamari.MemmapReader(file_names,None,chunk_size=5)
+    assert chain.GetEntries()==23
+    # in order, backwards across chunks and files, and jumping around
+    order=range(23)+range(22,-1,-1)+list(numpy.random.RandomState(0).randint(0,23,40))
+    for i in order:
+        assert chain.GetEntry(i)==100*8
+        assert numpy.array_equal(chain.Waveform,data['Waveform'][i])
+        for name in Calamari.Reader.scalar_names:
+            assert getattr(chain,name)==data[name][i]
+    assert chain.GetEntry(-1)==0
+    assert chain.GetEntry(23)==0
+
+def test_scan(tmpdir):
+    file_names,data=heater_files(tmpdir,20,n_files=3,n_samples=50,seed=23)
+    chain=Calamari.MemmapReader(file_names,None,chunk_size=7)
+    for start,stop in [(0,None),(5,33),(13,14)]:
+        scan=Calamari.scan_entries(chain,stop,start)
+        # the generic scan reads whole chunks
+        generic=Calamari.Reader.scan(chain,stop,start)
+        rows=slice(start,stop)
+        assert numpy.array_equal(scan['WaveformMin'],
+            data['Waveform'][rows].min(axis=1))
+        for name in ['Ch','t_s','t_mus','WaveformMin']:
+            assert numpy.array_equal(scan[name],generic[name])
+            if name!='WaveformMin':
+                assert numpy.array_equal(scan[name],data[name][rows])
+
+def test_write_memmap_store_lengths(tmpdir):
+    with pytest.raises(ValueError):
+        Calamari.write_memmap_store(str(tmpdir),numpy.zeros((3,10)),
+            numpy.zeros(3),numpy.zeros(3),numpy.zeros(2),numpy.zeros(3))
+
+def test_tree_reader(tmpdir):
+    pytest.importorskip('root_numpy')
+    data=Calamari.heater_data(20,n_samples=50,seed=24)
+    file_names=Calamari.write_synthetic(str(tmpdir),data,n_files=2,
+        file_format='root')
+    chain=Calamari.TreeReader(file_names,'data_tree',chunk_size=7)
+    assert chain.GetEntries()==40
+    for i in range(40):
+        chain.GetEntry(i)
+        assert numpy.allclose(chain.Waveform,data['Waveform'][i])
+        assert chain.Ch==data['Ch'][i]
+
+def test_prefetch_same_events(tmpdir):
+    file_names,data=heater_files(tmpdir,100,n_files=3,seed=14)
+    FL=run_looper(file_names,heater_setup,chunk_size=16)
+    for prefetch,memory in [(1,None),(4,None),(4,1)]:
+        prefetched=run_looper(file_names,heater_setup,chunk_size=16,
+            prefetch=prefetch,prefetch_memory=memory)
+        assert_same_events(FL,prefetched)
+        assert prefetched.chain.thread is None
+
+def test_prefetch_stopped_on_error(tmpdir):
+    file_names,data=heater_files(tmpdir,100,n_files=3,seed=15)
+    def failing_setup(FL):
+        heater_setup(FL)
+        FL.add_module(Failing('Failing',20))
+        FL.add_profiler(Calamari.Profiler())
+    n_threads=threading.active_count()
+    FL=Calamari.FileLooper(file_names,None,logging=False,
+        reader=Calamari.MemmapReader,chunk_size=16,prefetch=2)
+    failing_setup(FL)
+    with pytest.raises(RuntimeError):
+        FL.loop()
+    assert FL.chain.thread is None
+    assert threading.active_count()==n_threads
+    # the trigger and modules are unwrapped, so the looper can run again
+    assert FL.profiler.wrapped==[]
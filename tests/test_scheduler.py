@@ -0,0 +1,45 @@
+import numpy
+import Calamari
+from helpers import *
+
+def scheduler_setup(FL):
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+    FL.add_module(Calamari.Filter('Filter',5e3,2,1e-5,'Waveform',
+        'FilteredWaveform'))
+    FL.add_module(Calamari.Filter('SlowFilter',1e3,2,1e-5,'Waveform',
+        'SlowWaveform'))
+    FL.add_module(Calamari.Filter('SmoothFilter',1e3,2,1e-5,'FilteredWaveform',
+        'SmoothWaveform'))
+    FL.add_module(Calamari.PulseParams('PulseParams','SmoothWaveform'))
+    FL.add_module(Calamari.Cut('Cut',['HeaterAmplitude<-0.07']))
+
+def test_plan_schedule():
+    FL=Calamari.FileLooper([],None,logging=False)
+    scheduler_setup(FL)
+    # the cut only reads a trigger field, so it goes first; the filters of the
+    # waveform don't depend on each other, the one of the filtered waveform
+    # has to wait for it, and PulseParams may reject events, so it runs alone
+    assert FL.plan_schedule()==[['Cut'],['Filter','SlowFilter'],
+        ['SmoothFilter'],['PulseParams']]
+    FL.keep_fields=['Time','PulseParams_PulseHeight']
+    assert FL.plan_schedule()==[['Cut'],['Filter'],['SmoothFilter'],
+        ['PulseParams']]
+
+def test_cut_stays_behind_its_inputs():
+    FL=Calamari.FileLooper([],None,logging=False)
+    scheduler_setup(FL)
+    FL.add_module(Calamari.Cut('HeightCut',['PulseParams_PulseHeight<0']))
+    assert FL.plan_schedule()[-1]==['HeightCut']
+
+def test_threads_same_events(tmpdir):
+    file_names,data=heater_files(tmpdir,80,seed=41)
+    FL=run_looper(file_names,scheduler_setup,batch_size=16)
+    assert 0<len(FL.events)<data['Pulsed'].sum()
+    for n_threads in [2,4]:
+        threaded=run_looper(file_names,scheduler_setup,batch_size=16,
+            n_threads=n_threads)
+        assert_same_events(FL,threaded)
+        assert threaded.pool is None
+    # and the same as running the modules event by event
+    per_event=run_looper(file_names,scheduler_setup)
+    assert_same_events(FL,per_event,exact=False)
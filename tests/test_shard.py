@@ -0,0 +1,58 @@
+import os
+import json
+import numpy
+import Calamari
+from helpers import *
+
+def shard_setup(FL):
+    FL.add_trigger(Calamari.SimpleTrigger('SimpleTrigger',0.01,1e-4,1e4,2,0.5))
+    FL.add_module(Calamari.NoisePSD('NoisePSD',1000))
+
+def make_manifest(tmpdir,file_names,n_shards=4):
+    manifest_file=str(tmpdir.join('manifest.json'))
+    Calamari.write_manifest(manifest_file,file_names,None,shard_setup,n_shards,
+        str(tmpdir.join('output')),reader=Calamari.MemmapReader,chunk_size=7)
+    return manifest_file
+
+def test_merge_same_as_serial(tmpdir):
+    file_names,data=background_files(tmpdir.join('data'),32,n_files=2,
+        pulse_rate=20.,lock_loss_rate=0.05,seed=1)
+    manifest_file=make_manifest(tmpdir,file_names)
+    manifest=Calamari.read_manifest(manifest_file)
+    assert manifest['looper_args']=={'reader':'Calamari.reader:MemmapReader',
+        'chunk_size':7}
+    for k in range(4):
+        Calamari.run_shard(manifest_file,k,chunk_size=20)
+    assert Calamari.unfinished_shards(manifest)==[]
+    merged=Calamari.merge_shards(manifest_file,logging=False)
+    FL=run_looper(file_names,shard_setup)
+    assert len(FL.events)>50
+    assert_same_events(FL,merged)
+    assert merged.modules['NoisePSD'].n_segments==FL.modules['NoisePSD'].n_segments
+    assert merged.n_rerun==0
+
+def test_done_markers_tied_to_manifest(tmpdir):
+    file_names,data=background_files(tmpdir.join('data'),8,seed=2)
+    manifest_file=make_manifest(tmpdir,file_names,2)
+    Calamari.run_shard(manifest_file,1)
+    manifest=Calamari.read_manifest(manifest_file)
+    assert Calamari.unfinished_shards(manifest)==[0]
+    # the same shards written again make a new manifest
+    manifest_file=make_manifest(tmpdir,file_names,2)
+    assert Calamari.unfinished_shards(Calamari.read_manifest(manifest_file))==[0,1]
+    try:
+        Calamari.merge_shards(manifest_file,logging=False)
+    except RuntimeError:
+        pass
+    else:
+        assert False,"merged unfinished shards"
+
+def test_run_local(tmpdir):
+    file_names,data=background_files(tmpdir.join('data'),8,seed=3)
+    manifest_file=make_manifest(tmpdir,file_names,2)
+    assert Calamari.run_local(manifest_file,2)==[]
+    with open(os.path.join(str(tmpdir),'output','shard_0001','done.json')) as f:
+        assert json.load(f)['manifest']==\
+            Calamari.read_manifest(manifest_file)['hash']
+    merged=Calamari.merge_shards(manifest_file,logging=False)
+    assert_same_events(run_looper(file_names,shard_setup),merged)
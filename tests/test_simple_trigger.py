@@ -0,0 +1,99 @@
+import numpy
+import Calamari
+from helpers import *
+
+def shift_buffer_triggers(waveforms,stride,n_sigma,skip):
+    '''
+    Trigger decisions of the original SimpleTrigger, which shifted a buffer of
+    the last two entries along by one stride at a time and took the mean and
+    std of the whole buffer for every stride
+
+    Returns:
+    -list of (entry, stride) of every trigger
+    '''
+    n_samples=waveforms.shape[1]
+    daq_buffer=numpy.zeros(2*n_samples)
+    triggers=[]
+    for i,waveform in enumerate(waveforms):
+        j=0
+        while j<n_samples/stride:
+            daq_buffer[:-stride]=daq_buffer[stride:]
+            daq_buffer[-stride:]=waveform[stride*j:stride*(j+1)]
+            mean=numpy.mean(daq_buffer[:-stride])
+            std=numpy.std(daq_buffer[:-stride])
+            if numpy.mean(daq_buffer[-stride:])>mean+n_sigma*std:
+                triggers+=[(i,j)]
+                j+=skip
+            else:
+                j+=1
+    return triggers
+
+def ring_buffer_triggers(file_names,trigger):
+    '''
+    Returns:
+    -list of (entry, stride) of every trigger of a SimpleTrigger
+    '''
+    chain=Calamari.MemmapReader(file_names,None)
+    trigger.locate=True
+    triggers=[]
+    for i in xrange(chain.GetEntries()):
+        for event in trigger.execute(chain,i):
+            center=event['WindowStart']+trigger.window/2
+            assert center%trigger.stride==0
+            triggers+=[(event['Entry'],center/trigger.stride)]
+    return triggers
+
+def test_same_decisions_as_shift_buffer(tmpdir):
+    for n_sigma,seed in [(5,1),(4,2),(3,3)]:
+        file_names,data=background_files(tmpdir.join('%i' % seed),12,
+            pulse_rate=5.,amplitude_range=(5e-3,5e-2),lock_loss_rate=0.3,
+            lock_loss_time=0.02,seed=seed)
+        assert len(data['LockLossStart'])>0
+        trigger=Calamari.SimpleTrigger('SimpleTrigger',0.01,1e-4,1e4,n_sigma,0.5)
+        skip=int(0.5/2/1e-4/trigger.stride)
+        reference=shift_buffer_triggers(data['Waveform'],trigger.stride,
+            n_sigma,skip)
+        # both trigger on the step up from the zeroed buffer in the first
+        # entries; check there are pulses after that too
+        assert len([j for i,j in reference if i>=5])>=4
+        assert ring_buffer_triggers(file_names,trigger)==reference
+
+def test_readout_windows(tmpdir):
+    file_names,data=background_files(tmpdir,12,pulse_rate=5.,seed=4)
+    FL=run_looper(file_names,lambda FL: FL.add_trigger(
+        Calamari.SimpleTrigger('SimpleTrigger',0.01,1e-4,1e4,5,0.5)))
+    assert len(FL.events)>0
+    stream=data['Waveform'].ravel()
+    # windows reaching past either end of the run are padded with zeros
+    padded=numpy.concatenate((numpy.zeros(10000),stream,numpy.zeros(10000)))
+    for waveform in FL.events['Waveform']:
+        assert waveform.shape==(5000,)
+        # every readout is a piece of the continuous stream, even though the
+        # trigger's buffer has moved on since: the looper keeps copies
+        start=numpy.flatnonzero(padded==waveform[2500])
+        assert any(numpy.array_equal(padded[k-2500:k+2500],waveform)
+            for k in start)
+    # the windows are views of the buffer, so events kept across entries (a
+    # block of entries, or a batch of events) must be copies
+    for kwargs in [dict(block_size=8),dict(batch_size=16)]:
+        held=run_looper(file_names,lambda FL: FL.add_trigger(
+            Calamari.SimpleTrigger('SimpleTrigger',0.01,1e-4,1e4,5,0.5)),**kwargs)
+        assert_same_events(FL,held)
+
+def test_event_times(tmpdir):
+    file_names,data=background_files(tmpdir,6,pulse_rate=5.,seed=5)
+    chain=Calamari.MemmapReader(file_names,None)
+    trigger=Calamari.SimpleTrigger('SimpleTrigger',0.01,1e-4,1e4,5,0.5)
+    trigger.locate=True
+    entry_times=data['t_s']+data['t_mus']*1e-6
+    n_events=0
+    for i in xrange(chain.GetEntries()):
+        for event in trigger.execute(chain,i):
+            assert event['dt_sample']==1e-4
+            assert numpy.isclose(event['Time'],
+                entry_times[i]+event['WindowStart']*1e-4,rtol=0,atol=1e-9)
+            # the readout is a view of the trigger's buffer, not a copy
+            assert numpy.may_share_memory(event['Waveform'],trigger.buffer.data)
+            n_events+=1
+    assert n_events>0
+    assert sorted(trigger.schema())==['Time','Waveform','dt_sample']
@@ -0,0 +1,80 @@
+import numpy
+import pytest
+import Calamari
+from helpers import *
+
+def make_events(n,first=0):
+    return [{'Time':float(k),'Ch':k%3,'Waveform':numpy.arange(5.)*k}
+        for k in range(first,first+n)]
+
+def test_growth():
+    events=make_events(11)
+    store=Calamari.EventStore(capacity=2)
+    store.declare({'Ch':numpy.int16})
+    for event in events[:3]:
+        store.append_event(event)
+    store.append(Calamari.EventBlock.from_events(events[3:]))
+    assert len(store)==11
+    assert store.capacity>=11
+    assert store['Ch'].dtype==numpy.int16
+    assert store['Waveform'].shape==(11,5)
+    assert list(store['EventID'])==range(11)
+    for k,event in enumerate(store):
+        assert event['Time']==events[k]['Time']
+        assert numpy.array_equal(event['Waveform'],events[k]['Waveform'])
+    assert store[-1]['Time']==10.
+    with pytest.raises(IndexError):
+        store[11]
+
+def test_clear_keeps_numbering():
+    store=Calamari.EventStore(capacity=4)
+    store.append(Calamari.EventBlock.from_events(make_events(3)))
+    capacity=store.capacity
+    store.clear()
+    assert len(store)==0
+    store.append(Calamari.EventBlock.from_events(make_events(2,3)))
+    assert list(store['EventID'])==[3,4]
+    assert list(store['Time'])==[3.,4.]
+    assert store.capacity==capacity
+
+def test_rejected_events_not_stored():
+    block=Calamari.EventBlock.from_events(make_events(4))
+    block.keep[[0,2]]=False
+    store=Calamari.EventStore()
+    store.append(block)
+    assert list(store['Time'])==[1.,3.]
+    assert list(store['EventID'])==[0,1]
+
+def test_fields_must_match():
+    store=Calamari.EventStore()
+    store.append_event(make_events(1)[0])
+    event=make_events(1)[0]
+    del event['Ch']
+    with pytest.raises(ValueError):
+        store.append_event(event)
+    event['Ch']=0
+    event['Extra']=1.
+    with pytest.raises(ValueError):
+        store.append(Calamari.EventBlock.from_events([event]))
+    assert len(store)==1
+
+def test_to_array():
+    store=Calamari.EventStore()
+    assert len(store.to_array())==0
+    events=make_events(4)
+    store.append(Calamari.EventBlock.from_events(events))
+    array=store.to_array()
+    assert array.dtype.names==('EventID','Ch','Time','Waveform')
+    assert array['Waveform'].shape==(4,5)
+    assert numpy.array_equal(array['Time'],store['Time'])
+    assert numpy.array_equal(array['Waveform'],store['Waveform'])
+
+def test_to_dataframe():
+    pytest.importorskip('pandas')
+    store=Calamari.EventStore()
+    store.append(Calamari.EventBlock.from_events(make_events(4)))
+    df=store.to_dataframe()
+    assert list(df.index)==range(4)
+    assert numpy.array_equal(df['Time'].values,store['Time'])
+    assert numpy.array_equal(df['Waveform'].iloc[2],store['Waveform'][2])
+    assert 'Waveform' not in store.to_dataframe(waveforms=False)
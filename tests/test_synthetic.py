@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+import subprocess
+import numpy
+import pytest
+import Calamari
+from helpers import *
+
+def test_heater_data():
+    data=Calamari.heater_data(50,n_samples=500,noise=0.,seed=44)
+    assert data['Waveform'].shape==(100,500)
+    assert list(data['Ch'][:4])==[0,1,0,1]
+    # each heater entry is taken with the bolometer entry before it, and the
+    # pairs follow each other back to back
+    times=data['t_s']+data['t_mus']*1e-6
+    assert numpy.array_equal(times[0::2],times[1::2])
+    assert numpy.allclose(numpy.diff(times[0::2]),500*1e-5)
+    width=20
+    for j in range(50):
+        heater=data['Waveform'][2*j+1]
+        bolometer=data['Waveform'][2*j]-0.1
+        start=data['PulseStart'][j]
+        amplitude=data['Amplitude'][j]
+        if not data['Pulsed'][j]:
+            assert amplitude==0
+            assert not heater.any() and not bolometer.any()
+            continue
+        assert amplitude in (0.05,0.1)
+        assert numpy.allclose(heater[start:start+width],-amplitude)
+        assert not heater[:start].any() and not heater[start+width:].any()
+        assert not bolometer[:start].any()
+        assert numpy.isclose(bolometer.max(),0.2*amplitude,rtol=0.05)
+
+def test_background_data():
+    data=Calamari.background_data(10,n_samples=1000,noise=0.,pulse_rate=5.,
+        lock_loss_rate=1.,lock_loss_time=0.01,seed=45)
+    stream=data['Waveform'].ravel()-0.3
+    assert len(data['PulseSample'])>0 and len(data['LockLossStart'])>0
+    assert numpy.allclose(numpy.diff(data['t_s']+data['t_mus']*1e-6),0.1)
+    lost=numpy.zeros(len(stream),dtype=bool)
+    for start,stop in zip(data['LockLossStart'],data['LockLossStop']):
+        assert stop-start==100 or stop==len(stream)
+        lost[start:stop]=True
+    # flat at 100 times the noise above the baseline, here 0
+    assert numpy.array_equal(stream[lost],numpy.zeros(lost.sum()))
+    # the stream starts rising at each pulse
+    for sample in data['PulseSample']:
+        if sample+1<len(stream) and not lost[sample:sample+2].any():
+            assert stream[sample+1]>stream[sample]
+    first=data['PulseSample'][0]
+    if not lost[:first+1].any():
+        assert not stream[:first+1].any()
+
+def test_write_synthetic(tmpdir):
+    data=Calamari.heater_data(11,n_samples=50,seed=46)
+    file_names=Calamari.write_synthetic(str(tmpdir),data,n_files=3,entry_step=2)
+    assert len(file_names)==3
+    chain=Calamari.MemmapReader(file_names,None)
+    assert chain.GetEntries()==22
+    for i in range(22):
+        chain.GetEntry(i)
+        assert numpy.array_equal(chain.Waveform,data['Waveform'][i])
+    # the files only split between pairs
+    for file_name in file_names:
+        assert Calamari.MemmapReader([file_name],None).GetEntries()%2==0
+    with pytest.raises(ValueError):
+        Calamari.write_synthetic(str(tmpdir),data,file_format='csv')
+
+def test_benchmark_baseline(tmpdir):
+    script=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..',
+        'scripts','Benchmark.py')
+    baseline=str(tmpdir.join('baseline.json'))
+    env=dict(os.environ)
+    env['PYTHONPATH']=os.pathsep.join([os.path.dirname(Calamari.__path__[0])]+
+        ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+    subprocess.check_call([sys.executable,script,'save',baseline,'0.02'],
+        env=env,stdout=open(os.devnull,'w'))
+    with open(baseline) as f:
+        results=json.load(f)['results']
+    names=set(key.rsplit('/',1)[0] for key in results)
+    assert names=={'heater/HeaterTrigger','heater/Filter','heater/PulseParams',
+        'heater/write_output','heater_blocks/HeaterTrigger',
+        'heater_blocks/Filter','heater_blocks/PulseParams',
+        'heater_blocks/write_output','background/SimpleTrigger',
+        'background/MatchedFilterTrigger','pulses/PulseParams_events',
+        'pulses/PulseParams_blocks'}
+    assert all(result['items']>0 for result in results.values())
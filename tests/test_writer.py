@@ -0,0 +1,54 @@
+import os
+import numpy
+import pytest
+import Calamari
+from helpers import *
+
+def heater_setup(FL):
+    FL.add_trigger(Calamari.HeaterTrigger('HeaterTrigger',3e-3,-0.025,1,0))
+    FL.add_module(Calamari.PulseParams('PulseParams','Waveform'))
+
+def test_npz_round_trip(tmpdir):
+    file_names,data=heater_files(tmpdir.mkdir('data'),60,seed=37)
+    FL=run_looper(file_names,heater_setup)
+    out_dir=str(tmpdir.join('out'))
+    def writing_setup(FL):
+        heater_setup(FL)
+        FL.add_writer(Calamari.NPZWriter(out_dir,chunk_size=7))
+    written=run_looper(file_names,writing_setup)
+    # everything went to disk in full chunks, plus the rest at the end
+    assert len(written.events)==0
+    n_events=len(FL.events)
+    assert written.writer.n_events==n_events
+    assert written.writer.n_chunks==(n_events+6)/7
+    assert len(os.listdir(out_dir))==written.writer.n_chunks
+    events=Calamari.NPZWriter.read(out_dir)
+    expected=FL.events.to_array()
+    assert events.dtype==expected.dtype
+    for name in expected.dtype.names:
+        assert numpy.array_equal(events[name],expected[name]),name
+    # writing again replaces the old chunks
+    run_looper(file_names,writing_setup)
+    assert len(Calamari.NPZWriter.read(out_dir))==n_events
+
+def test_npz_empty(tmpdir):
+    writer=Calamari.NPZWriter(str(tmpdir.join('out')))
+    writer.write(Calamari.EventStore().to_array())
+    writer.close()
+    assert writer.n_chunks==0
+    assert len(Calamari.NPZWriter.read(str(tmpdir.join('out'))))==0
+
+def test_hdf5_round_trip(tmpdir):
+    h5py=pytest.importorskip('h5py')
+    store=Calamari.EventStore()
+    store.append(Calamari.EventBlock.from_events([{'Time':float(k),
+        'Waveform':numpy.arange(4.)*k} for k in range(10)]))
+    events=store.to_array()
+    file_name=str(tmpdir.join('events.h5'))
+    writer=Calamari.HDF5Writer(file_name,chunk_size=4)
+    for start in range(0,10,4):
+        writer.write(events[start:start+4])
+    writer.close()
+    with h5py.File(file_name,'r') as f:
+        for name in events.dtype.names:
+            assert numpy.array_equal(f[name][:],events[name])